@@ -0,0 +1,177 @@
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import time
+import traceback
+
+import numpy as np
+import torch
+
+RESULTS_PATH = "canonical_network/results/benchmarks"
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def peak_memory_bytes(device):
+    """ Peak allocated cuda memory, on cpu the peak resident set size of the process (linux reports kilobytes). """
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def time_fn(fn, device, warmup, runs):
+    """ Runs `fn` `warmup` times untimed then `runs` times, returns the wall time of every timed run in seconds. """
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def latency_stats(timings, items_per_run):
+    timings = np.asarray(timings)
+    return {
+        "latency_ms_p50": float(np.percentile(timings, 50) * 1e3),
+        "latency_ms_p90": float(np.percentile(timings, 90) * 1e3),
+        "latency_ms_p99": float(np.percentile(timings, 99) * 1e3),
+        "latency_ms_mean": float(timings.mean() * 1e3),
+        "throughput": float(items_per_run / np.median(timings)),
+    }
+
+
+def environment_info(device):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ""
+    return {
+        "commit": commit,
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "num_threads": torch.get_num_threads(),
+        "device": str(device),
+        "device_name": torch.cuda.get_device_name(device) if device.type == "cuda" else platform.processor(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def _run_case(run, args):
+    try:
+        return run(*args)
+    except Exception as e:
+        return {"name": args[0], "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
+
+
+def _run_case_in_child(run, args, connection, start_method):
+    # a spawned child defaults to spawn as well, restore the parent's start method so DataLoader workers start the
+    # way they do in training
+    mp.set_start_method(start_method, force=True)
+    connection.send(_run_case(run, args))
+    connection.close()
+
+
+def _run_isolated(run, args):
+    # a plain (non daemonic) process rather than a pool worker, so a case may start DataLoader workers itself
+    context = mp.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_case_in_child, args=(run, args, sender, mp.get_start_method()))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        result = {"name": args[0], "error": f"the case process exited with code {process.exitcode}"}
+    return result
+
+
+def run_cases(run, cases, isolate):
+    """
+    Runs `run(*case)` for every case, whose first entry is its name, and collects the result dicts. With `isolate`
+    each case gets a fresh spawned process, so cpu peak memory is the case's own and a crash or leak stays
+    contained. Exceptions are recorded in the result instead of stopping the suite.
+    """
+    results = []
+    for case in cases:
+        results.append(_run_isolated(run, case) if isolate else _run_case(run, case))
+        print_result(results[-1])
+    return results
+
+
+def print_result(result):
+    name = result.get("name", "")
+    if "error" in result:
+        print(f"{name}: {result['error']}")
+        return
+    print(", ".join([name] + [f"{key} {value:.4g}" for key, value in result.items()
+                              if isinstance(value, float)]))
+
+
+def failed_cases(results):
+    """ Names of the cases that raised or crashed, so a suite with cases that never ran does not pass. """
+    return [result.get("name", "") for result in results if "error" in result]
+
+
+def save_results(results, environment, name, output_path=RESULTS_PATH):
+    os.makedirs(output_path, exist_ok=True)
+    path = os.path.join(output_path, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump({"environment": environment, "results": results}, f, indent=2)
+    print(f"Saved {path}")
+    return path
+
+
+def metric_direction(metric):
+    """ True if higher is better, False if lower is better, None if the metric is not compared. """
+    if metric.endswith(("throughput", "samples_per_s")):
+        return True
+    if metric.endswith(("latency_ms_p50", "latency_ms_p90", "peak_memory_mb", "epoch_s", "import_s", "startup_s")):
+        return False
+    return None
+
+
+def compare_to_baseline(results, baseline_path, tolerance):
+    """
+    Prints every metric next to the baseline run with the same case name and returns the regressions, metrics
+    that got worse by more than `tolerance` (relative).
+    """
+    with open(baseline_path, "r") as f:
+        baseline = {result["name"]: result for result in json.load(f)["results"] if "name" in result}
+    regressions = []
+    for result in results:
+        reference = baseline.get(result.get("name"))
+        if reference is None or "error" in result or "error" in reference:
+            continue
+        for metric, value in result.items():
+            higher_is_better = metric_direction(metric)
+            if higher_is_better is None or not isinstance(value, float) or not reference.get(metric):
+                continue
+            ratio = result[metric] / reference[metric]
+            worse = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+            print(f"{result['name']} {metric}: {reference[metric]:.4g} -> {result[metric]:.4g} ({ratio:.2f}x)"
+                  + (" REGRESSION" if worse else ""))
+            if worse:
+                regressions.append((result["name"], metric, ratio))
+    return regressions
@@ -0,0 +1,427 @@
+import cProfile
+import json
+import multiprocessing as mp
+import os
+import pickle
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from canonical_network.benchmarks.common import environment_info, run_cases, save_results, compare_to_baseline, \
+    failed_cases
+
+MODULES = ["nbody", "rotated_mnist", "cifar10", "modelnet", "shapenet"]
+
+# self time of these functions (matched on pstats' "file:line(function)" strings) is attributed to the stage,
+# everything else inside __getitem__ counts as transform
+STAGE_PATTERNS = {
+    "read": ["io.open", "of '_io.", "numpy.fromfile", "memmap", "mmap", "posix.", "SharedMemory", "'read' of"],
+    "parse": ["_load_from_filelike", "loadtxt", "<method 'split' of 'str'", "_pickle.load", "json", "frombuffer",
+              "_read", "float"],
+}
+
+
+def get_hyperparams():
+    parser = ArgumentParser(description="Drives the train loader of every data module on synthetic on-disk "
+                                        "fixtures and reports throughput, per-stage time and worker utilisation.")
+    parser.add_argument("--modules", type=str, default=",".join(MODULES), help="comma separated data modules")
+    parser.add_argument("--num_samples", type=int, default=256, help="samples per split of the fixtures")
+    parser.add_argument("--num_epochs", type=int, default=2, help="epochs per module, the first one is cold")
+    parser.add_argument("--max_batches", type=int, default=0, help="batches per epoch [default: 0, all]")
+    parser.add_argument("--num_workers", type=int, default=-1,
+                        help="loader workers [default: -1, the training script default]")
+    parser.add_argument("--batch_size", type=int, default=0, help="batch size [default: 0, the training script default]")
+    parser.add_argument("--overrides", type=str, default="{}",
+                        help="json dict of hyperparameters for the data modules, e.g. '{\"cache_backend\": \"shared\"}'")
+    parser.add_argument("--packed", type=int, default=0,
+                        help="also pack the point cloud fixtures and benchmark the packed stores")
+    parser.add_argument("--profile_batches", type=int, default=8, help="batches profiled for the stage breakdown")
+    parser.add_argument("--fixture_path", type=str, default="",
+                        help="where to write the fixtures [default: a temporary directory, removed afterwards]")
+    parser.add_argument("--isolate", type=int, default=1, help="run every module in a fresh process")
+    parser.add_argument("--output_path", type=str, default="canonical_network/results/benchmarks",
+                        help="directory for the json results")
+    parser.add_argument("--baseline", type=str, default="", help="results json to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown reported as a regression")
+    return parser.parse_args()
+
+
+# Fixtures, in the on-disk layout each data module reads
+
+def write_nbody_fixture(root, num_samples, num_steps=49, num_nodes=5):
+    os.makedirs(root, exist_ok=True)
+    rng = np.random.RandomState(0)
+    for split in ("train", "valid", "test"):
+        suffix = split + "_charged5_initvel1small"
+        charges = rng.choice([-1, 1], size=(num_samples, num_nodes, 1))
+        np.save(os.path.join(root, f"loc_{suffix}.npy"), rng.randn(num_samples, num_steps, 3, num_nodes))
+        np.save(os.path.join(root, f"vel_{suffix}.npy"), rng.randn(num_samples, num_steps, 3, num_nodes))
+        np.save(os.path.join(root, f"edges_{suffix}.npy"), charges * charges.transpose(0, 2, 1))
+        np.save(os.path.join(root, f"charges_{suffix}.npy"), charges)
+
+
+def write_rotated_mnist_fixture(root, num_samples):
+    os.makedirs(root, exist_ok=True)
+    rng = np.random.RandomState(0)
+    for split in ("train", "valid", "test"):
+        images = (rng.rand(num_samples, 784) > 0.8) * rng.rand(num_samples, 784)
+        labels = rng.randint(10, size=(num_samples, 1))
+        np.savetxt(os.path.join(root, f"mnist_rotated_{split}.amat"), np.concatenate([images, labels], 1), fmt="%.6g")
+
+
+def write_cifar10_fixture(root, num_samples):
+    batches_path = os.path.join(root, "cifar-10-batches-py")
+    os.makedirs(batches_path, exist_ok=True)
+    rng = np.random.RandomState(0)
+    for name in ["data_batch_%d" % i for i in range(1, 6)] + ["test_batch"]:
+        entry = {"data": rng.randint(256, size=(num_samples, 3072), dtype=np.uint8),
+                 "labels": rng.randint(10, size=num_samples).tolist()}
+        with open(os.path.join(batches_path, name), "wb") as f:
+            pickle.dump(entry, f)
+    with open(os.path.join(batches_path, "batches.meta"), "wb") as f:
+        pickle.dump({"label_names": ["class_%d" % i for i in range(10)]}, f)
+
+
+def write_modelnet_fixture(root, num_samples, num_points=10000, categories=("airplane", "chair", "lamp", "table")):
+    rng = np.random.RandomState(0)
+    with open(os.path.join(root, "modelnet40_shape_names.txt"), "w") as f:
+        f.write("\n".join(categories) + "\n")
+    for split in ("train", "test"):
+        shape_ids = []
+        for i in range(num_samples):
+            category = categories[i % len(categories)]
+            shape_id = "%s_%04d" % (category, len(shape_ids) + 1 if split == "train" else num_samples + i + 1)
+            os.makedirs(os.path.join(root, category), exist_ok=True)
+            points = rng.randn(num_points, 6)
+            np.savetxt(os.path.join(root, category, shape_id + ".txt"), points, fmt="%.6f", delimiter=",")
+            shape_ids.append(shape_id)
+        with open(os.path.join(root, "modelnet40_%s.txt" % split), "w") as f:
+            f.write("\n".join(shape_ids) + "\n")
+
+
+def write_shapenet_fixture(root, num_samples, num_points=2500,
+                           categories=(("Airplane", "02691156"), ("Chair", "03001627"), ("Table", "04379243"))):
+    rng = np.random.RandomState(0)
+    with open(os.path.join(root, "synsetoffset2category.txt"), "w") as f:
+        f.write("\n".join("%s\t%s" % category for category in categories) + "\n")
+    os.makedirs(os.path.join(root, "train_test_split"), exist_ok=True)
+    for split in ("train", "val", "test"):
+        file_list = []
+        for i in range(num_samples):
+            _, synset = categories[i % len(categories)]
+            token = "%s_%05d" % (split, i)
+            os.makedirs(os.path.join(root, synset), exist_ok=True)
+            points = np.concatenate([rng.randn(num_points, 6), rng.randint(50, size=(num_points, 1))], 1)
+            np.savetxt(os.path.join(root, synset, token + ".txt"), points, fmt="%.6f")
+            file_list.append("shape_data/%s/%s" % (synset, token))
+        with open(os.path.join(root, "train_test_split", "shuffled_%s_file_list.json" % split), "w") as f:
+            json.dump(file_list, f)
+
+
+def write_fixture(module, root, num_samples, packed):
+    path = os.path.join(root, module)
+    if os.path.isdir(path):
+        return path
+    os.makedirs(path)
+    start = time.perf_counter()
+    {
+        "nbody": write_nbody_fixture,
+        "rotated_mnist": write_rotated_mnist_fixture,
+        "cifar10": write_cifar10_fixture,
+        "modelnet": write_modelnet_fixture,
+        "shapenet": write_shapenet_fixture,
+    }[module](path, num_samples)
+    if packed and module == "modelnet":
+        from canonical_network.prepare.modelnet_data import pack_modelnet_split
+        for split in ("train", "test"):
+            pack_modelnet_split(path, os.path.join(path, "packed"), split)
+    if packed and module == "shapenet":
+        from canonical_network.prepare.shapenet_data import pack_shapenet_split
+        for split in ("trainval", "test"):
+            pack_shapenet_split(path, os.path.join(path, "packed"), split)
+    print(f"Wrote the {module} fixture in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def evict_from_page_cache(root):
+    """ Drops the fixture files from the os page cache so the first epoch reads from disk (best effort). """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for directory, _, files in os.walk(root):
+        for name in files:
+            fd = os.open(os.path.join(directory, name), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+@contextmanager
+def skip_cifar_integrity_check():
+    # torchvision checks the md5 of the official archives, which a synthetic fixture cannot match. The batches go
+    # through CIFAR10._check_integrity, the metadata through the module level check_integrity
+    from torchvision.datasets import CIFAR10, cifar
+    check_batches, check_file = CIFAR10._check_integrity, cifar.check_integrity
+    CIFAR10._check_integrity = lambda self: True
+    cifar.check_integrity = lambda *args, **kwargs: True
+    try:
+        yield
+    finally:
+        CIFAR10._check_integrity, cifar.check_integrity = check_batches, check_file
+
+
+def build_data_module(module, data_path, num_samples, overrides, num_workers, batch_size):
+    if module == "nbody":
+        from canonical_network.prepare.nbody_data import NBodyDataModule
+        from canonical_network.train_nbody import HYPERPARAMS
+        hyperparams = Namespace(**{**HYPERPARAMS, **overrides})
+        if num_workers >= 0:
+            hyperparams.num_workers = num_workers
+        # the train loader drops its last batch, a fixture smaller than the default batch would yield none
+        hyperparams.batch_size = batch_size or min(hyperparams.batch_size, num_samples)
+        return NBodyDataModule(hyperparams, data_path=data_path)
+
+    if module in ("rotated_mnist", "cifar10"):
+        from canonical_network import train_images
+        hyperparams = train_images.get_hyperparams([])
+    else:
+        from canonical_network import train_modelnet, train_shapenet
+        hyperparams = {"modelnet": train_modelnet, "shapenet": train_shapenet}[module].get_hyperparams([])
+    for key, value in overrides.items():
+        setattr(hyperparams, key, value)
+    hyperparams.data_path = data_path
+    if num_workers >= 0:
+        hyperparams.num_workers = num_workers
+    if batch_size:
+        hyperparams.batch_size = batch_size
+    if getattr(hyperparams, "packed_data_path", "") == "fixture":
+        hyperparams.packed_data_path = os.path.join(data_path, "packed")
+
+    if module == "rotated_mnist":
+        from canonical_network.prepare.rotated_mnist_data import RotatedMNISTDataModule
+        return RotatedMNISTDataModule(hyperparams, mode=hyperparams.data_mode)
+    if module == "cifar10":
+        from canonical_network.prepare.cifar_data import CIFAR10DataModule
+        return CIFAR10DataModule(hyperparams)
+    if module == "modelnet":
+        from canonical_network.prepare.modelnet_data import ModelNetDataModule
+        return ModelNetDataModule(hyperparams)
+    from canonical_network.prepare.shapenet_data import ShapenetPartDataModule
+    return ShapenetPartDataModule(hyperparams)
+
+
+class TimedDataset(torch.utils.data.Dataset):
+    """ Adds the time spent in `__getitem__` to a counter shared with the workers. """
+    def __init__(self, dataset, busy_seconds):
+        self.dataset = dataset
+        self.busy_seconds = busy_seconds
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        item = self.dataset[index]
+        with self.busy_seconds.get_lock():
+            self.busy_seconds.value += time.perf_counter() - start
+        return item
+
+
+class TimedCollate:
+    def __init__(self, collate_fn, busy_seconds):
+        self.collate_fn = collate_fn
+        self.busy_seconds = busy_seconds
+
+    def __call__(self, batch):
+        start = time.perf_counter()
+        batch = self.collate_fn(batch)
+        with self.busy_seconds.get_lock():
+            self.busy_seconds.value += time.perf_counter() - start
+        return batch
+
+
+def instrument_loader(loader, busy_seconds):
+    """ Same loader over the same batches, with the dataset and collate function timed. """
+    return DataLoader(
+        TimedDataset(loader.dataset, busy_seconds),
+        batch_sampler=loader.batch_sampler,
+        num_workers=loader.num_workers,
+        collate_fn=TimedCollate(loader.collate_fn, busy_seconds),
+        pin_memory=loader.pin_memory,
+        timeout=loader.timeout,
+        worker_init_fn=loader.worker_init_fn,
+        multiprocessing_context=loader.multiprocessing_context,
+        persistent_workers=loader.persistent_workers,
+        prefetch_factor=loader.prefetch_factor,
+    )
+
+
+def batch_length(batch):
+    while isinstance(batch, (list, tuple)):
+        batch = batch[0]
+    return len(batch)
+
+
+def run_epoch(loader, busy_seconds, max_batches):
+    busy_seconds.value = 0.0
+    num_samples, wait_seconds, num_batches = 0, 0.0, 0
+    start = time.perf_counter()
+    iterator = iter(loader)
+    while True:
+        wait_start = time.perf_counter()
+        batch = next(iterator, None)
+        wait_seconds += time.perf_counter() - wait_start
+        if batch is None:
+            break
+        num_samples += batch_length(batch)
+        num_batches += 1
+        if num_batches == max_batches:
+            break
+    del iterator
+    epoch_seconds = time.perf_counter() - start
+    return {
+        "epoch_s": epoch_seconds,
+        "samples_per_s": num_samples / epoch_seconds,
+        "wait_ms_per_batch": wait_seconds / max(num_batches, 1) * 1e3,
+        "worker_utilisation": busy_seconds.value / (max(loader.num_workers, 1) * epoch_seconds),
+        "num_batches": num_batches,
+    }
+
+
+def profile_stages(loader, num_batches):
+    """
+    Profiles loading `num_batches` batches in this process and splits the time per sample into read (file and
+    memory map access), parse (text and pickle decoding), transform (everything else in `__getitem__`) and collate.
+    """
+    profiler = cProfile.Profile()
+    getitem_seconds, collate_seconds, num_samples = 0.0, 0.0, 0
+    for i, indices in enumerate(loader.batch_sampler):
+        if i == num_batches:
+            break
+        items = []
+        for index in indices:
+            start = time.perf_counter()
+            profiler.enable()
+            items.append(loader.dataset[index])
+            profiler.disable()
+            getitem_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        loader.collate_fn(items)
+        collate_seconds += time.perf_counter() - start
+        num_samples += len(indices)
+
+    stage_seconds = {stage: 0.0 for stage in STAGE_PATTERNS}
+    for function, (_, _, self_seconds, _, _) in pstats.Stats(profiler).stats.items():
+        name = pstats.func_std_string(function)
+        for stage, patterns in STAGE_PATTERNS.items():
+            if any(pattern in name for pattern in patterns):
+                stage_seconds[stage] += self_seconds
+                break
+    # the profiler slows everything down by about the same factor, so its shares are rescaled to the wall time
+    profiled_seconds = sum(stats[2] for stats in pstats.Stats(profiler).stats.values()) or 1.0
+    stage_seconds = {stage: seconds / profiled_seconds * getitem_seconds for stage, seconds in stage_seconds.items()}
+    stage_seconds["transform"] = max(getitem_seconds - sum(stage_seconds.values()), 0.0)
+    stage_seconds["collate"] = collate_seconds
+    total = sum(stage_seconds.values()) or 1.0
+    result = {f"{stage}_ms_per_sample": seconds / max(num_samples, 1) * 1e3 for stage, seconds in stage_seconds.items()}
+    result.update({f"{stage}_share": seconds / total for stage, seconds in stage_seconds.items()})
+    return result
+
+
+def diagnose(result):
+    stages = ["read", "parse", "transform", "collate"]
+    slowest = max(stages, key=lambda stage: result[f"{stage}_share"])
+    notes = [f"{slowest} dominates the sample time ({result[slowest + '_share']:.0%})"]
+    if result["worker_utilisation"] > 0.85:
+        notes.append("workers are saturated, more workers or a cheaper pipeline would raise throughput")
+    elif result["worker_utilisation"] < 0.3 and result["num_workers"] > 1:
+        notes.append("workers are mostly idle, fewer workers would do")
+    if result["cold_warm_ratio"] > 1.5:
+        notes.append("the first epoch is much slower, caching (or persistent workers for the local cache) pays off")
+    if slowest in ("read", "parse"):
+        notes.append("a packed store (prepare/*_data.py main) removes per-file reads and text parsing")
+    return "; ".join(notes)
+
+
+def benchmark_data_module(name, module, fixture_root, num_samples, packed, overrides, num_workers, batch_size,
+                          num_epochs, max_batches, profile_batches):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    data_path = write_fixture(module, fixture_root, num_samples, packed)
+    with skip_cifar_integrity_check():
+        evict_from_page_cache(data_path)
+        data_module = build_data_module(module, data_path, num_samples, overrides, num_workers, batch_size)
+        data_module.setup("fit")
+        if len(data_module.train_dataloader()) == 0:
+            raise ValueError(f"The train loader yields no batches for {num_samples} samples, lower --batch_size")
+        stages = profile_stages(data_module.train_dataloader(), profile_batches)
+
+        evict_from_page_cache(data_path)
+        data_module = build_data_module(module, data_path, num_samples, overrides, num_workers, batch_size)
+        data_module.setup("fit")
+        loader = data_module.train_dataloader()
+        busy_seconds = mp.Value("d", 0.0)
+        timed_loader = instrument_loader(loader, busy_seconds)
+        epochs = [run_epoch(timed_loader, busy_seconds, max_batches) for _ in range(num_epochs)]
+
+    warm_epochs = epochs[1:] or epochs
+    result = {
+        "name": name, "module": module, "num_workers": loader.num_workers, "batch_size": loader.batch_size,
+        "overrides": overrides, "epochs": epochs,
+        "first_epoch_s": epochs[0]["epoch_s"],
+        "warm_epoch_s": float(np.mean([epoch["epoch_s"] for epoch in warm_epochs])),
+        "warm_samples_per_s": float(np.mean([epoch["samples_per_s"] for epoch in warm_epochs])),
+        "wait_ms_per_batch": float(np.mean([epoch["wait_ms_per_batch"] for epoch in warm_epochs])),
+        "worker_utilisation": float(np.mean([epoch["worker_utilisation"] for epoch in warm_epochs])),
+        **stages,
+    }
+    result["cold_warm_ratio"] = result["first_epoch_s"] / result["warm_epoch_s"]
+    result["diagnosis"] = diagnose(result)
+    return result
+
+
+def main():
+    hyperparams = get_hyperparams()
+    overrides = json.loads(hyperparams.overrides)
+    fixture_root = hyperparams.fixture_path or tempfile.mkdtemp(prefix="canonical_network_fixtures_")
+    cases = []
+    for module in hyperparams.modules.split(","):
+        variants = [("", overrides)]
+        if hyperparams.packed and module in ("modelnet", "shapenet"):
+            variants.append(("/packed", {**overrides, "packed_data_path": "fixture"}))
+        for suffix, module_overrides in variants:
+            cases.append((module + suffix, module, fixture_root, hyperparams.num_samples, hyperparams.packed,
+                          module_overrides, hyperparams.num_workers, hyperparams.batch_size, hyperparams.num_epochs,
+                          hyperparams.max_batches, hyperparams.profile_batches))
+    try:
+        results = run_cases(benchmark_data_module, cases, hyperparams.isolate)
+    finally:
+        if not hyperparams.fixture_path:
+            shutil.rmtree(fixture_root, ignore_errors=True)
+    for result in results:
+        if "diagnosis" in result:
+            print(f"{result['name']}: {result['diagnosis']}")
+    save_results(results, environment_info(torch.device("cpu")), "data", hyperparams.output_path)
+    failures = []
+    failed = failed_cases(results)
+    if failed:
+        failures.append(f"{len(failed)} cases failed ({', '.join(failed)})")
+    if hyperparams.baseline:
+        regressions = compare_to_baseline(results, hyperparams.baseline, hyperparams.tolerance)
+        if regressions:
+            failures.append(f"{len(regressions)} metrics regressed beyond {hyperparams.tolerance:.0%}")
+    if failures:
+        sys.exit(", ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+from canonical_network.benchmarks.common import environment_info, run_cases, save_results, compare_to_baseline, \
+    failed_cases
+
+# module -> what importing it may load: "torch" for the plain networks and helpers, "lightning" for the
+# LightningModules (Lightning itself imports torchvision, torchmetrics and wandb)
+MODULES = {
+    "canonical_network.utils": "torch",
+    "canonical_network.models.vn_layers": "torch",
+    "canonical_network.models.gcl": "torch",
+    "canonical_network.models.equivariant_layers": "torch",
+    "canonical_network.models.pointcloud_networks": "torch",
+    "canonical_network.models.image_networks": "torch",
+    "canonical_network.models.pointcloud_classification_models": "lightning",
+    "canonical_network.models.pointcloud_partseg_models": "lightning",
+    "canonical_network.models.image_model": "lightning",
+    "canonical_network.models.euclideangraph_model": "lightning",
+    "canonical_network.models.set_model": "lightning",
+}
+
+# optional or slow dependencies the package imports on first use, never when a module is loaded
+LAZY_DEPENDENCIES = ("kornia", "scipy", "torch_scatter", "pytorch3d")
+LIGHTNING_DEPENDENCIES = ("pytorch_lightning", "lightning_fabric", "torchvision", "torchmetrics", "wandb")
+
+
+def get_hyperparams():
+    parser = ArgumentParser(description="Import time of the package modules in fresh interpreters (python -X "
+                                        "importtime), the dependencies each one loads, and a check that the optional "
+                                        "ones are only imported on first use.")
+    parser.add_argument("--modules", type=str, default=",".join(MODULES), help="comma separated modules")
+    parser.add_argument("--num_runs", type=int, default=3, help="fresh interpreters per module, the median is reported")
+    parser.add_argument("--top_n", type=int, default=5, help="slowest top-level packages reported per module")
+    parser.add_argument("--strict", type=int, default=1,
+                        help="exit with an error when a module loads a dependency it should import lazily")
+    parser.add_argument("--output_path", type=str, default="canonical_network/results/benchmarks",
+                        help="directory for the json results")
+    parser.add_argument("--baseline", type=str, default="", help="results json to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown reported as a regression")
+    return parser.parse_args()
+
+
+def parse_importtime(stderr):
+    """ (self seconds, cumulative seconds, module) of every import recorded by `python -X importtime`. """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((int(self_us) / 1e6, int(cumulative_us) / 1e6, name.strip()))
+    return imports
+
+
+def time_import(module):
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True)
+    startup_s = time.perf_counter() - start
+    if process.returncode != 0:
+        errors = [line for line in process.stderr.strip().splitlines() if not line.startswith("import time:")]
+        raise ImportError(errors[-1] if errors else f"exit code {process.returncode}")
+    return startup_s, parse_importtime(process.stderr)
+
+
+def benchmark_import(name, module, kind, num_runs, top_n):
+    runs = [time_import(module) for _ in range(num_runs)]
+    startup_s = [startup for startup, _ in runs]
+    import_s = [max(cumulative for _, cumulative, imported in imports if imported == module) for _, imports in runs]
+    own_s = [sum(self_s for self_s, _, imported in imports if imported.startswith("canonical_network"))
+             for _, imports in runs]
+
+    # the run with the median import time is broken down by top-level package
+    _, imports = runs[int(np.argsort(import_s)[len(import_s) // 2])]
+    packages = defaultdict(float)
+    for self_s, _, imported in imports:
+        packages[imported.split(".")[0]] += self_s
+    forbidden = LAZY_DEPENDENCIES + (LIGHTNING_DEPENDENCIES if kind == "torch" else ())
+    return {
+        "name": name,
+        "startup_s": float(np.median(startup_s)),
+        "import_s": float(np.median(import_s)),
+        "own_import_s": float(np.median(own_s)),
+        "top_packages": {package: round(seconds, 4) for package, seconds in
+                         sorted(packages.items(), key=lambda item: -item[1])[:top_n]},
+        "eager_dependencies": sorted(package for package in packages if package in forbidden),
+    }
+
+
+def main():
+    hyperparams = get_hyperparams()
+    cases = [(module, module, MODULES.get(module, "lightning"), hyperparams.num_runs, hyperparams.top_n)
+             for module in hyperparams.modules.split(",")]
+    results = run_cases(benchmark_import, cases, isolate=False)
+    eager = [(result["name"], result["eager_dependencies"]) for result in results if result.get("eager_dependencies")]
+    for name, packages in eager:
+        print(f"{name} imports {', '.join(packages)} at load time")
+    save_results(results, environment_info(torch.device("cpu")), "imports", hyperparams.output_path)
+    failures = []
+    failed = failed_cases(results)
+    if failed:
+        failures.append(f"{len(failed)} modules failed to import ({', '.join(failed)})")
+    if hyperparams.strict and eager:
+        failures.append(f"{len(eager)} modules import optional dependencies eagerly")
+    if hyperparams.baseline:
+        regressions = compare_to_baseline(results, hyperparams.baseline, hyperparams.tolerance)
+        if regressions:
+            failures.append(f"{len(regressions)} metrics regressed beyond {hyperparams.tolerance:.0%}")
+    if failures:
+        sys.exit(", ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
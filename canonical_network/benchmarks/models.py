@@ -0,0 +1,131 @@
+import re
+import sys
+from argparse import ArgumentParser
+
+import torch
+
+from canonical_network.benchmarks.common import environment_info, latency_stats, peak_memory_bytes, \
+    reset_peak_memory, time_fn, run_cases, save_results, compare_to_baseline, failed_cases
+
+# (family, models, configs) per group, every config is benchmarked with every model of its group. Batch sizes
+# follow the training scripts, inputs are synthetic so nothing needs downloading. Left out because they fail in the
+# models themselves: the nbody Transformer (PositionalEncoding gets the embedded coordinates instead of the raw
+# ones) and the modelnet vn_pointnet (VNPointnet builds PointNetEncoder with arguments it does not take).
+# canonized_pca and equivariant_optimization assume 28x28 grayscale images, so they only run on rotated_mnist.
+PRESETS = {
+    "full": [
+        ("nbody", ["EGNN", "GNN", "vndeepsets", "euclideangraph_model"], [{"batch_size": 100}]),
+        ("modelnet", ["pointnet", "DGCNN", "equivariant_pointcloud_model"],
+         [{"batch_size": 32, "num_points": 1024}, {"batch_size": 8, "num_points": 4096},
+          {"batch_size": 2, "num_points": 16384}]),
+        ("image", ["equivariant", "canonized_pca", "equivariant_optimization"],
+         [{"batch_size": 128, "dataset": "rotated_mnist"}]),
+        ("image", ["equivariant"], [{"batch_size": 128, "dataset": "cifar10"}]),
+    ],
+    "quick": [
+        ("nbody", ["EGNN", "GNN", "vndeepsets", "euclideangraph_model"], [{"batch_size": 8}]),
+        ("modelnet", ["pointnet", "DGCNN", "equivariant_pointcloud_model"], [{"batch_size": 2, "num_points": 1024}]),
+        ("image", ["equivariant", "canonized_pca", "equivariant_optimization"],
+         [{"batch_size": 16, "dataset": "rotated_mnist"}]),
+        ("image", ["equivariant"], [{"batch_size": 16, "dataset": "cifar10"}]),
+    ],
+}
+
+
+def get_hyperparams():
+    parser = ArgumentParser(description="Forward and forward+backward throughput, latency percentiles and peak "
+                                        "memory of every model family on synthetic inputs.")
+    parser.add_argument("--preset", type=str, default="full", help="benchmark shapes 1)full 2)quick")
+    parser.add_argument("--cases", type=str, default="", help="regex on the case names to run [default: all]")
+    parser.add_argument("--device", type=str, default="auto", help="device 1)auto 2)cpu 3)cuda")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed runs before timing")
+    parser.add_argument("--num_runs", type=int, default=20, help="timed runs per measurement")
+    parser.add_argument("--isolate", type=int, default=1,
+                        help="run every case in a fresh process, needed for per-case peak memory on cpu")
+    parser.add_argument("--output_path", type=str, default="canonical_network/results/benchmarks",
+                        help="directory for the json results")
+    parser.add_argument("--baseline", type=str, default="", help="results json to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slowdown (or memory growth) against the baseline reported as a regression")
+    return parser.parse_args()
+
+
+def get_cases(preset, pattern, device):
+    cases = []
+    for family, models, configs in PRESETS[preset]:
+        for config in configs:
+            for model in models:
+                name = "/".join([family, model] + [f"{key}={value}" for key, value in config.items()])
+                if re.search(pattern, name):
+                    cases.append((name, family, model, config, device))
+    return cases
+
+
+def get_spec(family, model_name, config):
+    from canonical_network import export
+    config = dict(config)
+    if family == "modelnet":
+        return export.modelnet_family(config, model_name, config.pop("num_points"))
+    return {
+        "nbody": lambda: export.nbody_family(config, model_name),
+        "image": lambda: export.image_family(config, model_name),
+    }[family]()
+
+
+def benchmark_model(name, family, model_name, config, device, warmup=3, num_runs=20):
+    torch.manual_seed(0)
+    device = torch.device(device)
+    from canonical_network.export import ExportWrapper
+    spec = get_spec(family, model_name, {**config, "device": str(device)})
+    model = ExportWrapper(spec).to(device)
+    batch_size = config["batch_size"]
+    inputs = [tensor.to(device) for tensor in spec.make_inputs(batch_size)]
+
+    def forward():
+        with torch.no_grad():
+            model(*inputs)
+
+    def forward_backward():
+        outputs = model(*inputs)
+        loss = sum(output.float().mean() for output in outputs if output.is_floating_point() and output.requires_grad)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    result = {
+        "name": name, "family": family, "model": model_name, **config,
+        "num_parameters": sum(parameter.numel() for parameter in model.parameters()),
+    }
+    model.eval()
+    result.update({"forward_" + key: value
+                   for key, value in latency_stats(time_fn(forward, device, warmup, num_runs), batch_size).items()})
+    model.train()
+    reset_peak_memory(device)
+    result.update({"train_" + key: value
+                   for key, value in latency_stats(time_fn(forward_backward, device, warmup, num_runs),
+                                                   batch_size).items()})
+    result["peak_memory_mb"] = peak_memory_bytes(device) / 2**20
+    return result
+
+
+def main():
+    hyperparams = get_hyperparams()
+    device = hyperparams.device if hyperparams.device != "auto" else ("cuda" if torch.cuda.is_available() else "cpu")
+    cases = [case + (hyperparams.warmup, hyperparams.num_runs)
+             for case in get_cases(hyperparams.preset, hyperparams.cases, device)]
+    results = run_cases(benchmark_model, cases, hyperparams.isolate)
+    save_results(results, environment_info(torch.device(device)), f"models_{hyperparams.preset}",
+                 hyperparams.output_path)
+    failures = []
+    failed = failed_cases(results)
+    if failed:
+        failures.append(f"{len(failed)} cases failed ({', '.join(failed)})")
+    if hyperparams.baseline:
+        regressions = compare_to_baseline(results, hyperparams.baseline, hyperparams.tolerance)
+        if regressions:
+            failures.append(f"{len(regressions)} metrics regressed beyond {hyperparams.tolerance:.0%}")
+    if failures:
+        sys.exit(", ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
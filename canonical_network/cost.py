@@ -0,0 +1,116 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+
+class CostMeter:
+    """
+    Always-on cost accounting of the canonicalization and prediction halves of a canonicalized model. The model
+    wraps each half in `measure(part)`; every call records the wall time (cuda events on gpu), the bytes of
+    activations saved for backward, and every `flops_every` calls the forward FLOPs (those calls are left out of the
+    timings since the FLOP counter slows them down). `metrics(stage)` averages the timings and activations recorded
+    since its last call and reports the latest FLOP counts. When disabled `measure` returns a shared no-op context.
+    """
+    def __init__(self, enabled=False, flops_every=100):
+        self.enabled = bool(enabled)
+        self.flops_every = flops_every
+        self.calls = defaultdict(int)
+        self.flops = {}
+        self._parameters = {}
+        self.reset()
+
+    def reset(self):
+        self.timings = defaultdict(list)
+        self.activation_bytes = defaultdict(list)
+
+    def measure(self, part, *modules):
+        """
+        Context measuring `part`. `modules` are the networks of that half: their parameters saved for backward are
+        not counted as activations and their device decides between cuda events and the host clock.
+        """
+        if not self.enabled:
+            return _NO_MEASUREMENT
+        return self._measure(part, modules)
+
+    def _parameter_storages(self, modules):
+        """
+        The parameters of `modules` and the set of their storage pointers, cached per module set and rebuilt only
+        when the parameters are moved to new storage (e.g. by `.to(device)`).
+        """
+        key = tuple(id(module) for module in modules)
+        cached = self._parameters.get(key)
+        if cached is not None:
+            parameters, storages = cached
+            if not parameters or parameters[0].untyped_storage().data_ptr() in storages:
+                return cached
+        parameters = [parameter for module in modules for parameter in module.parameters()]
+        self._parameters[key] = parameters, {parameter.untyped_storage().data_ptr() for parameter in parameters}
+        return self._parameters[key]
+
+    @contextmanager
+    def _measure(self, part, modules):
+        count_flops = self.flops_every > 0 and self.calls[part] % self.flops_every == 0
+        self.calls[part] += 1
+        parameters, parameter_storages = self._parameter_storages(modules)
+        on_cuda = len(parameters) > 0 and parameters[0].is_cuda
+        saved_storages = {}
+
+        def pack(tensor):
+            storage = tensor.untyped_storage()
+            if storage.data_ptr() not in parameter_storages:
+                saved_storages[storage.data_ptr()] = storage.nbytes()
+            return tensor
+
+        saved_tensors = torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor) \
+            if torch.is_grad_enabled() else nullcontext()
+        flop_counter = FlopCounterMode(display=False) if count_flops else nullcontext()
+        with saved_tensors, flop_counter:
+            if count_flops:
+                yield
+            elif on_cuda:
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                # read lazily in metrics(), so measuring does not synchronise the step
+                self.timings[part].append((start, end))
+            else:
+                start = time.perf_counter()
+                yield
+                self.timings[part].append((time.perf_counter() - start) * 1e3)
+        if count_flops:
+            self.flops[part] = flop_counter.get_total_flops()
+        if torch.is_grad_enabled():
+            self.activation_bytes[part].append(sum(saved_storages.values()))
+
+    def metrics(self, stage):
+        """ Per-call averages of the calls since the last `metrics`, keyed `<stage>/cost/<part>_<metric>`. """
+        if not self.enabled:
+            return {}
+        metrics = {}
+        for part, timings in self.timings.items():
+            timings = [_elapsed_ms(timing) for timing in timings]
+            metrics[f"{stage}/cost/{part}_ms"] = sum(timings) / len(timings)
+        for part, activation_bytes in self.activation_bytes.items():
+            metrics[f"{stage}/cost/{part}_activation_mb"] = sum(activation_bytes) / len(activation_bytes) / 2**20
+        for part, flops in self.flops.items():
+            metrics[f"{stage}/cost/{part}_gflops"] = flops / 1e9
+        canon_ms, pred_ms = metrics.get(f"{stage}/cost/canon_ms"), metrics.get(f"{stage}/cost/pred_ms")
+        if canon_ms is not None and pred_ms is not None and canon_ms + pred_ms > 0:
+            metrics[f"{stage}/cost/canon_time_share"] = canon_ms / (canon_ms + pred_ms)
+        self.reset()
+        return metrics
+
+
+def _elapsed_ms(timing):
+    if isinstance(timing, tuple):
+        start, end = timing
+        end.synchronize()
+        return start.elapsed_time(end)
+    return timing
+
+
+_NO_MEASUREMENT = nullcontext()
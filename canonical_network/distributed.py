@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from pytorch_lightning.strategies import DDPSpawnStrategy, DDPStrategy
+from pytorch_lightning.utilities.rank_zero import rank_zero_only
+
+# ddp_spawn is left out, the models keep the wandb config as hyperparameters and it cannot be pickled
+STRATEGIES = ("ddp", "ddp_fork")
+
+
+def is_distributed(hyperparams):
+    return hyperparams.num_processes > 1 or hyperparams.num_nodes > 1
+
+
+def is_global_zero():
+    """
+    True in a single process and in the rank 0 process of distributed training, already before the Trainer exists:
+    the ddp launcher starts the other local ranks of the script with LOCAL_RANK set, and the other nodes are started
+    with NODE_RANK set.
+    """
+    return rank_zero_only.rank == 0 and int(os.environ.get("NODE_RANK", 0)) == 0
+
+
+class ThreadsPerProcessCallback(pl.Callback):
+    """
+    Limits the torch cpu threads of every rank to its share of the cores, otherwise each of the processes on a node
+    starts one thread per core and they oversubscribe the machine.
+    """
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+
+    def setup(self, trainer, pl_module, stage=None):
+        torch.set_num_threads(self.num_threads)
+
+
+def get_trainer_kwargs(hyperparams):
+    """
+    The accelerator, devices and strategy arguments of `pl.Trainer` for the --num_processes/--num_nodes/--strategy
+    arguments of the training scripts. A single process keeps the previous `accelerator="auto"` setup. Distributed
+    runs use DDP over gloo on cpu (nccl on gpu), with the data modules choosing their own distributed samplers.
+    """
+    if not is_distributed(hyperparams):
+        return {"accelerator": "auto"}
+    if hyperparams.strategy not in STRATEGIES:
+        raise ValueError(f"Unknown strategy {hyperparams.strategy}, use one of {', '.join(STRATEGIES)}")
+    strategy_kwargs = {
+        "process_group_backend": "nccl" if torch.cuda.is_available() else "gloo",
+        "find_unused_parameters": bool(hyperparams.find_unused_parameters),
+    }
+    if hyperparams.strategy == "ddp":
+        strategy = DDPStrategy(**strategy_kwargs)
+    else:
+        strategy = DDPSpawnStrategy(start_method="fork", **strategy_kwargs)
+    return {
+        "accelerator": "auto",
+        "devices": hyperparams.num_processes,
+        "num_nodes": hyperparams.num_nodes,
+        "strategy": strategy,
+        # the data modules shard with utils.get_sampler, so evaluation is not padded and the bucket batches stay
+        "replace_sampler_ddp": False,
+    }
+
+
+def get_distributed_callbacks(hyperparams):
+    if not is_distributed(hyperparams) or torch.cuda.is_available():
+        return []
+    num_threads = hyperparams.threads_per_process or max(len(os.sched_getaffinity(0)) // hyperparams.num_processes, 1)
+    return [ThreadsPerProcessCallback(num_threads)]
+
+
+def reduce_sum(pl_module, values):
+    """
+    Sums the numbers in `values` (a scalar, list or array) over the ranks and returns them as a float64 array, so
+    metrics accumulated in python by every rank over its shard become the metrics of the whole split.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if pl_module.trainer.world_size == 1:
+        return values
+    tensor = torch.from_numpy(values).to(pl_module.device)
+    return pl_module.trainer.strategy.reduce(tensor, reduce_op="sum").cpu().numpy()
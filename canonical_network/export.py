@@ -0,0 +1,393 @@
+import json
+import os
+import time
+from argparse import ArgumentParser
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+import torch.nn as nn
+
+from canonical_network.utils import dict_to_object
+
+# `model`: the network to export, `forward(model, *inputs)`: call of the network on flat tensor inputs,
+# `make_inputs(batch_size)`: example inputs, `input_names`/`dynamic_axes`: as in torch.onnx.export
+ExportSpec = namedtuple("ExportSpec", ["model", "forward", "make_inputs", "input_names", "dynamic_axes"])
+
+SET_SIZE = 10
+NBODY_NODES = 5
+
+
+def get_hyperparams():
+    parser = ArgumentParser(description="Export a trained model to ONNX and TorchScript, check numerical parity "
+                                        "against PyTorch and measure CPU latency under onnxruntime.")
+    parser.add_argument("--family", type=str, required=True,
+                        help="model family 1)set 2)nbody 3)modelnet 4)shapenet 5)image")
+    parser.add_argument("--model", type=str, default="",
+                        help="model of the family, as in the training scripts [default: the config's model]")
+    parser.add_argument("--checkpoint", type=str, default="",
+                        help="lightning checkpoint to load [default: '', export the initial weights]")
+    parser.add_argument("--config", type=str, default="",
+                        help="hyperparameters of the run, a wandb config.yaml or a json dict, merged over the defaults")
+    parser.add_argument("--output_path", type=str, default="canonical_network/results/exported_models",
+                        help="directory for the exported models and the report")
+    parser.add_argument("--formats", type=str, default="onnx,torchscript", help="comma separated export formats")
+    parser.add_argument("--opset_version", type=int, default=17, help="onnx opset version")
+    parser.add_argument("--batch_sizes", type=str, default="1,8,32",
+                        help="comma separated batch sizes to check parity and latency at, the first one is traced")
+    parser.add_argument("--num_points", type=int, default=0,
+                        help="points per cloud of the example inputs [default: 0, the config's num_points]")
+    parser.add_argument("--num_runs", type=int, default=20, help="timed runs per batch size")
+    parser.add_argument("--atol", type=float, default=1e-4, help="max absolute difference to PyTorch to pass")
+    parser.add_argument("--validate", type=int, default=1, help="check parity and latency after exporting")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the example inputs")
+    return parser.parse_args()
+
+
+def load_config(path):
+    if not path:
+        return {}
+    with open(path, "r") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+    # wandb stores every entry as {"desc": ..., "value": ...} next to its own bookkeeping keys
+    return {
+        key: value["value"] if isinstance(value, dict) and "value" in value else value
+        for key, value in config.items() if key not in ("wandb_version", "_wandb")
+    }
+
+
+def get_model_hyperparams(defaults, config, model_name):
+    hyperparams = dict(defaults)
+    hyperparams.update(config)
+    if model_name:
+        hyperparams["model"] = model_name
+    hyperparams.setdefault("device", "cpu")
+    return hyperparams
+
+
+def set_family(config, model_name):
+    from canonical_network.models.set_model import SET_HYPERPARAMS, SetModel
+    from canonical_network.models.set_base_models import DeepSets, Transformer
+
+    hyperparams = get_model_hyperparams({"model": "set_model", **SET_HYPERPARAMS}, config, model_name)
+    hyperparams = dict_to_object(hyperparams)
+    model = {
+        "set_model": lambda: SetModel(hyperparams),
+        "deepsets": lambda: DeepSets(hyperparams),
+        "transformer": lambda: Transformer(hyperparams),
+    }[hyperparams.model]()
+
+    if hyperparams.model == "transformer":
+        # in eval the encoder packs the unpadded elements into a nested tensor, which leaves zeros at the padded
+        # positions, the tracers never take that path and compute them
+        model.transformer_encoder.enable_nested_tensor = False
+        model.transformer_encoder.use_nested_tensor = False
+
+        def make_inputs(batch_size):
+            x = torch.randint(hyperparams.num_embeddings, (batch_size, SET_SIZE))
+            mask = torch.arange(SET_SIZE).unsqueeze(0) >= torch.randint(1, SET_SIZE + 1, (batch_size, 1))
+            return x, mask
+        return ExportSpec(model, lambda model, x, mask: model(x, mask, 0), make_inputs, ["x", "mask"],
+                          {"x": {0: "batch", 1: "set_size"}, "mask": {0: "batch", 1: "set_size"}})
+
+    def make_inputs(batch_size):
+        x = torch.randint(hyperparams.num_embeddings, (batch_size * SET_SIZE,))
+        set_indices = torch.arange(batch_size).repeat_interleave(SET_SIZE)
+        return x, set_indices
+    return ExportSpec(model, lambda model, x, set_indices: model(x, set_indices, 0), make_inputs,
+                      ["x", "set_indices"], {"x": {0: "num_elements"}, "set_indices": {0: "num_elements"}})
+
+
+def nbody_family(config, model_name):
+    from canonical_network.train_nbody import HYPERPARAMS
+    from canonical_network.models.euclideangraph_model import NBODY_HYPERPARAMS, EuclideanGraphModel
+    from canonical_network.models.euclideangraph_base_models import EGNN_vel, GNN, VNDeepSets
+
+    hyperparams = get_model_hyperparams(HYPERPARAMS | NBODY_HYPERPARAMS, config, model_name)
+    hyperparams = dict_to_object(hyperparams)
+    if hyperparams.model == "Transformer":
+        raise NotImplementedError("The nbody Transformer fails in the model itself, its PositionalEncoding gets the "
+                                  "embedded coordinates instead of the raw ones, pass e.g. --model EGNN")
+    model = {
+        "euclideangraph_model": lambda: EuclideanGraphModel(hyperparams),
+        "EGNN": lambda: EGNN_vel(hyperparams),
+        "GNN": lambda: GNN(hyperparams),
+        "vndeepsets": lambda: VNDeepSets(hyperparams),
+    }[hyperparams.model]()
+
+    def make_inputs(batch_size):
+        loc, vel = torch.randn(batch_size * NBODY_NODES, 3), torch.randn(batch_size * NBODY_NODES, 3)
+        charges = torch.randint(2, (batch_size * NBODY_NODES, 1)).float() * 2 - 1
+        rows, cols = model.get_edges(batch_size, NBODY_NODES)
+        nodes = torch.sqrt(torch.sum(vel ** 2, dim=1)).unsqueeze(1)
+        loc_dist = torch.sum((loc[rows] - loc[cols]) ** 2, 1).unsqueeze(1)
+        edge_attr = torch.cat([charges[rows] * charges[cols], loc_dist], 1)
+        return nodes, loc, rows, cols, vel, edge_attr, charges
+
+    def forward(model, nodes, loc, rows, cols, vel, edge_attr, charges):
+        return model(nodes, loc, [rows, cols], vel, edge_attr, charges)
+
+    node_axes, edge_axes = {0: "num_nodes"}, {0: "num_edges"}
+    return ExportSpec(model, forward, make_inputs, ["nodes", "loc", "rows", "cols", "vel", "edge_attr", "charges"],
+                      {"nodes": node_axes, "loc": node_axes, "rows": edge_axes, "cols": edge_axes, "vel": node_axes,
+                       "edge_attr": edge_axes, "charges": node_axes})
+
+
+def pointcloud_hyperparams(train_script, config, model_name, num_points):
+    hyperparams = get_model_hyperparams(vars(train_script.get_hyperparams([])), config, model_name)
+    # the kd-tree runs in scipy and cannot be traced
+    hyperparams["knn_backend"] = "dense"
+    if num_points:
+        hyperparams["num_points"] = num_points
+    return dict_to_object(hyperparams)
+
+
+def modelnet_family(config, model_name, num_points):
+    from canonical_network import train_modelnet
+    from canonical_network.models.pointcloud_classification_models import Pointnet, DGCNN, \
+        EquivariantPointcloudModel, VNPointnet
+
+    hyperparams = pointcloud_hyperparams(train_modelnet, config, model_name, num_points)
+    model = {
+        "equivariant_pointcloud_model": lambda: EquivariantPointcloudModel(hyperparams),
+        "pointnet": lambda: Pointnet(hyperparams),
+        "vn_pointnet": lambda: VNPointnet(hyperparams),
+        "DGCNN": lambda: DGCNN(hyperparams),
+    }[hyperparams.model]()
+    channels = 6 if hyperparams.normal_channel else 3
+
+    def make_inputs(batch_size):
+        return (torch.randn(batch_size, channels, hyperparams.num_points),)
+    return ExportSpec(model, lambda model, points: model(points), make_inputs, ["points"],
+                      {"points": {0: "batch", 2: "num_points"}})
+
+
+def shapenet_family(config, model_name, num_points):
+    from canonical_network import train_shapenet
+    from canonical_network.models.pointcloud_partseg_models import Pointnet, DGCNN, EquivariantPointcloudModel, \
+        VNPointnet
+
+    hyperparams = pointcloud_hyperparams(train_shapenet, config, model_name, num_points)
+    model = {
+        "equivariant_pointcloud_model": lambda: EquivariantPointcloudModel(hyperparams),
+        "pointnet": lambda: Pointnet(hyperparams),
+        "vn_pointnet": lambda: VNPointnet(hyperparams),
+        "DGCNN": lambda: DGCNN(hyperparams),
+    }[hyperparams.model]()
+    channels = 6 if hyperparams.normal_channel else 3
+
+    def make_inputs(batch_size):
+        points = torch.randn(batch_size, channels, hyperparams.num_points)
+        label = torch.eye(hyperparams.num_classes)[torch.randint(hyperparams.num_classes, (batch_size, 1))]
+        return points, label
+    return ExportSpec(model, lambda model, points, label: model(points, label), make_inputs, ["points", "label"],
+                      {"points": {0: "batch", 2: "num_points"}, "label": {0: "batch"}})
+
+
+def image_family(config, model_name):
+    from canonical_network import train_images
+    from canonical_network.models.image_model import LitClassifier
+
+    hyperparams = get_model_hyperparams(vars(train_images.get_hyperparams([])), config, model_name)
+    # the optimization canonization finds the rotation from the point set of the image, so it only takes mixed batches
+    if hyperparams["model"] == "equivariant_optimization":
+        hyperparams["data_mode"] = "mixed"
+    hyperparams = dict_to_object(hyperparams)
+    if hyperparams.data_mode not in ("image", "mixed"):
+        raise NotImplementedError(f"Export of data mode {hyperparams.data_mode} is not supported")
+    if hyperparams.data_mode == "mixed" and hyperparams.dataset != "rotated_mnist":
+        raise NotImplementedError("The mixed data mode only exists for rotated_mnist")
+    model = LitClassifier(hyperparams)
+
+    # the logits of the network, LitClassifier.forward returns the argmax
+    if hyperparams.data_mode == "image":
+        def make_inputs(batch_size):
+            return (torch.rand(batch_size, *model.im_shape),)
+        return ExportSpec(model, lambda model, images: model.network(model.prepare_images(images)), make_inputs,
+                          ["images"], {"images": {0: "batch"}})
+
+    from canonical_network.prepare.rotated_mnist_data import image_to_set
+
+    def make_inputs(batch_size):
+        # the (x, y, pixel) grid the mixed dataset pairs with every image
+        images = torch.rand(batch_size, *model.im_shape)
+        return images, torch.stack([image_to_set(image) for image in images])
+    return ExportSpec(model, lambda model, images, points: model.network(model.prepare_images(images), points),
+                      make_inputs, ["images", "points"], {"images": {0: "batch"}, "points": {0: "batch"}})
+
+
+def get_export_spec(hyperparams, config):
+    return {
+        "set": lambda: set_family(config, hyperparams.model),
+        "nbody": lambda: nbody_family(config, hyperparams.model),
+        "modelnet": lambda: modelnet_family(config, hyperparams.model, hyperparams.num_points),
+        "shapenet": lambda: shapenet_family(config, hyperparams.model, hyperparams.num_points),
+        "image": lambda: image_family(config, hyperparams.model),
+    }[hyperparams.family]()
+
+
+def flatten_outputs(outputs):
+    if isinstance(outputs, torch.Tensor):
+        return [outputs]
+    return [tensor for output in outputs if output is not None for tensor in flatten_outputs(output)]
+
+
+class ExportWrapper(nn.Module):
+    """ Flat tensors in, flat tuple of tensors out, the interface both exporters need. """
+    def __init__(self, spec):
+        super().__init__()
+        self.model = spec.model
+        self.forward_fn = spec.forward
+
+    def forward(self, *inputs):
+        return tuple(flatten_outputs(self.forward_fn(self.model, *inputs)))
+
+
+def load_checkpoint(model, checkpoint_path):
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    model.load_state_dict(checkpoint["state_dict"])
+    print(f"Loaded {checkpoint_path} (epoch {checkpoint.get('epoch')}, step {checkpoint.get('global_step')})")
+
+
+@contextmanager
+def lightning_tracing():
+    """
+    `LightningModule.trainer` raises outside of a Trainer and the exporters probe every attribute of the modules,
+    Lightning's own `to_torchscript` flips the same switch.
+    """
+    pl.LightningModule._jit_is_scripting = True
+    try:
+        yield
+    finally:
+        pl.LightningModule._jit_is_scripting = False
+
+
+def export_onnx(wrapper, spec, inputs, num_outputs, path, opset_version):
+    output_names = [f"output_{i}" for i in range(num_outputs)]
+    dynamic_axes = dict(spec.dynamic_axes)
+    for i, name in enumerate(output_names):
+        dynamic_axes[name] = {0: f"output_{i}_dim_0"}
+    torch.onnx.export(
+        wrapper, inputs, path, input_names=spec.input_names, output_names=output_names,
+        dynamic_axes=dynamic_axes, opset_version=opset_version, do_constant_folding=True,
+    )
+
+
+def export_torchscript(wrapper, inputs, path):
+    traced = torch.jit.trace(wrapper, inputs, check_trace=False)
+    traced.save(path)
+
+
+def time_runs(run, num_runs):
+    run()
+    timings = []
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1e3
+
+
+def validate(wrapper, spec, paths, batch_sizes, num_runs, atol):
+    """ Runs every exported model on fresh inputs of each batch size, the dynamic axes are exercised too. """
+    runners = {"pytorch": lambda *inputs: [output.numpy() for output in wrapper(*inputs)]}
+    if "torchscript" in paths:
+        traced = torch.jit.load(paths["torchscript"])
+        runners["torchscript"] = lambda *inputs: [output.numpy() for output in traced(*inputs)]
+    if "onnx" in paths:
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(paths["onnx"], options, providers=["CPUExecutionProvider"])
+        runners["onnxruntime"] = lambda *inputs: session.run(
+            None, {name: tensor.numpy() for name, tensor in zip(spec.input_names, inputs)}
+        )
+
+    report = []
+    for batch_size in batch_sizes:
+        inputs = spec.make_inputs(batch_size)
+        with torch.no_grad():
+            reference = runners["pytorch"](*inputs)
+            for name, run in runners.items():
+                row = {"format": name, "batch_size": batch_size}
+                try:
+                    outputs = run(*inputs)
+                    row["max_abs_error"] = max(
+                        float(np.abs(output - expected).max()) if output.size else 0.0
+                        for output, expected in zip(outputs, reference)
+                    ) if len(outputs) == len(reference) else float("inf")
+                    row["latency_ms"] = time_runs(lambda: run(*inputs), num_runs)
+                except Exception as e:
+                    row["error"] = f"{type(e).__name__}: {e}"
+                row["passed"] = row.get("max_abs_error", float("inf")) <= atol
+                report.append(row)
+                print(f"{name:>12} batch {batch_size:>4}: " + (
+                    f"max abs error {row['max_abs_error']:.2e}, median latency {row['latency_ms']:.2f}ms"
+                    if "error" not in row else row["error"]))
+    return report
+
+
+def main():
+    hyperparams = get_hyperparams()
+    torch.manual_seed(hyperparams.seed)
+    config = load_config(hyperparams.config)
+    # the exported models run on cpu whatever the training device was
+    config.pop("device", None)
+    spec = get_export_spec(hyperparams, config)
+    if hyperparams.checkpoint:
+        load_checkpoint(spec.model, hyperparams.checkpoint)
+    else:
+        print("No checkpoint given, exporting the initial weights")
+    spec.model.eval()
+    wrapper = ExportWrapper(spec).eval()
+
+    batch_sizes = [int(batch_size) for batch_size in hyperparams.batch_sizes.split(",")]
+    formats = hyperparams.formats.split(",")
+    inputs = spec.make_inputs(batch_sizes[0])
+    with torch.no_grad():
+        num_outputs = len(wrapper(*inputs))
+
+    name = (os.path.splitext(os.path.basename(hyperparams.checkpoint))[0] if hyperparams.checkpoint
+            else f"{hyperparams.family}_{type(spec.model).__name__}")
+    os.makedirs(hyperparams.output_path, exist_ok=True)
+    exporters = {
+        "onnx": (".onnx", lambda path: export_onnx(wrapper, spec, inputs, num_outputs, path, hyperparams.opset_version)),
+        "torchscript": (".pt", lambda path: export_torchscript(wrapper, inputs, path)),
+    }
+    paths, export_errors = {}, []
+    with lightning_tracing():
+        for export_format in formats:
+            extension, export = exporters[export_format]
+            path = os.path.join(hyperparams.output_path, name + extension)
+            # e.g. the optimization canonization differentiates its energy inside forward, which neither tracer records
+            try:
+                export(path)
+            except Exception as e:
+                export_errors.append({"format": export_format, "error": f"export failed, {type(e).__name__}: {e}",
+                                      "passed": False})
+                print(f"{export_format} export failed: {type(e).__name__}: {e}")
+                continue
+            paths[export_format] = path
+            print(f"Exported {path}")
+
+    if export_errors and not hyperparams.validate:
+        raise SystemExit(f"Export to {', '.join(row['format'] for row in export_errors)} failed")
+    if hyperparams.validate:
+        torch.manual_seed(hyperparams.seed + 1)
+        report = export_errors + validate(wrapper, spec, paths, batch_sizes, hyperparams.num_runs, hyperparams.atol)
+        with open(os.path.join(hyperparams.output_path, name + "_report.json"), "w") as f:
+            json.dump({"export": vars(hyperparams), "paths": paths, "results": report}, f, indent=2)
+        if export_errors:
+            raise SystemExit(f"Export to {', '.join(row['format'] for row in export_errors)} failed, see the report")
+        if not all(row["passed"] for row in report):
+            raise SystemExit("Exported models do not match PyTorch, see the report")
+
+
+if __name__ == "__main__":
+    main()
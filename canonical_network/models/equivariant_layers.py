@@ -1,9 +1,12 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import kornia as K
 import math
 
+from canonical_network.utils import LazyModule
+
+K = LazyModule("kornia")
+
 class RotationEquivariantConvLift(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, num_rotations=4, stride=1, padding=0, bias=True,
                  device='cuda'):
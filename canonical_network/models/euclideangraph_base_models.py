@@ -4,14 +4,14 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 import pytorch_lightning as pl
-from pytorch3d.transforms import RotateAxisAngle, Rotate, random_rotations
-import torchmetrics.functional as tmf
-import wandb
-import torch_scatter as ts
 import math
 from canonical_network.models.gcl import E_GCL_vel, GCL
 from canonical_network.models.vn_layers import VNLinearLeakyReLU, VNLinear, VNLeakyReLU, VNSoftplus
-from canonical_network.models.set_base_models import SequentialMultiple
+from canonical_network.cost import CostMeter
+from canonical_network.utils import LazyModule, SequentialMultiple
+
+ts = LazyModule("torch_scatter")
+wandb = LazyModule("wandb")
 
 
 # This model is the parent of all the following models in this file.
@@ -21,6 +21,8 @@ class BaseEuclideangraphModel(pl.LightningModule):
         self.learning_rate = hyperparams.learning_rate if hasattr(hyperparams, "learning_rate") else None
         self.weight_decay = hyperparams.weight_decay if hasattr(hyperparams, "weight_decay") else 0.0
         self.patience = hyperparams.patience if hasattr(hyperparams, "patience") else 100
+        # timings, FLOPs and activation memory of the canonicalization and prediction halves
+        self.cost_meter = CostMeter(hyperparams.cost_accounting if hasattr(hyperparams, "cost_accounting") else 0)
         # Each input has 5 particles. This list defines all the edges, since our graph is fully connected.
         # vertex at self.edges[0][i] has an edge connecting to self.edges[1][i]
         self.edges = [
@@ -30,15 +32,6 @@ class BaseEuclideangraphModel(pl.LightningModule):
 
         self.loss = nn.MSELoss()
 
-        self.dummy_nodes = torch.zeros(2, 1, device=self.device, dtype=torch.float)
-        self.dummy_loc = torch.zeros(2, 3, device=self.device, dtype=torch.float)
-        self.dummy_edges = [
-            torch.zeros(40, device=self.device, dtype=torch.long),
-            torch.zeros(40, device=self.device, dtype=torch.long),
-        ]
-        self.dummy_vel = torch.zeros(2, 3, device=self.device, dtype=torch.float)
-        self.dummy_edge_attr = torch.zeros(40, 2, device=self.device, dtype=torch.float)
-
     def training_step(self, batch, batch_idx):
         """
         Performs one training step.
@@ -68,7 +61,7 @@ class BaseEuclideangraphModel(pl.LightningModule):
         # outputs and loc_end are both (5*batch_size)x3
         loss = self.loss(outputs, loc_end)
 
-        metrics = {"train/loss": loss}
+        metrics = {"train/loss": loss, **self.cost_meter.metrics("train")}
         self.log_dict(metrics, on_epoch=True)
 
         return loss
@@ -104,7 +97,9 @@ class BaseEuclideangraphModel(pl.LightningModule):
             wandb.define_metric("valid/loss", summary="min")
 
         metrics = {"valid/loss": loss}
-        self.log_dict(metrics, on_epoch=True)
+        # averaged over the ranks, the plateau scheduler and early stopping of every rank see the same loss
+        self.log_dict(metrics, on_epoch=True, sync_dist=True)
+        self.log_dict(self.cost_meter.metrics("valid"), on_epoch=True)
 
         return loss
 
@@ -119,22 +114,6 @@ class BaseEuclideangraphModel(pl.LightningModule):
         scheduler = self.lr_schedulers()
         self.log("lr", scheduler.optimizer.param_groups[0]["lr"])
 
-        # if self.current_epoch == 0:
-        #     model_filename = f"canonical_network/results/nbody/onnx_models/{self.model}_{wandb.run.name}_{str(self.global_step)}.onnx"
-        #     torch.onnx.export(
-        #         self,
-        #         (
-        #             self.dummy_nodes.to(self.device),
-        #             self.dummy_loc.to(self.device),
-        #             [edges.to(self.device) for edges in self.dummy_edges],
-        #             self.dummy_vel.to(self.device),
-        #             self.dummy_edge_attr.to(self.device),
-        #         ),
-        #         model_filename,
-        #         opset_version=12,
-        #     )
-        #     wandb.save(model_filename)
-
     def get_edges(self, batch_size, n_nodes):
         """
         Returns a length 2 list of vertices, where edges[0][i] is adjacent to edges[1][i]
@@ -324,9 +303,6 @@ class VNDeepSets(BaseEuclideangraphModel):
         )
         self.batch_size = hyperparams.batch_size
 
-        self.dummy_input = torch.zeros(1, device=self.device, dtype=torch.long)
-        self.dummy_indices = torch.zeros(1, device=self.device, dtype=torch.long)
-
     def forward(self, nodes, loc, edges, vel, edge_attr, charges):
         batch_indices = torch.arange(self.batch_size, device=self.device).reshape(-1, 1)
         batch_indices = batch_indices.repeat(1, 5).reshape(-1)
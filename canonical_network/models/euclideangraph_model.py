@@ -2,10 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import pytorch_lightning as pl
-from pytorch3d.transforms import RotateAxisAngle, Rotate, random_rotations
-from pytorch3d.transforms import RotateAxisAngle, Rotate, random_rotations
-import torchmetrics.functional as tmf
-import wandb
 
 from canonical_network.models.vn_layers import *
 from canonical_network.models.euclideangraph_base_models import EGNN_vel, GNN, VNDeepSets, BaseEuclideangraphModel, Transformer
@@ -190,7 +186,8 @@ class EuclideanGraphModel(BaseEuclideangraphModel):
         # Shapes: (n_nodes * batch_size) x 3 x 3 and (n_nodes * batch_size) x 3
         # ie. One rotation matrix and one translation vector for each node.
         # QUESTION: IS ROTATION MATRIX THE SAME FOR ALL NODES IN A BATCH?
-        rotation_matrix, translation_vectors = self.canon_function(nodes, loc, edges, vel, edge_attr, charges)
+        with self.cost_meter.measure("canon", self.canon_function):
+            rotation_matrix, translation_vectors = self.canon_function(nodes, loc, edges, vel, edge_attr, charges)
         rotation_matrix_inverse = rotation_matrix.transpose(1, 2) # Inverse of a rotation matrix is its transpose.
 
         # Canonicalizes coordinates by rotating node coordinates and translation vectors by inverse rotation. 
@@ -206,7 +203,8 @@ class EuclideanGraphModel(BaseEuclideangraphModel):
 
         # Makes prediction on canonical inputs.
         # Shape: (n_nodes * batch_size) x coord_dim. 
-        position_prediction = self.pred_function(nodes, canonical_loc, edges, canonical_vel, edge_attr, charges)
+        with self.cost_meter.measure("pred", self.pred_function):
+            position_prediction = self.pred_function(nodes, canonical_loc, edges, canonical_vel, edge_attr, charges)
 
         # Applies rotation to predictions, following equation (10) from https://arxiv.org/pdf/2211.06489.pdf 
         # Shape: (n_nodes * batch_size) x coord_dim. 
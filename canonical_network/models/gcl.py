@@ -1,7 +1,10 @@
 from torch import nn
 import torch
 import torch.nn.functional as F
-import torch_scatter as ts
+
+from canonical_network.utils import LazyModule
+
+ts = LazyModule("torch_scatter")
 
 
 class MLP(nn.Module):
@@ -5,8 +5,11 @@ from torch.optim.lr_scheduler import OneCycleLR, MultiStepLR
 from canonical_network.models.image_networks import VanillaNetwork, EquivariantCanonizationNetwork, \
     BasicConvEncoder, Identity, PCACanonizationNetwork, RotationEquivariantConvEncoder, OptimizationCanonizationNetwork
 from canonical_network.models.resnet import resnet44
-import torchvision
-from canonical_network.utils import check_rotation_invariance, check_rotoreflection_invariance, save_images_class_wise
+from canonical_network.utils import check_rotation_invariance, check_rotoreflection_invariance, save_images_class_wise, \
+    convert_to_channels_last, check_canonization_precision_stability, LazyModule
+from canonical_network.cost import CostMeter
+
+torchvision = LazyModule("torchvision")
 
 # define the LightningModule
 class LitClassifier(pl.LightningModule):
@@ -62,7 +65,8 @@ class LitClassifier(pl.LightningModule):
         else:
             raise ValueError('base_encoder not implemented for now.')
 
-
+        # timings, FLOPs and activation memory of the canonicalization and prediction halves
+        self.cost_meter = CostMeter(hyperparams.cost_accounting)
         if hyperparams.model == 'vanilla':
             self.network = VanillaNetwork(self.encoder, self.im_shape, num_classes,
                                           hyperparams.batch_size, hyperparams.device)
@@ -76,7 +80,9 @@ class LitClassifier(pl.LightningModule):
                 hyperparams.group_type,
                 hyperparams.num_rotations,
                 hyperparams.device,
-                hyperparams.batch_size
+                hyperparams.batch_size,
+                full_precision_canonization=bool(hyperparams.canonization_full_precision),
+                cost_meter=self.cost_meter
             )
         elif hyperparams.model == 'canonized_pca':
             self.network = PCACanonizationNetwork(
@@ -85,10 +91,12 @@ class LitClassifier(pl.LightningModule):
         elif hyperparams.model == 'equivariant_optimization':
             self.network = OptimizationCanonizationNetwork(
                 self.encoder, self.im_shape, num_classes,
-                hyperparams
+                hyperparams, cost_meter=self.cost_meter
             )
         else:
             raise ValueError('model not implemented for now.')
+        if hyperparams.channels_last:
+            convert_to_channels_last(self.network)
         self.hyperparams = hyperparams
         self.num_classes = num_classes
         self.image_buffer = []
@@ -103,6 +111,11 @@ class LitClassifier(pl.LightningModule):
             self.encoder.conv1 = nn.Conv2d(1, 64, kernel_size=3, stride=1, padding=1, bias=False)
             self.encoder.maxpool = nn.Identity()
 
+    def prepare_images(self, x):
+        x = x.reshape(x.size(0), self.im_shape[0], self.im_shape[1], self.im_shape[2])
+        if self.hyperparams.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
 
     def training_step(self, batch, batch_idx):
         # training_step defines the train loop.
@@ -111,14 +124,14 @@ class LitClassifier(pl.LightningModule):
             x, y = batch
         else:
             x, points, y = batch
-        x = x.reshape(x.size(0), self.im_shape[0], self.im_shape[1], self.im_shape[2])
+        x = self.prepare_images(x)
 
         logits = self.network(x) if self.hyperparams.data_mode == 'image' else self.network(x, points)
         loss = self.loss(logits, y)
 
         acc = (logits.argmax(dim=-1) == y).float().mean()
         # Logging to TensorBoard by default
-        metrics = {"train/loss": loss, "train/acc": acc}
+        metrics = {"train/loss": loss, "train/acc": acc, **self.cost_meter.metrics("train")}
         self.log_dict(metrics)
         return loss
 
@@ -127,14 +140,15 @@ class LitClassifier(pl.LightningModule):
             x, y = batch
         else:
             x, points, y = batch
-        x = x.reshape(x.size(0), self.im_shape[0], self.im_shape[1], self.im_shape[2])
+        x = self.prepare_images(x)
         logits = self.network(x) if self.hyperparams.data_mode == 'image' else self.network(x, points)
         loss = self.loss(logits, y)
         preds = logits.argmax(dim=-1)
         acc = (preds == y).float().mean()
         # Logging to TensorBoard by default
         metrics = {"val/loss": loss, "val/acc": acc}
-        self.log_dict(metrics)
+        self.log_dict(metrics, sync_dist=True)
+        self.log_dict(self.cost_meter.metrics("val"))
         return metrics
 
     def test_step(self, batch, batch_idx):
@@ -142,7 +156,7 @@ class LitClassifier(pl.LightningModule):
             x, y = batch
         else:
             x, points, y = batch
-        x = x.reshape(x.size(0), self.im_shape[0], self.im_shape[1], self.im_shape[2])
+        x = self.prepare_images(x)
         if self.hyperparams.model in ('equivariant', 'canonized_pca'):
             if self.hyperparams.check_invariance:
                 if self.hyperparams.group_type == 'roto-reflection':
@@ -151,6 +165,10 @@ class LitClassifier(pl.LightningModule):
                     self.num_batches_invariant += check_rotation_invariance(self.network, x, self.hyperparams.num_rotations)
                 else:
                     raise ValueError('group_type not implemented for now.')
+            if self.hyperparams.model == 'equivariant' and self.hyperparams.check_precision_stability:
+                reduced_dtype = torch.float16 if x.is_cuda and not torch.cuda.is_bf16_supported() else torch.bfloat16
+                self.log('test/canonization_argmax_agreement',
+                         check_canonization_precision_stability(self.network, x, reduced_dtype))
             if batch_idx == 0:
                 self.image_buffer = x
                 self.canonized_image_buffer, _ = self.network.get_canonized_images(x)
@@ -190,7 +208,7 @@ class LitClassifier(pl.LightningModule):
         metrics = {"test/loss": loss, "test/acc": acc}
         for i in range(self.num_classes):
             metrics[f'test/acc_class_{i}'] = acc_per_class[i]
-        self.log_dict(metrics)
+        self.log_dict(metrics, sync_dist=True)
         return metrics
 
     def on_test_end(self):
@@ -199,14 +217,14 @@ class LitClassifier(pl.LightningModule):
                   f'invariant: {self.num_batches_invariant / self.trainer.num_test_batches[0]}')
 
     def forward(self, x):
-        x = x.reshape(x.size(0), self.im_shape[0], self.im_shape[1], self.im_shape[2])
+        x = self.prepare_images(x)
         logits = self.network(x)
         preds = logits.argmax(dim=-1)
         return preds
 
     def predict_step(self, batch, batch_idx, **kwargs):
         x, y = batch
-        x = x.reshape(x.size(0), self.im_shape[0], self.im_shape[1], self.im_shape[2])
+        x = self.prepare_images(x)
         logits = self.network(x)
         preds = logits.argmax(dim=-1)
         return preds
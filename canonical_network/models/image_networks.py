@@ -1,13 +1,14 @@
 import torch.nn.functional as F
-import kornia as K
 from torch import nn
 import torch
 from canonical_network.models.equivariant_layers import RotationEquivariantConvLift, \
     RotoReflectionEquivariantConvLift, RotationEquivariantConv, RotoReflectionEquivariantConv
-from torchvision import transforms
-from canonical_network.models.set_base_models import SequentialMultiple
+from canonical_network.cost import CostMeter
+from canonical_network.utils import LazyModule, SequentialMultiple
 import numpy as np
 
+K = LazyModule("kornia")
+
 
 class CanonizationNetwork(nn.Module):
     def __init__(self, in_shape, out_channels, kernel_size, group_type='rotation', num_rotations=4, num_layers=1, device='cuda'):
@@ -50,7 +51,9 @@ class EquivariantCanonizationNetwork(nn.Module):
                  group_type='rotation',
                  num_rotations=4,
                  device='cuda',
-                 batch_size=128):
+                 batch_size=128,
+                 full_precision_canonization=True,
+                 cost_meter=None):
         super().__init__()
         self.canonization_network = CanonizationNetwork(
             in_shape, canonization_out_channels, canonization_kernel_size,
@@ -71,9 +74,13 @@ class EquivariantCanonizationNetwork(nn.Module):
         self.group_type = group_type
         self.beta = canonization_beta
         self.num_group = num_rotations if group_type == 'rotation' else 2 * num_rotations
+        self.full_precision_canonization = full_precision_canonization
+        self.cost_meter = cost_meter or CostMeter()
 
     def fibres_to_group(self, fibre_activations):
         device = fibre_activations.device
+        # argmax and the sharp softmax are taken in float32 even when the fibres come out of autocast
+        fibre_activations = fibre_activations.float()
         #fibre_activations_one_hot = torch.nn.functional.softmax(self.beta * fibre_activations, dim=-1)
         fibre_activations_one_hot = torch.nn.functional.one_hot(torch.argmax(fibre_activations, dim=-1), self.num_group).float()
         fibre_activations_soft = torch.nn.functional.softmax(self.beta * fibre_activations, dim=-1)
@@ -122,13 +129,20 @@ class EquivariantCanonizationNetwork(nn.Module):
         :return: (batch_size, num_classes)
         """
         batch_size = x.shape[0]
-        x_canonized, group = self.get_canonized_images(x)
-        reps = self.base_encoder(x_canonized)
-        reps = reps.reshape(batch_size, -1)
-        return self.predictor(reps)
+        with self.cost_meter.measure("canon", self.canonization_network):
+            x_canonized, group = self.get_canonized_images(x)
+        with self.cost_meter.measure("pred", self.base_encoder, self.predictor):
+            reps = self.base_encoder(x_canonized)
+            reps = reps.reshape(batch_size, -1)
+            return self.predictor(reps)
 
     def get_canonized_images(self, x):
-        fibres_activations = self.canonization_network(x)
+        if self.full_precision_canonization:
+            # nearly tied fibres can swap their argmax in bf16/fp16, so the canonization stays in float32
+            with torch.autocast(device_type=x.device.type, enabled=False):
+                fibres_activations = self.canonization_network(x.float())
+        else:
+            fibres_activations = self.canonization_network(x)
         #x = transforms.Pad(4)(x)
         x_canonized, group = self.inverse_action(x, fibres_activations)
         return x_canonized, group
@@ -202,9 +216,10 @@ class PCACanonizationNetwork(nn.Module):
         return self.predictor(reps)
 
 class OptimizationCanonizationNetwork(nn.Module):
-    def __init__(self, encoder, in_shape, num_classes, hyperparams=None):
+    def __init__(self, encoder, in_shape, num_classes, hyperparams=None, cost_meter=None):
         super().__init__()
         self.energy = CustomDeepSets(hyperparams)
+        self.cost_meter = cost_meter or CostMeter()
         self.lr = hyperparams.rot_opt_lr
         self.iters = hyperparams.num_optimization_iters
         self.implicit = True if hyperparams.implicit else False
@@ -286,10 +301,12 @@ class OptimizationCanonizationNetwork(nn.Module):
     def forward(self, images, points):
         #breakpoint()
         batch_size = points.shape[0]
-        images_canonized = self.get_canonized_images(images, points)
-        reps = self.encoder(images_canonized)
-        reps = reps.view(batch_size, -1)
-        return self.predictor(reps)
+        with self.cost_meter.measure("canon", self.energy):
+            images_canonized = self.get_canonized_images(images, points)
+        with self.cost_meter.measure("pred", self.encoder, self.predictor):
+            reps = self.encoder(images_canonized)
+            reps = reps.view(batch_size, -1)
+            return self.predictor(reps)
 
     def gram_schmidt(self, vectors):
         v1 = vectors[:, 0]
@@ -1,12 +1,14 @@
 
 
 import pytorch_lightning as pl
-from pytorch3d.transforms import RotateAxisAngle, Rotate, random_rotations
 from torch.optim.lr_scheduler import CosineAnnealingLR, StepLR
 
 from canonical_network.utils import *
-from canonical_network.models.pointcloud_networks import VNSmall, PointNetEncoder
+from canonical_network.models.pointcloud_networks import VNSmall, PointNetEncoder, FarthestPointDownsample, \
+    PointcloudAugmentation
 from canonical_network.models.vn_layers import *
+from canonical_network.cost import CostMeter
+from canonical_network.distributed import reduce_sum
 
 class BasePointcloudClassificationModel(pl.LightningModule):
     def __init__(self, hyperparams):
@@ -17,6 +19,22 @@ class BasePointcloudClassificationModel(pl.LightningModule):
         self.num_points = hyperparams.num_points
         self.learning_rate = hyperparams.learning_rate
         self.hyperparams = hyperparams
+        configure_knn(hyperparams.knn_backend, hyperparams.knn_memory_budget, hyperparams.knn_workers)
+        # timings, FLOPs and activation memory of the canonicalization and prediction halves
+        self.cost_meter = CostMeter(hyperparams.cost_accounting)
+        # multi-resolution input: farthest point sample num_points down to fps_num_points on device
+        self.downsample = FarthestPointDownsample(
+            hyperparams.fps_num_points, hyperparams.fps_seed if hyperparams.fps_seed >= 0 else None
+        ) if hyperparams.fps_num_points else None
+        self.train_augmentation = PointcloudAugmentation(
+            rotation=hyperparams.train_rotation,
+            max_dropout_ratio=0.9 if hyperparams.augment_train_data else 0.0,
+            scale_range=(0.8, 1.2) if hyperparams.augment_train_data else None,
+            shift_range=0.1 if hyperparams.augment_train_data else 0.0,
+            jitter_sigma=hyperparams.jitter_sigma,
+            seed=hyperparams.augment_seed if hyperparams.augment_seed >= 0 else None,
+        )
+        self.valid_augmentation = PointcloudAugmentation(rotation=hyperparams.valid_rotation)
 
     def configure_optimizers(self):
         if self.hyperparams.optimizer == "Adam":
@@ -44,32 +62,26 @@ class BasePointcloudClassificationModel(pl.LightningModule):
             raise NotImplementedError
 
     def training_step(self, batch, batch_idx):
-        points, targets = batch
+        points, targets, *knn_idx = batch
         points, targets = points.float(), targets.long()
 
         # Augmentations
-        trot = None
-        if self.train_rotation == "z":
-            trot = RotateAxisAngle(angle=torch.rand(points.shape[0]) * 360, axis="Z", degrees=True, device=self.device)
-        elif self.train_rotation == "so3":
-            trot = Rotate(R=random_rotations(points.shape[0]), device=self.device)
-        if trot is not None:
-            points = trot.transform_points(points)
-        if self.hyperparams.augment_train_data:
-            points = random_point_dropout(points)
-            points = random_scale_point_cloud(points)
-            points = random_shift_point_cloud(points)
-        points = points.transpose(2, 1)
+        points = self.train_augmentation(points)
+        if self.downsample is not None:
+            points, _ = self.downsample(points)
         targets = targets[:, 0]
+        # dropout and jitter move points, the dataset graph no longer matches
+        knn_idx = self.get_input_knn(knn_idx) if not self.train_augmentation.moves_points_apart else None
 
         # Forward pass
-        outputs = self(points)
+        outputs = self(points, knn_idx=knn_idx)
 
         # Loss
         loss = self.get_loss(outputs, targets)
 
         metrics = {"train/loss": loss}
         self.log_dict(metrics, on_epoch=True, prog_bar=True)
+        self.log_dict(self.cost_meter.metrics("train"), on_epoch=True)
 
         return loss
 
@@ -78,21 +90,15 @@ class BasePointcloudClassificationModel(pl.LightningModule):
         self.class_acc = np.zeros((self.num_classes,3))
 
     def validation_step(self, batch, batch_idx):
-        points, targets = batch
+        points, targets, *knn_idx = batch
         points, targets = points.float(), targets.long()
 
-        trot = None
-        if self.valid_rotation == "z":
-            trot = RotateAxisAngle(angle=torch.rand(points.shape[0]) * 360, axis="Z", degrees=True, device=self.device)
-        elif self.valid_rotation == "so3":
-            trot = Rotate(R=random_rotations(points.shape[0]), device=self.device)
-        if trot is not None:
-            points = trot.transform_points(points)
-
-        points = points.transpose(2, 1)
+        points = self.valid_augmentation(points)
+        if self.downsample is not None:
+            points, _ = self.downsample(points)
         targets = targets[:, 0]
 
-        outputs = self(points)
+        outputs = self(points, knn_idx=self.get_input_knn(knn_idx))
         predictions = self.get_predictions(outputs)
 
         pred_choice = predictions.data.max(1)[1]
@@ -102,19 +108,29 @@ class BasePointcloudClassificationModel(pl.LightningModule):
             self.class_acc[cat, 1] += 1
         correct = pred_choice.eq(targets.long().data).cpu().sum()
         self.mean_correct.append(correct.item() / float(points.size()[0]))
+        self.log_dict(self.cost_meter.metrics("valid"))
 
         return outputs
 
     def validation_epoch_end(self, outputs):
+        # sums and counts of all ranks, so the accuracies are those of the whole validation split
+        self.class_acc[:, :2] = reduce_sum(self, self.class_acc[:, :2])
+        correct_sum, num_batches = reduce_sum(self, [np.sum(self.mean_correct), len(self.mean_correct)])
 
         self.class_acc[:, 2] = self.class_acc[:, 0] / self.class_acc[:, 1]
         class_acc = np.mean(self.class_acc[:, 2])
-        instance_acc = np.mean(self.mean_correct)
+        instance_acc = correct_sum / num_batches
         self.log_dict(
             {"valid/instance_accuracy": instance_acc,
              "valid/class_accuracy": class_acc},
             prog_bar=True)
 
+    def get_input_knn(self, knn_idx):
+        # knn graph of the input coordinates precomputed by the dataset, rotations, scaling and shifts keep it valid
+        if not knn_idx or self.downsample is not None:
+            return None
+        return knn_idx[0].long()
+
     def get_loss(self, outputs, targets, smoothing=True):
         predictions = self.get_predictions(outputs)
         targets = targets.contiguous().view(-1)
@@ -158,7 +174,7 @@ class Pointnet(BasePointcloudClassificationModel):
         self.bn2 = nn.BatchNorm1d(256)
         self.relu = nn.ReLU()
 
-    def forward(self, point_cloud):
+    def forward(self, point_cloud, knn_idx=None):
         x, trans, trans_feat = self.feat(point_cloud)
         x = F.relu(self.bn1(self.fc1(x)))
         x = F.relu(self.bn2(self.dropout(self.fc2(x))))
@@ -186,6 +202,8 @@ class DGCNN(BasePointcloudClassificationModel):
     def __init__(self, hyperparams):
         super(DGCNN, self).__init__(hyperparams)
         self.n_knn = hyperparams.n_knn
+        self.fused_edge_conv = hyperparams.fused_edge_conv
+        self.static_knn_graph = hyperparams.static_knn_graph
 
         self.bn1 = nn.BatchNorm2d(64)
         self.bn2 = nn.BatchNorm2d(64)
@@ -216,22 +234,28 @@ class DGCNN(BasePointcloudClassificationModel):
         self.dp2 = nn.Dropout(p=0.5)
         self.linear3 = nn.Linear(256, hyperparams.num_classes)
 
-    def forward(self, x):
+    def graph_conv(self, x, conv, idx=None):
+        if self.fused_edge_conv:
+            return edge_conv(x, conv, k=self.n_knn, idx=idx)
+        return conv(get_graph_feature(x, k=self.n_knn, idx=idx))
+
+    def forward(self, x, knn_idx=None):
         batch_size = x.size(0)
-        x = get_graph_feature(x, k=self.n_knn)
-        x = self.conv1(x)
+        if knn_idx is None and self.static_knn_graph:
+            knn_idx = knn(x, k=self.n_knn)
+        # the input coordinate graph is used by the first layer, or by all of them with a static graph
+        layer_idx = knn_idx if self.static_knn_graph else None
+
+        x = self.graph_conv(x, self.conv1, knn_idx)
         x1 = x.max(dim=-1, keepdim=False)[0]
 
-        x = get_graph_feature(x1, k=self.n_knn)
-        x = self.conv2(x)
+        x = self.graph_conv(x1, self.conv2, layer_idx)
         x2 = x.max(dim=-1, keepdim=False)[0]
 
-        x = get_graph_feature(x2, k=self.n_knn)
-        x = self.conv3(x)
+        x = self.graph_conv(x2, self.conv3, layer_idx)
         x3 = x.max(dim=-1, keepdim=False)[0]
 
-        x = get_graph_feature(x3, k=self.n_knn)
-        x = self.conv4(x)
+        x = self.graph_conv(x3, self.conv4, layer_idx)
         x4 = x.max(dim=-1, keepdim=False)[0]
 
         x = torch.cat((x1, x2, x3, x4), dim=1)
@@ -258,8 +282,8 @@ class PointcloudCanonFunction(pl.LightningModule):
         self.model_type = hyperparams.canon_model_type
         self.model = {"vn_net": lambda: VNSmall(hyperparams)}[self.model_type]()
 
-    def forward(self, points):
-        vectors = self.model(points)
+    def forward(self, points, knn_idx=None):
+        vectors = self.model(points, knn_idx=knn_idx)
         rotation_vectors = vectors[:, :3]
         translation_vectors = vectors[:, 3:]
 
@@ -285,8 +309,8 @@ class PointcloudPredFunction(pl.LightningModule):
         self.model = {"pointnet": lambda: Pointnet(hyperparams),
                       "DGCNN": lambda: DGCNN(hyperparams)}[self.model_type]()
 
-    def forward(self, points):
-        return self.model(points)
+    def forward(self, points, knn_idx=None):
+        return self.model(points, knn_idx=knn_idx)
 
 
 class EquivariantPointcloudModel(BasePointcloudClassificationModel):
@@ -298,15 +322,20 @@ class EquivariantPointcloudModel(BasePointcloudClassificationModel):
         self.canon_function = PointcloudCanonFunction(hyperparams)
         self.pred_function = PointcloudPredFunction(hyperparams)
 
-    def forward(self, point_cloud):
-        rotation_matrix, translation_vectors = self.canon_function(point_cloud)
+    def forward(self, point_cloud, knn_idx=None):
+        # the canonicalization only rotates, so the input graph is shared by both networks
+        if knn_idx is None and self.hyperparams.static_knn_graph:
+            knn_idx = knn(point_cloud, k=self.hyperparams.n_knn)
+        with self.cost_meter.measure("canon", self.canon_function):
+            rotation_matrix, translation_vectors = self.canon_function(point_cloud, knn_idx=knn_idx)
         rotation_matrix_inverse = rotation_matrix.transpose(1, 2)
 
         # not applying translations
         canonical_point_cloud = torch.bmm(point_cloud.transpose(1, 2), rotation_matrix_inverse)
         canonical_point_cloud = canonical_point_cloud.transpose(1, 2)
 
-        predictions, _ = self.pred_function(canonical_point_cloud)
+        with self.cost_meter.measure("pred", self.pred_function):
+            predictions, _ = self.pred_function(canonical_point_cloud, knn_idx=knn_idx)
 
         return predictions, rotation_matrix
 
@@ -328,7 +357,7 @@ class VNPointnet(BasePointcloudClassificationModel):
         self.bn2 = nn.BatchNorm1d(256)
         self.relu = nn.ReLU()
 
-    def forward(self, x):
+    def forward(self, x, knn_idx=None):
         x, trans, trans_feat = self.feat(x)
         x = F.relu(self.bn1(self.fc1(x)))
         x = F.relu(self.bn2(self.dropout(self.fc2(x))))
@@ -3,11 +3,95 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-import pytorch_lightning as pl
 from canonical_network.models.vn_layers import *
 import torch.nn.init as init
-from canonical_network.utils import get_graph_feature_cross
-class STN3d(pl.LightningModule):
+from canonical_network.utils import get_graph_feature_cross, farthest_point_sample, edge_conv, random_rotations
+
+
+class FarthestPointDownsample(nn.Module):
+    def __init__(self, num_points, seed=None):
+        super(FarthestPointDownsample, self).__init__()
+        self.num_points = num_points
+        self.seed = seed
+        self.generator = None
+
+    def forward(self, point_cloud):
+        '''
+        point_cloud: (B, C, N) tensor, the first three channels are the coordinates
+        returns the (B, C, num_points) downsampled cloud and the (B, num_points) sampled indices
+        '''
+        if self.seed is not None and (self.generator is None or self.generator.device.type != point_cloud.device.type):
+            self.generator = torch.Generator(device=point_cloud.device).manual_seed(self.seed)
+        idx = farthest_point_sample(point_cloud.transpose(2, 1), self.num_points, generator=self.generator)
+        downsampled = point_cloud.gather(2, idx.unsqueeze(1).expand(-1, point_cloud.shape[1], -1))
+        return downsampled, idx
+
+class PointcloudAugmentation(nn.Module):
+    """
+    Random rotation, dropout, scaling, shift and jitter for a whole batch on its device, one batched op each.
+    Takes (B, N, C) clouds as they come from the loaders and returns them in the (B, C, N) layout of the models;
+    the rotation and the transpose are a single batched matmul. Rotations are applied to every group of three
+    channels (coordinates and normals), the other augmentations only touch the coordinates. Every augmentation is
+    disabled by its default, and with a seed the draws come from a dedicated torch.Generator so runs are
+    reproducible.
+    """
+    def __init__(self, rotation=None, max_dropout_ratio=0.0, scale_range=None, shift_range=0.0, jitter_sigma=0.0,
+                 jitter_clip=0.05, seed=None):
+        super(PointcloudAugmentation, self).__init__()
+        self.rotation = rotation if rotation in ("z", "so3") else None
+        self.max_dropout_ratio = max_dropout_ratio
+        self.scale_range = scale_range
+        self.shift_range = shift_range
+        self.jitter_sigma = jitter_sigma
+        self.jitter_clip = jitter_clip
+        self.seed = seed
+        self.generator = None
+
+    @property
+    def moves_points_apart(self):
+        # whether the knn graph of the input is still valid after the augmentation
+        return self.max_dropout_ratio > 0 or self.jitter_sigma > 0
+
+    def forward(self, point_cloud):
+        '''
+        point_cloud: (B, N, C) tensor, the first three channels are the coordinates
+        returns the augmented (B, C, N) tensor
+        '''
+        B, N, C = point_cloud.shape
+        device, dtype = point_cloud.device, point_cloud.dtype
+        if self.seed is not None and (self.generator is None or self.generator.device.type != device.type):
+            self.generator = torch.Generator(device=device).manual_seed(self.seed)
+
+        if self.rotation is not None:
+            rotations = random_rotations(self.rotation, B, device, dtype, self.generator)
+            if C > 3:
+                # block diagonal (B, C, C) matrix rotating every group of three channels
+                blocks = torch.eye(C // 3, device=device, dtype=dtype)
+                rotations = torch.einsum("ij,bkl->bikjl", blocks, rotations).reshape(B, C, C)
+            point_cloud = torch.matmul(rotations, point_cloud.transpose(2, 1))
+        else:
+            point_cloud = point_cloud.transpose(2, 1)
+        if self.max_dropout_ratio > 0:
+            dropout_ratio = torch.rand(B, 1, device=device, generator=self.generator) * self.max_dropout_ratio
+            drop = torch.rand(B, N, device=device, generator=self.generator) <= dropout_ratio
+            # dropped points are set to the first point
+            point_cloud = torch.where(drop.unsqueeze(1), point_cloud[:, :, :1], point_cloud)
+
+        xyz, features = point_cloud[:, :3], point_cloud[:, 3:]
+        if self.scale_range is not None:
+            scale_low, scale_high = self.scale_range
+            xyz = xyz * (torch.rand(B, 1, 1, device=device, dtype=dtype, generator=self.generator)
+                         * (scale_high - scale_low) + scale_low)
+        if self.shift_range > 0:
+            xyz = xyz + (torch.rand(B, 3, 1, device=device, dtype=dtype, generator=self.generator) * 2 - 1) \
+                * self.shift_range
+        if self.jitter_sigma > 0:
+            noise = torch.randn(B, 3, N, device=device, dtype=dtype, generator=self.generator) * self.jitter_sigma
+            xyz = xyz + noise.clamp_(-self.jitter_clip, self.jitter_clip)
+        return torch.cat((xyz, features), dim=1) if C > 3 else xyz
+
+
+class STN3d(nn.Module):
     def __init__(self, channel):
         super(STN3d, self).__init__()
         self.conv1 = torch.nn.Conv1d(channel, 64, 1)
@@ -47,7 +131,7 @@ class STN3d(pl.LightningModule):
         x = x.view(-1, 3, 3)
         return x
 
-class STNkd(pl.LightningModule):
+class STNkd(nn.Module):
     def __init__(self, k=64):
         super(STNkd, self).__init__()
         self.conv1 = torch.nn.Conv1d(k, 64, 1)
@@ -90,7 +174,7 @@ class STNkd(pl.LightningModule):
         return x
 
 
-class VNSTNkd(pl.LightningModule):
+class VNSTNkd(nn.Module):
     def __init__(self, hyperparams, d):
         super(VNSTNkd, self).__init__()
         self.conv1 = VNLinearLeakyReLU(d, 64 // 3, dim=4, negative_slope=0.0)
@@ -121,7 +205,7 @@ class VNSTNkd(pl.LightningModule):
         return x
 
 
-class Transform_Net(pl.LightningModule):
+class Transform_Net(nn.Module):
     def __init__(self, args):
         super(Transform_Net, self).__init__()
         self.args = args
@@ -150,10 +234,14 @@ class Transform_Net(pl.LightningModule):
         init.constant_(self.transform.weight, 0)
         init.eye_(self.transform.bias.view(3, 3))
 
-    def forward(self, x):
+    def forward(self, x, idx=None):
         batch_size = x.size(0)
 
-        x = self.conv1(x)                       # (batch_size, 3*2, num_points, k) -> (batch_size, 64, num_points, k)
+        if x.dim() == 3:
+            # points instead of edge features, (batch_size, 3, num_points) -> (batch_size, 64, num_points, k)
+            x = edge_conv(x, self.conv1, k=self.args.n_knn, idx=idx)
+        else:
+            x = self.conv1(x)                   # (batch_size, 3*2, num_points, k) -> (batch_size, 64, num_points, k)
         x = self.conv2(x)                       # (batch_size, 64, num_points, k) -> (batch_size, 128, num_points, k)
         x = x.max(dim=-1, keepdim=False)[0]     # (batch_size, 128, num_points, k) -> (batch_size, 128, num_points)
 
@@ -169,10 +257,11 @@ class Transform_Net(pl.LightningModule):
         return x
 
 
-class VNSmall(pl.LightningModule):
+class VNSmall(nn.Module):
     def __init__(self, hyperparams):
         super().__init__()
         self.n_knn = hyperparams.n_knn
+        self.fused_edge_conv = hyperparams.fused_edge_conv
         self.pooling = hyperparams.pooling
         self.conv_pos = VNLinearLeakyReLU(3, 64 // 3, dim=5, negative_slope=0.0)
         self.conv1 = VNLinearLeakyReLU(64 // 3, 64 // 3, dim=4, negative_slope=0.0)
@@ -190,10 +279,13 @@ class VNSmall(pl.LightningModule):
         self.conv = VNLinear(3, 12 // 3)
 
 
-    def forward(self, point_cloud, labels=None):
+    def forward(self, point_cloud, labels=None, knn_idx=None):
 
         point_cloud = point_cloud.unsqueeze(1)
-        feat = get_graph_feature_cross(point_cloud, k=self.n_knn)
+        if self.fused_edge_conv:
+            out = self.pool(self.conv.forward_edge(point_cloud, k=self.n_knn, idx=knn_idx))
+            return self.dropout(out).mean(dim=-1)
+        feat = get_graph_feature_cross(point_cloud, k=self.n_knn, idx=knn_idx)
         # point_cloud = self.conv_pos(feat)
         # point_cloud = self.pool(point_cloud)
         #
@@ -206,7 +298,7 @@ class VNSmall(pl.LightningModule):
 
         return out.mean(dim=-1)
 
-class PointNetEncoder(pl.LightningModule):
+class PointNetEncoder(nn.Module):
     def __init__(self, global_feat=True, feature_transform=False, channel=3):
         super(PointNetEncoder, self).__init__()
         self.stn = STN3d(channel)
@@ -1,11 +1,13 @@
 
 import pytorch_lightning as pl
-from pytorch3d.transforms import RotateAxisAngle, Rotate, random_rotations
 from torch.optim.lr_scheduler import CosineAnnealingLR, MultiStepLR
 
 from canonical_network.utils import *
-from canonical_network.models.pointcloud_networks import STNkd, STN3d, VNSTNkd, Transform_Net, VNSmall
+from canonical_network.models.pointcloud_networks import STNkd, STN3d, VNSTNkd, Transform_Net, VNSmall, \
+    PointcloudAugmentation
 from canonical_network.models.vn_layers import *
+from canonical_network.cost import CostMeter
+from canonical_network.distributed import reduce_sum
 
 SEGMENTATION_CLASSES = {
     "Earphone": [16, 17, 18],
@@ -46,6 +48,17 @@ class BasePointcloudModel(pl.LightningModule):
         self.num_points = hyperparams.num_points
         self.learning_rate = hyperparams.learning_rate if hasattr(hyperparams, "learning_rate") else None
         self.hyperparams = hyperparams
+        configure_knn(hyperparams.knn_backend, hyperparams.knn_memory_budget, hyperparams.knn_workers)
+        # timings, FLOPs and activation memory of the canonicalization and prediction halves
+        self.cost_meter = CostMeter(hyperparams.cost_accounting)
+        self.train_augmentation = PointcloudAugmentation(
+            rotation=hyperparams.train_rotation,
+            scale_range=(0.8, 1.2) if hyperparams.augment_train_data else None,
+            shift_range=0.1 if hyperparams.augment_train_data else 0.0,
+            jitter_sigma=hyperparams.jitter_sigma,
+            seed=hyperparams.augment_seed if hyperparams.augment_seed >= 0 else None,
+        )
+        self.valid_augmentation = PointcloudAugmentation(rotation=hyperparams.valid_rotation)
 
     def get_predictions(self, outputs):
         if type(outputs) == list:
@@ -94,31 +107,24 @@ class BasePointcloudModel(pl.LightningModule):
         print(f"Learning rate in epoch {self.current_epoch} is {lr}")
 
     def training_step(self, batch, batch_idx):
-        points, label, targets = batch
+        points, label, targets, *knn_idx = batch
         points, label, targets = points.float(), label.long(), targets.long()
 
         # Augmentations
-        trot = None
-        if self.train_rotation == "z":
-            trot = RotateAxisAngle(angle=torch.rand(points.shape[0]) * 360, axis="Z", degrees=True, device=self.device)
-        elif self.train_rotation == "so3":
-            trot = Rotate(R=random_rotations(points.shape[0]), device=self.device)
-        if trot is not None:
-            points = trot.transform_points(points)
-        if self.hyperparams.augment_train_data:
-            points = random_scale_point_cloud(points)
-            points = random_shift_point_cloud(points)
-        points = points.transpose(2, 1)
+        points = self.train_augmentation(points)
+        # jitter moves points, the dataset graph no longer matches
+        knn_idx = self.get_input_knn(knn_idx) if not self.train_augmentation.moves_points_apart else None
 
         # Forward pass
         ont_hot_labels = to_categorical(label, self.num_classes).type_as(label)
-        outputs = self(points, ont_hot_labels)
+        outputs = self(points, ont_hot_labels, knn_idx=knn_idx)
 
         # Loss
         loss = self.get_loss(outputs, targets)
 
         metrics = {"train/loss": loss}
         self.log_dict(metrics, on_epoch=True, prog_bar=True)
+        self.log_dict(self.cost_meter.metrics("train"), on_epoch=True)
 
         return loss
 
@@ -130,27 +136,20 @@ class BasePointcloudModel(pl.LightningModule):
         self.shape_ious = {cat: [] for cat in SEGMENTATION_CLASSES.keys()}
 
     def validation_step(self, batch, batch_idx):
-        points, label, targets = batch
+        points, label, targets, *knn_idx = batch
         points, label, targets = points.float(), label.long(), targets.long()
 
-        trot = None
-        if self.valid_rotation == "z":
-            trot = RotateAxisAngle(angle=torch.rand(points.shape[0]) * 360, axis="Z", degrees=True, device=self.device)
-        elif self.valid_rotation == "so3":
-            trot = Rotate(R=random_rotations(points.shape[0]), device=self.device)
-        if trot is not None:
-            points = trot.transform_points(points)
-
-        points = points.transpose(2, 1)
+        points = self.valid_augmentation(points)
         ont_hot_labels = to_categorical(label, self.num_classes).type_as(label)
-        outputs = self(points, ont_hot_labels)
+        outputs = self(points, ont_hot_labels, knn_idx=self.get_input_knn(knn_idx))
         predictions = self.get_predictions(outputs)
 
         loss = self.get_loss(outputs, targets)
         self.append_to_metric_lists(points, predictions, targets)
 
         metrics = {"valid/loss": loss}
-        self.log_dict(metrics, prog_bar=True)
+        self.log_dict(metrics, prog_bar=True, sync_dist=True)
+        self.log_dict(self.cost_meter.metrics("valid"))
         return outputs
 
     def validation_epoch_end(self, outputs):
@@ -160,6 +159,10 @@ class BasePointcloudModel(pl.LightningModule):
             {"valid/accuracy": accuracy, "valid/class_avg_iou": class_avg_iou, "valid/instance_avg_iou": instance_avg_iou},
             prog_bar=True)
 
+    def get_input_knn(self, knn_idx):
+        # knn graph of the input coordinates precomputed by the dataset, rotations, scaling and shifts keep it valid
+        return knn_idx[0].long() if knn_idx else None
+
     def get_loss(self, outputs, targets, smoothing=True):
         ''' Calculate cross entropy loss and apply label smoothing. '''
         predictions = self.get_predictions(outputs)
@@ -214,16 +217,20 @@ class BasePointcloudModel(pl.LightningModule):
             self.shape_ious[cat].append(np.mean(part_ious))
 
     def get_metrics(self):
-        all_shape_ious = []
-        for cat in self.shape_ious.keys():
-            for iou in self.shape_ious[cat]:
-                all_shape_ious.append(iou)
-            self.shape_ious[cat] = np.mean(self.shape_ious[cat])
+        # sums and counts of all ranks in one reduction, so the metrics are those of the whole validation split
+        categories = list(self.shape_ious.keys())
+        totals = reduce_sum(self, [self.total_correct, self.total_seen] + self.total_seen_class
+                            + self.total_correct_class + [np.sum(self.shape_ious[cat]) for cat in categories]
+                            + [len(self.shape_ious[cat]) for cat in categories])
+        total_correct, total_seen, total_seen_class, total_correct_class, iou_sums, iou_counts = np.split(
+            totals, np.cumsum([1, 1, self.num_parts, self.num_parts, len(categories)]))
+        # nan for a category without shapes, like the mean of its empty list
+        self.shape_ious = dict(zip(categories, iou_sums / iou_counts))
         mean_shape_ious = np.mean(list(self.shape_ious.values()))
-        accuracy = self.total_correct / float(self.total_seen)
-        class_avg_accuracies = np.mean(np.array(self.total_correct_class) / np.array(self.total_seen_class, dtype=np.float))
+        accuracy = total_correct.item() / total_seen.item()
+        class_avg_accuracies = np.mean(total_correct_class / total_seen_class)
         class_avg_ious = mean_shape_ious
-        instance_avg_iou = np.mean(all_shape_ious)
+        instance_avg_iou = iou_sums.sum() / iou_counts.sum()
         return accuracy, class_avg_accuracies, class_avg_ious, instance_avg_iou
 
 
@@ -260,7 +267,7 @@ class Pointnet(BasePointcloudModel):
         self.bns2 = nn.BatchNorm1d(256)
         self.bns3 = nn.BatchNorm1d(128)
 
-    def forward(self, point_cloud, label):
+    def forward(self, point_cloud, label, knn_idx=None):
         B, D, N = point_cloud.size()
         if self.regularization_transform:
             trans = self.stn(point_cloud)
@@ -291,9 +298,8 @@ class Pointnet(BasePointcloudModel):
         out_max = out_max.view(-1, 2048)
 
         out_max = torch.cat([out_max, label.squeeze(1)], 1)
-        expand = out_max.view(-1, 2048 + 16, 1).repeat(1, 1, N)
-        concat = torch.cat([expand, out1, out2, out3, out4, out5], 1)
-        net = F.relu(self.bns1(self.convs1(concat)))
+        # convs1 over [out_max repeated N times, out1, ..., out5] without building the (B, 4944, N) input
+        net = F.relu(self.bns1(global_point_conv(self.convs1, out_max, [out1, out2, out3, out4, out5])))
         net = F.relu(self.bns2(self.convs2(net)))
         net = F.relu(self.bns3(self.convs3(net)))
         net = self.convs4(net)
@@ -330,6 +336,8 @@ class DGCNN(BasePointcloudModel):
         self.normal_channel = hyperparams.normal_channel
         self.regularization_transform = hyperparams.regularization_transform
         self.n_knn = hyperparams.n_knn
+        self.fused_edge_conv = hyperparams.fused_edge_conv
+        self.static_knn_graph = hyperparams.static_knn_graph
         self.transform_net = Transform_Net(hyperparams)
         
         self.bn1 = nn.BatchNorm2d(64)
@@ -378,28 +386,35 @@ class DGCNN(BasePointcloudModel):
                                    nn.LeakyReLU(negative_slope=0.2))
         self.conv11 = nn.Conv1d(128, self.num_parts, kernel_size=1, bias=False)
 
-    def forward(self, x, l):
+    def graph_conv(self, x, conv, idx=None):
+        if self.fused_edge_conv:
+            return edge_conv(x, conv, k=self.n_knn, idx=idx)
+        return conv(get_graph_feature(x, k=self.n_knn, idx=idx))
 
-        batch_size, _, num_points = x.shape
+    def forward(self, x, l, knn_idx=None):
 
-        x0 = get_graph_feature(x, k=self.n_knn)
-        t = self.transform_net(x0)
+        batch_size, _, num_points = x.shape
+        if knn_idx is None and self.static_knn_graph:
+            knn_idx = knn(x, k=self.n_knn)
+        # the input coordinate graph is used by the transform net, or by all layers with a static graph
+        layer_idx = knn_idx if self.static_knn_graph else None
+
+        # the fused transform net builds its edge features from the points itself
+        x0 = x if self.fused_edge_conv else get_graph_feature(x, k=self.n_knn, idx=knn_idx)
+        t = self.transform_net(x0, idx=knn_idx)
         x = x.transpose(2, 1)
         x = torch.bmm(x, t)
         x = x.transpose(2, 1)
 
-        x = get_graph_feature(x, k=self.n_knn)
-        x = self.conv1(x)
+        x = self.graph_conv(x, self.conv1, layer_idx)
         x = self.conv2(x)
         x1 = x.max(dim=-1, keepdim=False)[0]
 
-        x = get_graph_feature(x1, k=self.n_knn)
-        x = self.conv3(x)
+        x = self.graph_conv(x1, self.conv3, layer_idx)
         x = self.conv4(x)
         x2 = x.max(dim=-1, keepdim=False)[0]
 
-        x = get_graph_feature(x2, k=self.n_knn)
-        x = self.conv5(x)
+        x = self.graph_conv(x2, self.conv5, layer_idx)
         x3 = x.max(dim=-1, keepdim=False)[0]
 
         x = torch.cat((x1, x2, x3), dim=1)
@@ -411,11 +426,9 @@ class DGCNN(BasePointcloudModel):
         l = self.conv7(l)
 
         x = torch.cat((x, l), dim=1)
-        x = x.repeat(1, 1, num_points)
 
-        x = torch.cat((x, x1, x2, x3), dim=1)
-
-        x = self.conv8(x)
+        # conv8 over [x repeated num_points times, x1, x2, x3] without building the (B, 1280, N) input
+        x = global_point_conv(self.conv8, x, [x1, x2, x3])
         x = self.dp1(x)
         x = self.conv9(x)
         x = self.dp2(x)
@@ -435,8 +448,8 @@ class PointcloudCanonFunction(pl.LightningModule):
         self.model_type = hyperparams.canon_model_type
         self.model = {"vn_pointnet": lambda: VNSmall(hyperparams)}[self.model_type]()
 
-    def forward(self, points, labels):
-        vectors = self.model(points, labels)
+    def forward(self, points, labels, knn_idx=None):
+        vectors = self.model(points, labels, knn_idx=knn_idx)
         rotation_vectors = vectors[:, :3]
         translation_vectors = vectors[:, 3:]
 
@@ -462,8 +475,8 @@ class PointcloudPredFunction(pl.LightningModule):
         self.model = {"pointnet": lambda: Pointnet(hyperparams),
                       "DGCNN": lambda: DGCNN(hyperparams)}[self.model_type]()
 
-    def forward(self, points, labels):
-        return self.model(points, labels)
+    def forward(self, points, labels, knn_idx=None):
+        return self.model(points, labels, knn_idx=knn_idx)
 
 
 class EquivariantPointcloudModel(BasePointcloudModel):
@@ -476,15 +489,22 @@ class EquivariantPointcloudModel(BasePointcloudModel):
         self.canon_function = PointcloudCanonFunction(hyperparams)
         self.pred_function = PointcloudPredFunction(hyperparams)
 
-    def forward(self, point_cloud, label):
-        rotation_matrix, translation_vectors = self.canon_function(point_cloud, label)
+    def forward(self, point_cloud, label, knn_idx=None):
+        # the canonicalization only rotates, so the input graph is shared by both networks
+        if knn_idx is None and self.hyperparams.static_knn_graph:
+            knn_idx = knn(point_cloud, k=self.hyperparams.n_knn)
+        with self.cost_meter.measure("canon", self.canon_function):
+            rotation_matrix, translation_vectors = self.canon_function(point_cloud, label, knn_idx=knn_idx)
         rotation_matrix_inverse = rotation_matrix.transpose(1, 2)
 
         # not applying translations
         canonical_point_cloud = torch.bmm(point_cloud.transpose(1, 2), rotation_matrix_inverse)
         canonical_point_cloud = canonical_point_cloud.transpose(1, 2)
 
-        return self.pred_function(canonical_point_cloud, label)[0], rotation_matrix
+        with self.cost_meter.measure("pred", self.pred_function):
+            predictions = self.pred_function(canonical_point_cloud, label, knn_idx=knn_idx)[0]
+
+        return predictions, rotation_matrix
 
 
 
@@ -493,6 +513,7 @@ class VNPointnet(BasePointcloudModel):
         super(VNPointnet, self).__init__(hyperparams)
         self.model = "vn_pointnet"
         self.n_knn = hyperparams.n_knn
+        self.fused_edge_conv = hyperparams.fused_edge_conv
         self.normal_channel = hyperparams.normal_channel
         self.num_parts = hyperparams.num_parts
         self.pooling = hyperparams.pooling
@@ -527,12 +548,15 @@ class VNPointnet(BasePointcloudModel):
         self.bns2 = nn.BatchNorm1d(256)
         self.bns3 = nn.BatchNorm1d(128)
 
-    def forward(self, point_cloud, label):
+    def forward(self, point_cloud, label, knn_idx=None):
         B, D, N = point_cloud.size()
 
         point_cloud = point_cloud.unsqueeze(1)
-        feat = get_graph_feature_cross(point_cloud, k=self.n_knn)
-        point_cloud = self.conv_pos(feat)
+        if self.fused_edge_conv:
+            point_cloud = self.conv_pos.forward_edge(point_cloud, k=self.n_knn, idx=knn_idx)
+        else:
+            feat = get_graph_feature_cross(point_cloud, k=self.n_knn, idx=knn_idx)
+            point_cloud = self.conv_pos(feat)
         point_cloud = self.pool(point_cloud)
 
         out1 = self.conv1(point_cloud)
@@ -553,14 +577,12 @@ class VNPointnet(BasePointcloudModel):
         out_max = torch.max(out5, -1, keepdim=False)[0]
 
         out_max = torch.cat([out_max, label.squeeze(1)], 1)
-        expand = out_max.view(-1, 2048 // 3 * 6 + 16, 1).repeat(1, 1, N)
 
         out1234 = torch.cat((out1, out2, out3, out4), dim=1)
         out1234 = torch.einsum("bijm,bjkm->bikm", out1234, trans).view(B, -1, N)
 
-        concat = torch.cat([expand, out1234, out5], 1)
-
-        net = F.relu(self.bns1(self.convs1(concat)))
+        # convs1 over [out_max repeated N times, out1234, out5] without building the (B, 9025, N) input
+        net = F.relu(self.bns1(global_point_conv(self.convs1, out_max, [out1234, out5])))
         net = F.relu(self.bns2(self.convs2(net)))
         net = F.relu(self.bns3(self.convs3(net)))
         net = self.convs4(net)
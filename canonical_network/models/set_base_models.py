@@ -1,23 +1,14 @@
-from sched import scheduler
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch_scatter as ts
 import pytorch_lightning as pl
-import torchmetrics.functional as tmf
-import wandb
-import torch_scatter as ts
-# import torchsort
 
+from canonical_network.utils import LazyModule, SequentialMultiple
 
-class SequentialMultiple(nn.Sequential):
-    def forward(self, *inputs):
-        for module in self._modules.values():
-            if type(inputs) == tuple:
-                inputs = module(*inputs)
-            else:
-                inputs = module(inputs)
-        return inputs
+ts = LazyModule("torch_scatter")
+tmf = LazyModule("torchmetrics.functional")
+wandb = LazyModule("wandb")
+# import torchsort
 
 
 # Set model base class
@@ -77,13 +68,6 @@ class BaseSetModel(pl.LightningModule):
         self.log("lr", scheduler.optimizer.param_groups[0]["lr"])
 
         predictions = validation_step_outputs[0]
-        if self.current_epoch == 0:
-            model_filename = (
-                f"canonical_network/results/digits/onnx_models/{self.model}_{wandb.run.name}_{str(self.global_step)}.onnx"
-            )
-            torch.onnx.export(self, (self.dummy_input, self.dummy_indices, 0.0), model_filename, opset_version=12)
-            wandb.save(model_filename)
-
         self.logger.experiment.log(
             {
                 "valid/logits": wandb.Histogram(predictions.to("cpu")),
@@ -125,9 +109,6 @@ class DeepSets(BaseSetModel):
         )
         self.output_layer = nn.Linear(self.hidden_dim, self.out_dim) if not self.out_dim == 1 else SequentialMultiple(nn.Linear(self.hidden_dim, self.out_dim), nn.Sigmoid())
 
-        self.dummy_input = torch.zeros(1, device=self.device, dtype=torch.long)
-        self.dummy_indices = torch.zeros(1, device=self.device, dtype=torch.long)
-
     def forward(self, x, set_indices, _):
         embeddings = self.embedding_layer(x)
         x, _ = self.set_layers(embeddings, set_indices)
@@ -147,9 +128,6 @@ class Transformer(BaseSetModel):
         self.transformer_encoder = nn.TransformerEncoder(self.transformer_layer, self.num_layers)
         self.output_layer = nn.Linear(self.hidden_dim, self.out_dim) if not self.out_dim == 1 else SequentialMultiple(nn.Linear(self.hidden_dim, self.out_dim), nn.Sigmoid())
 
-        self.dummy_input = torch.zeros((1,1), device=self.device, dtype=torch.long)
-        self.dummy_indices = torch.zeros((1,1), device=self.device, dtype=torch.long)
-
     def forward(self, x, mask, _):
         embeddings = self.embedding_layer(x)
         x = self.transformer_encoder(embeddings, src_key_padding_mask=mask)
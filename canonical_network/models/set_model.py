@@ -1,18 +1,18 @@
 from collections import namedtuple
 
-from turtle import forward
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch_scatter as ts
 import pytorch_lightning as pl
-import torchmetrics.functional as tmf
 from einops import rearrange
-import wandb
 
 from canonical_network.models.set_base_models import BaseSetModel, DeepSets, SequentialMultiple
-from canonical_network.utils import define_hyperparams, dict_to_object
+from canonical_network.utils import define_hyperparams, dict_to_object, LazyModule
+
+ts = LazyModule("torch_scatter")
+tmf = LazyModule("torchmetrics.functional")
+wandb = LazyModule("wandb")
 
 SET_HYPERPARAMS = {
     "learning_rate": 1e-3,
@@ -64,11 +64,12 @@ class SetCanonFunction(pl.LightningModule):
 
 
 class SetPredictionLayer(pl.LightningModule):
-    def __init__(self, in_dim, out_dim, num_clusters, batch_size, pooling):
+    def __init__(self, in_dim, out_dim, num_clusters, batch_size=None, pooling="sum"):
         super().__init__()
         self.in_dim = in_dim
         self.out_dim = out_dim
         self.num_clusters = num_clusters
+        # optional fixed number of sets per batch, by default they are counted from set_indices
         self.batch_size = batch_size
         self.pooling = pooling
 
@@ -77,15 +78,25 @@ class SetPredictionLayer(pl.LightningModule):
 
     def forward(self, x, clusters, set_indices):
         identity = self.identity_linear(x)
-
-        cluster_matrix = torch.zeros((x.shape[0], self.batch_size, self.num_clusters))
-        cluster_matrix[torch.arange(x.shape[0]), set_indices, :] = clusters
-
-        pooled = torch.einsum("nbk,nf->bkf", cluster_matrix, x)
+        if self.batch_size is not None:
+            num_sets = self.batch_size
+        elif torch.jit.is_tracing():
+            # a count read from set_indices would become a constant of the trace, the element count bounds it and
+            # stays dynamic
+            num_sets = x.shape[0]
+        else:
+            num_sets = int(set_indices.max()) + 1
+
+        # cluster weighted features summed per set, one cluster at a time so nothing larger than x is allocated
+        pooled = torch.stack([
+            x.new_zeros(num_sets, self.in_dim).index_add(0, set_indices, clusters[:, k, None] * x)
+            for k in range(self.num_clusters)
+        ], dim=1)
         pooled = rearrange(pooled, "b k f -> b (k f)")
         outer = self.outer_linear(pooled)
         outer = rearrange(outer, "b (k f) -> b k f", k=self.num_clusters, f=self.out_dim)
-        outer = torch.einsum("nbk, bkf->nf", cluster_matrix, outer)
+        # every element reads back the outputs of its own set, weighted by its clusters
+        outer = sum(clusters[:, k, None] * outer[:, k][set_indices] for k in range(self.num_clusters))
 
         # residual connection
         output = F.relu(identity + outer) + x
@@ -96,7 +107,6 @@ class SetPredictionLayer(pl.LightningModule):
 class SetPredictionFunction(pl.LightningModule):
     def __init__(self, hyperparams):
         super().__init__()
-        self.batch_size = hyperparams.batch_size
         self.num_clusters = hyperparams.num_clusters
         self.num_embeddings = hyperparams.num_embeddings
         self.num_layers = hyperparams.num_layers
@@ -108,9 +118,7 @@ class SetPredictionFunction(pl.LightningModule):
         self.embedding_layer = nn.Embedding(self.num_embeddings, self.hidden_dim)
         self.set_layers = SequentialMultiple(
             *[
-                SetPredictionLayer(
-                    self.hidden_dim, self.hidden_dim, self.num_clusters, self.batch_size, self.layer_pooling
-                )
+                SetPredictionLayer(self.hidden_dim, self.hidden_dim, self.num_clusters, pooling=self.layer_pooling)
                 for i in range(self.num_layers - 1)
             ]
         )
@@ -132,7 +140,6 @@ class SetModel(BaseSetModel):
         self.canon_function = SetCanonFunction(hyperparams)
         self.prediction_function = SetPredictionFunction(hyperparams)
         self.learning_rate = hyperparams.learning_rate
-        self.batch_size = hyperparams.batch_size
         self.num_embeddings = hyperparams.num_embeddings
 
     def forward(self, x, set_indices, batch_idx):
@@ -149,15 +156,6 @@ class SetModel(BaseSetModel):
         self.log("lr", scheduler.optimizer.param_groups[0]["lr"])
 
         predictions, clusters = validation_step_outputs[0]
-        if self.current_epoch == 0:
-            dummy_input = torch.zeros(self.num_embeddings, device=self.device, dtype=torch.long)
-            dummy_indices = torch.zeros(1, device=self.device, dtype=torch.long)
-            model_filename = (
-                f"canonical_network/results/digits/onnx_models/set_model_{wandb.run.name}_{str(self.global_step)}.onnx"
-            )
-            torch.onnx.export(self, (dummy_input, dummy_indices, 0.0), model_filename, opset_version=12)
-            wandb.save(model_filename)
-
         self.logger.experiment.log(
             {
                 "valid/logits": wandb.Histogram(predictions.to("cpu")),
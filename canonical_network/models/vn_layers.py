@@ -1,26 +1,72 @@
 import os
 import sys
 import copy
+import functools
 import math
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from canonical_network.utils import vn_edge_linear
+
 EPS = 1e-6
 
+# The layers below take `fused=True` by default: channel maps are a single einsum over the channel axis instead of
+# transpose -> nn.Linear -> transpose, and the nonlinearities are one scripted elementwise expression. `fused=False`
+# keeps the reference implementation, tests/test_vn_layers.py checks that both agree in values and gradients.
+
+
+def vn_linear(x, weight):
+    '''
+    x: point features of shape [B, N_feat, 3, N_samples, ...], weight: [N_out, N_feat]
+    '''
+    return torch.einsum("oc,bc...->bo...", weight, x)
+
+
+def _vn_leaky_relu(p, d, negative_slope: float, eps: float = 1e-6):
+    dotprod = (p * d).sum(2, keepdim=True)
+    d_norm_sq = (d * d).sum(2, keepdim=True)
+    coefficient = torch.where(dotprod >= 0, torch.zeros_like(dotprod), dotprod / (d_norm_sq + eps))
+    return p - (1 - negative_slope) * coefficient * d
+
+
+@functools.lru_cache(maxsize=None)
+def _scripted_vn_leaky_relu():
+    # scripted on first use rather than at import, which would add the compilation to every import of the package
+    return torch.jit.script(_vn_leaky_relu)
+
+
+def vn_leaky_relu(p, d, negative_slope, eps=EPS):
+    '''
+    Keeps p where it points along d and removes its component along d elsewhere, blended with negative_slope * p.
+    negative_slope * p + (1 - negative_slope) * (mask * p + (1 - mask) * (p - <p, d> / |d|^2 d)) only differs from p
+    by a multiple of d, so the whole activation is one coefficient per vector and a single multiply-subtract.
+    '''
+    return _scripted_vn_leaky_relu()(p, d, float(negative_slope), float(eps))
+
+
 class VNLinear(nn.Module):
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, fused=True):
         super(VNLinear, self).__init__()
         self.map_to_feat = nn.Linear(in_channels, out_channels, bias=False)
+        self.fused = fused
     
     def forward(self, x):
         '''
         x: point features of shape [B, N_feat, 3, N_samples, ...]
         '''
+        if self.fused:
+            return vn_linear(x, self.map_to_feat.weight)
         x_out = self.map_to_feat(x.transpose(1,-1)).transpose(1,-1)
         return x_out
 
+    def forward_edge(self, x, k=20, idx=None):
+        '''
+        x: point features of shape [B, N_feat, 3, N_samples], same as forward(get_graph_feature_cross(x, k, idx))
+        '''
+        return vn_edge_linear(x, self.map_to_feat.weight, k=k, idx=idx)
+
 
 class VNBilinear(nn.Module):
     def __init__(self, in_channels1, in_channels2, out_channels):
@@ -37,19 +83,23 @@ class VNBilinear(nn.Module):
 
 
 class VNSoftplus(nn.Module):
-    def __init__(self, in_channels, share_nonlinearity=False, negative_slope=0.0):
+    def __init__(self, in_channels, share_nonlinearity=False, negative_slope=0.0, fused=True):
         super(VNSoftplus, self).__init__()
         if share_nonlinearity == True:
             self.map_to_dir = nn.Linear(in_channels, 1, bias=False)
         else:
             self.map_to_dir = nn.Linear(in_channels, in_channels, bias=False)
         self.negative_slope = negative_slope
+        self.fused = fused
     
     def forward(self, x):
         '''
         x: point features of shape [B, N_feat, 3, N_samples, ...]
         '''
-        d = self.map_to_dir(x.transpose(1,-1)).transpose(1,-1)
+        if self.fused:
+            d = vn_linear(x, self.map_to_dir.weight)
+        else:
+            d = self.map_to_dir(x.transpose(1,-1)).transpose(1,-1)
         dotprod = (x*d).sum(2, keepdim=True)
         angle_between = torch.acos(dotprod / (torch.norm(x, dim=2, keepdim=True) * torch.norm(d, dim=2, keepdim=True) + EPS))
         mask = torch.cos(angle_between / 2) ** 2
@@ -59,18 +109,21 @@ class VNSoftplus(nn.Module):
 
 
 class VNLeakyReLU(nn.Module):
-    def __init__(self, in_channels, share_nonlinearity=False, negative_slope=0.2):
+    def __init__(self, in_channels, share_nonlinearity=False, negative_slope=0.2, fused=True):
         super(VNLeakyReLU, self).__init__()
         if share_nonlinearity == True:
             self.map_to_dir = nn.Linear(in_channels, 1, bias=False)
         else:
             self.map_to_dir = nn.Linear(in_channels, in_channels, bias=False)
         self.negative_slope = negative_slope
+        self.fused = fused
     
     def forward(self, x):
         '''
         x: point features of shape [B, N_feat, 3, N_samples, ...]
         '''
+        if self.fused:
+            return vn_leaky_relu(x, vn_linear(x, self.map_to_dir.weight), self.negative_slope, EPS)
         d = self.map_to_dir(x.transpose(1,-1)).transpose(1,-1)
         dotprod = (x*d).sum(2, keepdim=True)
         mask = (dotprod >= 0).float()
@@ -80,13 +133,14 @@ class VNLeakyReLU(nn.Module):
 
 
 class VNLinearLeakyReLU(nn.Module):
-    def __init__(self, in_channels, out_channels, dim=5, share_nonlinearity=False, negative_slope=0.2):
+    def __init__(self, in_channels, out_channels, dim=5, share_nonlinearity=False, negative_slope=0.2, fused=True):
         super(VNLinearLeakyReLU, self).__init__()
         self.dim = dim
         self.negative_slope = negative_slope
+        self.fused = fused
         
         self.map_to_feat = nn.Linear(in_channels, out_channels, bias=False)
-        self.batchnorm = VNBatchNorm(out_channels, dim=dim)
+        self.batchnorm = VNBatchNorm(out_channels, dim=dim, fused=fused)
         
         if share_nonlinearity == True:
             self.map_to_dir = nn.Linear(in_channels, 1, bias=False)
@@ -98,11 +152,35 @@ class VNLinearLeakyReLU(nn.Module):
         x: point features of shape [B, N_feat, 3, N_samples, ...]
         '''
         # Linear
-        p = self.map_to_feat(x.transpose(1,-1)).transpose(1,-1)
+        if self.fused:
+            # feature and direction maps as one projection
+            p, d = vn_linear(x, self.projection_weight()).split(
+                [self.map_to_feat.out_features, self.map_to_dir.out_features], dim=1
+            )
+        else:
+            p = self.map_to_feat(x.transpose(1,-1)).transpose(1,-1)
+            d = self.map_to_dir(x.transpose(1,-1)).transpose(1,-1)
+        return self.batchnorm_leaky_relu(p, d)
+
+    def forward_edge(self, x, k=20, idx=None):
+        '''
+        x: point features of shape [B, N_feat, 3, N_samples], same as forward(get_graph_feature_cross(x, k, idx))
+        '''
+        # both linear maps in one pass over the neighbourhoods
+        p, d = vn_edge_linear(x, self.projection_weight(), k=k, idx=idx).split(
+            [self.map_to_feat.out_features, self.map_to_dir.out_features], dim=1
+        )
+        return self.batchnorm_leaky_relu(p, d)
+
+    def projection_weight(self):
+        return torch.cat((self.map_to_feat.weight, self.map_to_dir.weight), dim=0)
+
+    def batchnorm_leaky_relu(self, p, d):
         # BatchNorm
         p = self.batchnorm(p)
         # LeakyReLU
-        d = self.map_to_dir(x.transpose(1,-1)).transpose(1,-1)
+        if self.fused:
+            return vn_leaky_relu(p, d, self.negative_slope, EPS)
         dotprod = (p*d).sum(2, keepdims=True)
         mask = (dotprod >= 0).float()
         d_norm_sq = (d*d).sum(2, keepdims=True)
@@ -141,9 +219,10 @@ class VNLinearAndLeakyReLU(nn.Module):
 
 
 class VNBatchNorm(nn.Module):
-    def __init__(self, num_features, dim):
+    def __init__(self, num_features, dim, fused=True):
         super(VNBatchNorm, self).__init__()
         self.dim = dim
+        self.fused = fused
         if dim == 3 or dim == 4:
             self.bn = nn.BatchNorm1d(num_features)
         elif dim == 5:
@@ -156,6 +235,9 @@ class VNBatchNorm(nn.Module):
         # norm = torch.sqrt((x*x).sum(2))
         norm = torch.norm(x, dim=2) + EPS
         norm_bn = self.bn(norm)
+        if self.fused:
+            # one rescale per vector instead of a divide and a multiply over the whole feature map
+            return x * (norm_bn / norm).unsqueeze(2)
         norm = norm.unsqueeze(2)
         norm_bn = norm_bn.unsqueeze(2)
         x = x / norm * norm_bn
@@ -168,15 +250,17 @@ class VNMaxPool(nn.Module):
         super(VNMaxPool, self).__init__()
         self.map_to_dir = nn.Linear(in_channels, in_channels, bias=False)
     
-    def forward(self, x):
+    def forward(self, x, return_indices=False):
         '''
         x: point features of shape [B, N_feat, 3, N_samples, ...]
+        return_indices: also return the selected positions along the last axis, of shape [B, N_feat, 1, N_samples, ...]
         '''
-        d = self.map_to_dir(x.transpose(1,-1)).transpose(1,-1)
+        d = vn_linear(x, self.map_to_dir.weight)
         dotprod = (x*d).sum(2, keepdims=True)
-        idx = dotprod.max(dim=-1, keepdim=False)[1]
-        index_tuple = torch.meshgrid([torch.arange(j) for j in x.size()[:-1]]) + (idx,)
-        x_max = x[index_tuple]
+        idx = dotprod.max(dim=-1, keepdim=True)[1]
+        x_max = x.gather(-1, idx.expand(*x.shape[:-1], 1)).squeeze(-1)
+        if return_indices:
+            return x_max, idx.squeeze(-1)
         return x_max
 
 
@@ -204,7 +288,7 @@ class VNStdFeature(nn.Module):
         z0 = x
         z0 = self.vn1(z0)
         z0 = self.vn2(z0)
-        z0 = self.vn_lin(z0.transpose(1, -1)).transpose(1, -1)
+        z0 = vn_linear(z0, self.vn_lin.weight)
         
         if self.normalize_frame:
             # make z0 orthogonal. u2 = v2 - proj_u1(v2)
@@ -231,4 +315,4 @@ class VNStdFeature(nn.Module):
         elif self.dim == 5:
             x_std = torch.einsum('bijmn,bjkmn->bikmn', x, z0)
         
-        return x_std, z0
\ No newline at end of file
+        return x_std, z0
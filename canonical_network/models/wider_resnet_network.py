@@ -3,7 +3,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from scipy import stats
+from canonical_network.utils import LazyModule
+
+stats = LazyModule("scipy.stats")
 
 
 __all__ = [
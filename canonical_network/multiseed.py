@@ -0,0 +1,202 @@
+import contextlib
+import json
+import multiprocessing as mp
+import os
+import time
+import traceback
+from argparse import ArgumentParser
+from multiprocessing.connection import wait
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+
+def get_hyperparams():
+    parser = ArgumentParser(description="Trains one program with several seeds in parallel, on a dataset loaded once "
+                                        "and shared with the forked runs, and reports mean/std of the final metrics. "
+                                        "Arguments not listed here are passed to the training script.")
+    parser.add_argument("--program", type=str, default="nbody", help="training script 1)nbody 2)images 3)modelnet 4)shapenet")
+    parser.add_argument("--seeds", type=str, default="0,1,2,3", help="comma separated seeds, one run each")
+    parser.add_argument("--num_parallel", type=int, default=0, help="runs at the same time [default: 0, all seeds]")
+    parser.add_argument("--threads_per_run", type=int, default=0,
+                        help="torch cpu threads per run [default: 0, the cores split between the parallel runs]")
+    parser.add_argument("--pin_cpus", type=int, default=1, help="pin every run to its own set of cores")
+    parser.add_argument("--overrides", type=str, default="{}",
+                        help="json dict of hyperparameters for train_nbody (data_path also sets the dataset directory), "
+                             "e.g. '{\"num_epochs\": 100}'")
+    parser.add_argument("--output_path", type=str, default="canonical_network/results/multiseed",
+                        help="directory for the run logs and the results json")
+    return parser.parse_known_args()
+
+
+class PreparedDataModule(pl.LightningDataModule):
+    """ Wraps a data module whose datasets are already loaded, so every run reuses them instead of loading again. """
+    def __init__(self, data_module):
+        super().__init__()
+        self.data_module = data_module
+
+    def setup(self, stage=None):
+        pass
+
+    def train_dataloader(self):
+        return self.data_module.train_dataloader()
+
+    def val_dataloader(self):
+        return self.data_module.val_dataloader()
+
+    def test_dataloader(self):
+        return self.data_module.test_dataloader()
+
+
+def prepare_data(program, script_args, overrides):
+    """
+    Loads the datasets of `program` once. Runs are forked afterwards, so they map the loaded arrays copy-on-write
+    instead of reading and preprocessing the files again; the n-body tensors are moved to shared memory as well.
+    Called with a single torch thread, see `main`.
+    """
+    if program == "nbody":
+        from canonical_network.prepare.nbody_data import NBodyDataset
+        data_path = overrides.get("data_path")
+        return NBodyDataset(partition="train", data_path=data_path).share_memory(), \
+            NBodyDataset(partition="val", data_path=data_path).share_memory()
+
+    if program == "images":
+        from canonical_network import train_images
+        hyperparams = train_images.get_hyperparams(script_args)
+        hyperparams.data_path = hyperparams.data_path + "/" + hyperparams.dataset
+        data = train_images.get_image_data(hyperparams)
+    elif program == "modelnet":
+        from canonical_network import train_modelnet
+        from canonical_network.prepare.modelnet_data import ModelNetDataModule
+        data = ModelNetDataModule(train_modelnet.get_hyperparams(script_args))
+    elif program == "shapenet":
+        from canonical_network import train_shapenet
+        from canonical_network.prepare.shapenet_data import ShapenetPartDataModule
+        data = ShapenetPartDataModule(train_shapenet.get_hyperparams(script_args))
+    else:
+        raise NotImplementedError(f"Unknown program {program}")
+    data.setup("fit")
+    data.setup("test")
+    return PreparedDataModule(data)
+
+
+def train_seed(program, seed, data, script_args, overrides):
+    if program == "nbody":
+        from canonical_network.train_nbody import train_nbody
+        train_dataset, valid_dataset = data
+        return train_nbody({**overrides, "seed": seed}, (), train_dataset, valid_dataset)
+    # the last occurrence of an argument wins
+    args = script_args + ["--seed", str(seed)]
+    if program == "images":
+        from canonical_network.train_images import train_images
+        return train_images(args, data)
+    elif program == "modelnet":
+        from canonical_network.train_modelnet import train_pointnet
+        return train_pointnet(args, data)
+    else:
+        from canonical_network.train_shapenet import train_pointnet
+        return train_pointnet(args, data)
+
+
+def run_seed(program, seed, data, script_args, overrides, cpus, num_threads, log_path, connection):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    start = time.perf_counter()
+    result = {"seed": seed, "cpus": sorted(cpus) if cpus else None}
+    with open(log_path, "w") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            trainer = train_seed(program, seed, data, script_args, overrides)
+            result["metrics"] = {name: float(value) for name, value in trainer.callback_metrics.items()
+                                 if torch.is_tensor(value) and value.numel() == 1}
+        except Exception as e:
+            traceback.print_exc()
+            result["error"] = f"{type(e).__name__}: {e}"
+    result["time_s"] = time.perf_counter() - start
+    connection.send(result)
+    connection.close()
+
+
+def assign_cpus(num_runs, num_threads, pin):
+    """ Disjoint core sets of `num_threads` cores per run, wrapping around when the runs need more than there are. """
+    if not pin or not hasattr(os, "sched_getaffinity"):
+        return [None] * num_runs
+    cores = sorted(os.sched_getaffinity(0))
+    return [{cores[(run * num_threads + i) % len(cores)] for i in range(num_threads)} for run in range(num_runs)]
+
+
+def aggregate(results):
+    """ Mean, std (over seeds), min and max of every metric reported by all successful runs. """
+    runs = [result["metrics"] for result in results if "metrics" in result]
+    if not runs:
+        return {}
+    names = sorted(set.intersection(*[set(metrics) for metrics in runs]))
+    summary = {}
+    for name in names:
+        values = np.array([metrics[name] for metrics in runs])
+        summary[name] = {
+            "mean": float(values.mean()),
+            "std": float(values.std(ddof=1)) if len(values) > 1 else 0.0,
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "num_seeds": len(values),
+        }
+    return summary
+
+
+def main():
+    hyperparams, script_args = get_hyperparams()
+    overrides = json.loads(hyperparams.overrides)
+    seeds = [int(seed) for seed in hyperparams.seeds.split(",")]
+    num_parallel = hyperparams.num_parallel or len(seeds)
+    num_threads = hyperparams.threads_per_run or max(len(os.sched_getaffinity(0)) // num_parallel, 1)
+    cpu_sets = assign_cpus(num_parallel, num_threads, hyperparams.pin_cpus)
+
+    run_path = os.path.join(hyperparams.output_path, f"{hyperparams.program}_{time.strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(run_path, exist_ok=True)
+    start = time.perf_counter()
+    # the runs are forked after loading, and forking a process whose OpenMP thread pool is already running can
+    # deadlock the children with GNU OpenMP. With one thread the parent never starts the pool, every run sets its
+    # own thread count after the fork
+    torch.set_num_threads(1)
+    data = prepare_data(hyperparams.program, script_args, overrides)
+    print(f"Loaded the {hyperparams.program} data in {time.perf_counter() - start:.1f}s, training seeds {seeds} "
+          f"{num_parallel} at a time with {num_threads} threads each, logs in {run_path}")
+
+    # fork so the runs inherit the loaded data instead of receiving a pickled copy
+    context = mp.get_context("fork")
+    results, running, pending = [], {}, list(seeds)
+    free_slots = list(range(num_parallel))
+    while pending or running:
+        while pending and free_slots:
+            seed, slot = pending.pop(0), free_slots.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_seed, args=(
+                hyperparams.program, seed, data, script_args, overrides, cpu_sets[slot], num_threads,
+                os.path.join(run_path, f"seed_{seed}.log"), sender))
+            process.start()
+            sender.close()
+            running[receiver] = (process, seed, slot)
+        for receiver in wait(list(running)):
+            process, seed, slot = running.pop(receiver)
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = {"seed": seed, "error": "the run exited without a result"}
+            process.join()
+            free_slots.append(slot)
+            results.append(result)
+            print(f"seed {seed}: " + (result["error"] if "error" in result else f"done in {result['time_s']:.0f}s"))
+
+    summary = aggregate(results)
+    for name, stats in summary.items():
+        print(f"{name}: {stats['mean']:.4g} +- {stats['std']:.4g} over {stats['num_seeds']} seeds")
+    with open(os.path.join(run_path, "results.json"), "w") as f:
+        json.dump({"program": hyperparams.program, "script_args": script_args, "overrides": overrides,
+                   "summary": summary, "runs": sorted(results, key=lambda result: result["seed"]),
+                   "wall_time_s": time.perf_counter() - start}, f, indent=2)
+    print(f"Saved {os.path.join(run_path, 'results.json')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import pytorch_lightning as pl
 from torch.utils.data import DataLoader, random_split
 from torchvision import transforms
 from torchvision.datasets import CIFAR10
+import canonical_network.utils as utils
 import os
 
 
@@ -41,28 +42,34 @@ class CIFAR10DataModule(pl.LightningDataModule):
             print('Test dataset size: ', len(self.test_dataset))
 
     def train_dataloader(self):
+        sampler = utils.get_sampler(self.train_dataset, shuffle=True, seed=self.hyperparams.seed)
         train_loader = DataLoader(
             self.train_dataset,
             self.hyperparams.batch_size,
-            shuffle=True,
+            shuffle=sampler is None,
+            sampler=sampler,
             num_workers=self.hyperparams.num_workers,
         )
         return train_loader
 
     def val_dataloader(self):
+        sampler = utils.get_sampler(self.valid_dataset, shuffle=False)
         valid_loader = DataLoader(
             self.valid_dataset,
             self.hyperparams.batch_size,
             shuffle=False,
+            sampler=sampler,
             num_workers=self.hyperparams.num_workers,
         )
         return valid_loader
 
     def test_dataloader(self):
+        sampler = utils.get_sampler(self.test_dataset, shuffle=False)
         test_loader = DataLoader(
             self.test_dataset,
             self.hyperparams.batch_size,
             shuffle=False,
+            sampler=sampler,
             num_workers=self.hyperparams.num_workers,
         )
         return test_loader
\ No newline at end of file
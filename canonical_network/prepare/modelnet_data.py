@@ -1,10 +1,16 @@
 import numpy as np
 import warnings
 import os
+from argparse import ArgumentParser
+import torch
 from torch.utils.data import Dataset, DataLoader
 warnings.filterwarnings('ignore')
 import pytorch_lightning as pl
 
+import canonical_network.utils as utils
+from canonical_network.prepare.packed_store import PackedPointCloudWriter, PackedPointCloudStore
+from canonical_network.prepare.sample_cache import make_sample_cache, split_cache_budget
+
 
 
 def pc_normalize(pc):
@@ -14,79 +20,139 @@ def pc_normalize(pc):
     pc = pc / m
     return pc
 
+def farthest_point_sample_index(point, npoint, rng=np.random):
+    """
+    Input:
+        xyz: pointcloud data, [N, D]
+        npoint: number of samples
+        rng: random state used to draw the starting point
+    Return:
+        centroids: sampled pointcloud index, [npoint]
+    """
+    xyz = torch.from_numpy(np.ascontiguousarray(point[:, :3], dtype=np.float32)).unsqueeze(0)
+    start_index = torch.tensor([rng.randint(0, point.shape[0])])
+    centroids = utils.farthest_point_sample(xyz, npoint, start_index=start_index)
+    return centroids[0].numpy().astype(np.int32)
+
 def farthest_point_sample(point, npoint):
     """
     Input:
         xyz: pointcloud data, [N, D]
         npoint: number of samples
     Return:
-        centroids: sampled pointcloud index, [npoint, D]
+        centroids: sampled pointcloud, [npoint, D]
+    """
+    return point[farthest_point_sample_index(point, npoint)]
+
+def read_shape_ids(root, split):
+    shape_ids = [line.rstrip() for line in open(os.path.join(root, 'modelnet40_%s.txt' % split))]
+    shape_names = ['_'.join(x.split('_')[0:-1]) for x in shape_ids]
+    # list of (shape_name, shape_txt_file_path) tuple
+    return [(shape_names[i], os.path.join(root, shape_names[i], shape_ids[i]) + '.txt') for i in range(len(shape_ids))]
+
+def pack_modelnet_split(root, out_root, split='train', fps_npoints=(1024,), seed=0):
+    """
+    Converts one ModelNet40 split from per-shape .txt files to a packed, memory-mappable store (see
+    `PackedPointCloudWriter`). Farthest point sampling indices are precomputed for every value in `fps_npoints`
+    and stored as `fps_<npoints>`.
     """
-    N, D = point.shape
-    xyz = point[:,:3]
-    centroids = np.zeros((npoint,))
-    distance = np.ones((N,)) * 1e10
-    farthest = np.random.randint(0, N)
-    for i in range(npoint):
-        centroids[i] = farthest
-        centroid = xyz[farthest, :]
-        dist = np.sum((xyz - centroid) ** 2, -1)
-        mask = dist < distance
-        distance[mask] = dist[mask]
-        farthest = np.argmax(distance, -1)
-    point = point[centroids.astype(np.int32)]
-    return point
+    categories = [line.rstrip() for line in open(os.path.join(root, 'modelnet40_shape_names.txt'))]
+    classes = dict(zip(categories, range(len(categories))))
+    datapath = read_shape_ids(root, split)
+    rng = np.random.RandomState(seed)
+
+    writer = PackedPointCloudWriter(os.path.join(out_root, split), num_channels=6)
+    for i, (shape_name, fn) in enumerate(datapath):
+        point_set = np.loadtxt(fn, delimiter=',').astype(np.float32)
+        sample_fields = {'label': np.int32(classes[shape_name])}
+        for npoints in fps_npoints:
+            sample_fields['fps_%d' % npoints] = farthest_point_sample_index(point_set, npoints, rng)
+        writer.append(point_set, sample_fields=sample_fields)
+        if (i + 1) % 1000 == 0:
+            print('Packed %d/%d %s shapes' % (i + 1, len(datapath), split))
+    writer.close(meta={'categories': categories, 'fps_npoints': list(fps_npoints)})
 
 class ModelNetDataseet(Dataset):
-    def __init__(self, root,  npoints=1024, split='train', uniform=False, normal_channel=True, cache_size=15000):
+    def __init__(self, root,  npoints=1024, split='train', uniform=False, normal_channel=True, cache_size=15000,
+                 packed_root=None, cache_backend='local', cache_bytes=2**30, knn_k=0):
         self.root = root
         self.npoints = npoints
         self.uniform = uniform
-        self.catfile = os.path.join(self.root, 'modelnet40_shape_names.txt')
-
-        self.cat = [line.rstrip() for line in open(self.catfile)]
-        self.classes = dict(zip(self.cat, range(len(self.cat))))
         self.normal_channel = normal_channel
-
-        shape_ids = {}
-        shape_ids['train'] = [line.rstrip() for line in open(os.path.join(self.root, 'modelnet40_train.txt'))]
-        shape_ids['test'] = [line.rstrip() for line in open(os.path.join(self.root, 'modelnet40_test.txt'))]
+        # when > 0, the input-coordinate knn graph of every sample is computed once and returned with it
+        self.knn_k = knn_k
 
         assert (split == 'train' or split == 'test')
-        shape_names = ['_'.join(x.split('_')[0:-1]) for x in shape_ids[split]]
-        # list of (shape_name, shape_txt_file_path) tuple
-        self.datapath = [(shape_names[i], os.path.join(self.root, shape_names[i], shape_ids[split][i]) + '.txt') for i
-                         in range(len(shape_ids[split]))]
-        print('The size of %s data is %d'%(split,len(self.datapath)))
+        if packed_root:
+            # packed store written by `pack_modelnet_split`, no per-shape files are touched
+            self.store = PackedPointCloudStore(os.path.join(packed_root, split))
+            self.cat = self.store.meta['categories']
+            self.datapath = None
+        else:
+            self.store = None
+            self.catfile = os.path.join(self.root, 'modelnet40_shape_names.txt')
+            self.cat = [line.rstrip() for line in open(self.catfile)]
+            self.datapath = read_shape_ids(self.root, split)
+        self.classes = dict(zip(self.cat, range(len(self.cat))))
+        print('The size of %s data is %d'%(split,len(self)))
 
         self.cache_size = cache_size  # how many data points to cache in memory
-        self.cache = {}  # from index to (point_set, cls) tuple
+        self.cache_backend = cache_backend
+        # clouds are cut to npoints, so that bounds every cached (point_set, cls[, knn_idx]) tuple
+        self.slot_bytes = self.npoints * ((6 if normal_channel else 3) + self.knn_k) * 4 + 1024
+        # None leaves the cache to `make_caches`, for data modules sharing one budget between their datasets
+        if cache_bytes is not None:
+            self.make_caches(cache_bytes)
+
+    def cache_demand(self):
+        return len(self) * self.slot_bytes
+
+    def make_caches(self, cache_bytes):
+        # from index to (point_set, cls[, knn_idx]) tuple, either per worker or shared by all workers up to
+        # `cache_bytes`
+        self.cache = make_sample_cache(self.cache_backend, len(self), self.cache_size, cache_bytes, self.slot_bytes)
 
     def __len__(self):
-        return len(self.datapath)
+        return len(self.store) if self.store is not None else len(self.datapath)
+
+    def _load_packed(self, index):
+        cls = np.array([self.store.get_sample_field('label', index)]).astype(np.int32)
+        points = self.store.get_points(index)
+        fps_field = 'fps_%d' % self.npoints
+        if self.uniform and self.store.has_field(fps_field):
+            point_set = points[self.store.get_sample_field(fps_field, index)]
+        elif self.uniform:
+            point_set = farthest_point_sample(np.array(points), self.npoints)
+        else:
+            point_set = np.array(points[0:self.npoints, :])
+        return point_set, cls
 
     def _get_item(self, index):
-        if index in self.cache:
-            point_set, cls = self.cache[index]
+        cached = self.cache.get(index)
+        if cached is not None:
+            point_set, cls, *knn_idx = cached
         else:
-            fn = self.datapath[index]
-            cls = self.classes[self.datapath[index][0]]
-            cls = np.array([cls]).astype(np.int32)
-            point_set = np.loadtxt(fn[1], delimiter=',').astype(np.float32)
-            if self.uniform:
-                point_set = farthest_point_sample(point_set, self.npoints)
+            if self.store is not None:
+                point_set, cls = self._load_packed(index)
             else:
-                point_set = point_set[0:self.npoints,:]
+                fn = self.datapath[index]
+                cls = self.classes[self.datapath[index][0]]
+                cls = np.array([cls]).astype(np.int32)
+                point_set = np.loadtxt(fn[1], delimiter=',').astype(np.float32)
+                if self.uniform:
+                    point_set = farthest_point_sample(point_set, self.npoints)
+                else:
+                    point_set = point_set[0:self.npoints,:]
 
             point_set[:, 0:3] = pc_normalize(point_set[:, 0:3])
 
             if not self.normal_channel:
                 point_set = point_set[:, 0:3]
 
-            if len(self.cache) < self.cache_size:
-                self.cache[index] = (point_set, cls)
+            knn_idx = [utils.point_cloud_knn(point_set[:, 0:3], self.knn_k).astype(np.int32)] if self.knn_k else []
+            self.cache.put(index, (point_set, cls, *knn_idx))
 
-        return point_set, cls
+        return (point_set, cls, *knn_idx)
 
     def __getitem__(self, index):
         return self._get_item(index)
@@ -98,44 +164,76 @@ class ModelNetDataModule(pl.LightningDataModule):
         self.hyperparams = hyperparams
 
     def setup(self, stage=None):
+        # --cache_bytes is the budget of the whole run, split between the datasets in proportion to their size
         if stage == "fit" or stage is None:
-            self.train_dataset = ModelNetDataseet(
-                root=self.data_path, npoints=self.hyperparams.num_points, split="train",
-                normal_channel=self.hyperparams.normal_channel
-            )
-            self.valid_dataset = ModelNetDataseet(
-                root=self.data_path, npoints=self.hyperparams.num_points, split="test",
-                normal_channel=self.hyperparams.normal_channel
-            )
+            self.train_dataset = self.make_dataset("train")
+            self.valid_dataset = self.make_dataset("test")
+            self.make_caches([self.train_dataset, self.valid_dataset])
         if stage == "test":
-            self.test_dataset = ModelNetDataseet(
-                root=self.data_path, npoints=self.hyperparams.num_points, split="test",
-                normal_channel=self.hyperparams.normal_channel
-            )
+            # validation already runs on the test split, reuse it and its cache
+            self.test_dataset = getattr(self, "valid_dataset", None)
+            if self.test_dataset is None:
+                self.test_dataset = self.make_dataset("test")
+                self.make_caches([self.test_dataset])
+
+    def make_dataset(self, split):
+        return ModelNetDataseet(
+            root=self.data_path, npoints=self.hyperparams.num_points, split=split,
+            normal_channel=self.hyperparams.normal_channel, uniform=self.hyperparams.uniform,
+            packed_root=self.hyperparams.packed_data_path or None,
+            cache_backend=self.hyperparams.cache_backend, cache_bytes=None,
+            knn_k=self.hyperparams.n_knn if self.hyperparams.cache_input_knn else 0
+        )
+
+    def make_caches(self, datasets):
+        budgets = split_cache_budget(self.hyperparams.cache_bytes, [dataset.cache_demand() for dataset in datasets])
+        for dataset, cache_bytes in zip(datasets, budgets):
+            dataset.make_caches(cache_bytes)
 
     def train_dataloader(self):
+        sampler = utils.get_sampler(self.train_dataset, shuffle=True, seed=self.hyperparams.seed)
         train_loader = DataLoader(
             self.train_dataset,
             batch_size=self.hyperparams.batch_size,
-            shuffle=True,
+            shuffle=sampler is None,
+            sampler=sampler,
             num_workers=self.hyperparams.num_workers,
         )
         return train_loader
 
     def val_dataloader(self):
+        sampler = utils.get_sampler(self.valid_dataset, shuffle=False)
         valid_loader = DataLoader(
             self.valid_dataset,
             batch_size=self.hyperparams.batch_size,
             shuffle=False,
+            sampler=sampler,
             num_workers=self.hyperparams.num_workers,
         )
         return valid_loader
 
     def test_dataloader(self):
+        sampler = utils.get_sampler(self.test_dataset, shuffle=False)
         test_loader = DataLoader(
             self.test_dataset,
             batch_size=self.hyperparams.batch_size,
             shuffle=False,
+            sampler=sampler,
             num_workers=self.hyperparams.num_workers,
         )
-        return test_loader
\ No newline at end of file
+        return test_loader
+
+def main():
+    parser = ArgumentParser(description="Pack ModelNet40 into a memory-mapped store with precomputed FPS indices")
+    parser.add_argument("--data_path", type=str, required=True, help="path to modelnet40_normal_resampled")
+    parser.add_argument("--out_path", type=str, required=True, help="where to write the packed splits")
+    parser.add_argument("--fps_npoints", type=int, nargs="*", default=[1024],
+                        help="number of points to precompute farthest point samples for")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the farthest point sampling start points")
+    args = parser.parse_args()
+    for split in ("train", "test"):
+        pack_modelnet_split(args.data_path, args.out_path, split, args.fps_npoints, args.seed)
+
+
+if __name__ == "__main__":
+    main()
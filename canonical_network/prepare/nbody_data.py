@@ -10,8 +10,9 @@ from torch.utils.data import Dataset
 import canonical_network.utils as utils
 
 class NBodyDataset():
-    def __init__(self, partition='train', max_samples=3000, dataset_name="nbody_small"):
+    def __init__(self, partition='train', max_samples=3000, dataset_name="nbody_small", data_path=None):
         self.partition = partition
+        self.data_path = data_path or utils.DATA_PATH / 'n_body_system/dataset'
         if self.partition == 'val':
             self.sufix = 'valid'
         else:
@@ -29,10 +30,10 @@ class NBodyDataset():
         self.data, self.edges = self.load()
 
     def load(self):
-        loc = np.load(utils.DATA_PATH / f'n_body_system/dataset/loc_{self.sufix}.npy')
-        vel = np.load(utils.DATA_PATH / f'n_body_system/dataset/vel_{self.sufix}.npy')
-        edges = np.load(utils.DATA_PATH / f'n_body_system/dataset/edges_{self.sufix}.npy')
-        charges = np.load(utils.DATA_PATH / f'n_body_system/dataset/charges_{self.sufix}.npy')
+        loc = np.load(os.path.join(self.data_path, f'loc_{self.sufix}.npy'))
+        vel = np.load(os.path.join(self.data_path, f'vel_{self.sufix}.npy'))
+        edges = np.load(os.path.join(self.data_path, f'edges_{self.sufix}.npy'))
+        charges = np.load(os.path.join(self.data_path, f'charges_{self.sufix}.npy'))
 
         loc, vel, edge_attr, edges, charges = self.preprocess(loc, vel, edges, charges)
         return (loc, vel, edge_attr, charges), edges
@@ -69,6 +70,12 @@ class NBodyDataset():
 
         return torch.Tensor(loc), torch.Tensor(vel), torch.Tensor(edge_attr), edges, torch.Tensor(charges)
 
+    def share_memory(self):
+        """ Moves the tensors to shared memory, so processes receiving the dataset map them instead of copying. """
+        for tensor in self.data:
+            tensor.share_memory_()
+        return self
+
     def set_max_samples(self, max_samples):
         self.max_samples = int(max_samples)
         self.data, self.edges = self.load()
@@ -109,22 +116,30 @@ class NBodyDataset():
 
 class NBodyDataModule(pl.LightningDataModule):
     def __init__(
-        self, hyperparams
+        self, hyperparams, data_path=None, train_dataset=None, valid_dataset=None
     ):
         super().__init__()
         self.hyperparams = hyperparams
+        self.data_path = data_path
+        # already loaded datasets, e.g. shared between the trials of a sweep
+        self.train_dataset = train_dataset
+        self.valid_dataset = valid_dataset
 
     def setup(self, stage=None):
         if stage == "fit" or stage is None:
-            self.train_dataset = NBodyDataset(partition="train")
-            self.valid_dataset = NBodyDataset(partition="val")
+            if self.train_dataset is None:
+                self.train_dataset = NBodyDataset(partition="train", data_path=self.data_path)
+            if self.valid_dataset is None:
+                self.valid_dataset = NBodyDataset(partition="val", data_path=self.data_path)
         if stage == "test":
-            self.test_dataset = NBodyDataset(partition="test")
+            self.test_dataset = NBodyDataset(partition="test", data_path=self.data_path)
 
     def train_dataloader(self):
-        train_loader = DataLoader(self.train_dataset, batch_size=self.hyperparams.batch_size, shuffle=True, drop_last=True)
+        sampler = utils.get_sampler(self.train_dataset, shuffle=True, seed=self.hyperparams.seed)
+        train_loader = DataLoader(self.train_dataset, batch_size=self.hyperparams.batch_size, shuffle=sampler is None, sampler=sampler, drop_last=True)
         return train_loader
 
     def val_dataloader(self):
-        train_loader = DataLoader(self.valid_dataset, batch_size=self.hyperparams.batch_size, shuffle=False, drop_last=False)
+        sampler = utils.get_sampler(self.valid_dataset, shuffle=False)
+        train_loader = DataLoader(self.valid_dataset, batch_size=self.hyperparams.batch_size, shuffle=False, sampler=sampler, drop_last=False)
         return train_loader
@@ -0,0 +1,114 @@
+import json
+import os
+
+import numpy as np
+
+POINTS_FILE = "points.bin"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+
+
+class PackedPointCloudWriter:
+    """
+    Streams variable-length point clouds of one split into a single contiguous float32 file plus an offsets index.
+
+    Layout of `out_dir`:
+        `points.bin`: raw float32 array of shape (total_points, num_channels)
+        `<name>.bin`: raw per-point fields (e.g. segmentation labels), indexed with the same offsets
+        `offsets.npy`: int64 array of shape (num_clouds + 1,), cloud i is points[offsets[i]:offsets[i + 1]]
+        `<name>.npy`: per-cloud fields (e.g. class labels, precomputed sampling indices)
+        `meta.json`: number of channels, dtypes of the fields and any dataset specific metadata
+    """
+    def __init__(self, out_dir, num_channels, point_fields=None):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.num_channels = num_channels
+        self.point_fields = point_fields or {}
+        self.points_file = open(os.path.join(out_dir, POINTS_FILE), "wb")
+        self.point_field_files = {
+            name: open(os.path.join(out_dir, name + ".bin"), "wb") for name in self.point_fields
+        }
+        self.sample_fields = {}
+        self.offsets = [0]
+
+    def append(self, points, point_fields=None, sample_fields=None):
+        points = np.ascontiguousarray(points, dtype=np.float32)
+        assert points.ndim == 2 and points.shape[1] == self.num_channels
+        self.points_file.write(points.tobytes())
+        for name, dtype in self.point_fields.items():
+            values = np.ascontiguousarray(point_fields[name], dtype=dtype)
+            assert len(values) == len(points)
+            self.point_field_files[name].write(values.tobytes())
+        for name, value in (sample_fields or {}).items():
+            self.sample_fields.setdefault(name, []).append(value)
+        self.offsets.append(self.offsets[-1] + len(points))
+
+    def close(self, meta=None):
+        self.points_file.close()
+        for field_file in self.point_field_files.values():
+            field_file.close()
+        np.save(os.path.join(self.out_dir, OFFSETS_FILE), np.array(self.offsets, dtype=np.int64))
+        for name, values in self.sample_fields.items():
+            np.save(os.path.join(self.out_dir, name + ".npy"), np.stack(values))
+        meta = dict(meta or {})
+        meta.update({
+            "num_channels": self.num_channels,
+            "point_fields": {name: np.dtype(dtype).str for name, dtype in self.point_fields.items()},
+            "sample_fields": sorted(self.sample_fields),
+        })
+        with open(os.path.join(self.out_dir, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+
+class PackedPointCloudStore:
+    """
+    Read-only view of a split written by `PackedPointCloudWriter`. Everything is memory-mapped, so DataLoader
+    workers share the page cache instead of holding private copies. The maps are opened lazily in each process
+    and are never pickled, which keeps the store cheap to send to spawned workers.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        self._maps = None
+
+    def _open(self):
+        num_points = int(self.offsets[-1])
+        maps = {
+            "points": np.memmap(os.path.join(self.path, POINTS_FILE), dtype=np.float32, mode="r",
+                                shape=(num_points, self.meta["num_channels"])),
+        }
+        for name, dtype in self.meta["point_fields"].items():
+            maps[name] = np.memmap(os.path.join(self.path, name + ".bin"), dtype=np.dtype(dtype), mode="r",
+                                   shape=(num_points,))
+        for name in self.meta["sample_fields"]:
+            maps[name] = np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+        self._maps = maps
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_maps"] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def has_field(self, name):
+        return name in self.meta["point_fields"] or name in self.meta["sample_fields"]
+
+    def get_points(self, index):
+        """ Returns a read-only (num_points, num_channels) view of cloud `index`. """
+        return self.get_point_field("points", index)
+
+    def get_point_field(self, name, index):
+        if self._maps is None:
+            self._open()
+        return self._maps[name][self.offsets[index]:self.offsets[index + 1]]
+
+    def get_sample_field(self, name, index=None):
+        if self._maps is None:
+            self._open()
+        if index is None:
+            return self._maps[name]
+        return self._maps[name][index]
@@ -1,4 +1,5 @@
 import os
+import functools
 import urllib.request as url_req
 import zipfile
 import numpy as np
@@ -141,8 +142,11 @@ class RotatedMNISTDataModule(pl.LightningDataModule):
         if download == True:
             obtain(self.data_path)
         self.mode = mode
+        # pinning needs a cuda device, without one the flag is a no-op
+        self.pin_memory = bool(hyperparams.pin_memory) and torch.cuda.is_available()
         if self.mode == 'set':
-            self.collate_fn = utils.combine_set_data_sparse
+            # the set models read (features, set_indices, targets), so the offsets are not returned
+            self.collate_fn = functools.partial(utils.combine_set_data_sparse, pin_memory=self.pin_memory)
         else:
             self.collate_fn = None
 
@@ -156,35 +160,26 @@ class RotatedMNISTDataModule(pl.LightningDataModule):
             self.test_dataset = get_dataset(self.data_path, split='test', mode=self.mode)
             print('Test dataset size: ', len(self.test_dataset))
 
-    def train_dataloader(self):
-        train_loader = DataLoader(
-            self.train_dataset,
+    def get_dataloader(self, dataset, shuffle):
+        sampler = utils.get_sampler(dataset, shuffle, seed=self.hyperparams.seed)
+        return DataLoader(
+            dataset,
             self.hyperparams.batch_size,
-            shuffle=True,
+            shuffle=shuffle and sampler is None,
+            sampler=sampler,
             num_workers=self.hyperparams.num_workers,
             collate_fn=self.collate_fn,
+            pin_memory=self.pin_memory,
         )
-        return train_loader
+
+    def train_dataloader(self):
+        return self.get_dataloader(self.train_dataset, shuffle=True)
 
     def val_dataloader(self):
-        valid_loader = DataLoader(
-            self.valid_dataset,
-            self.hyperparams.batch_size,
-            shuffle=False,
-            num_workers=self.hyperparams.num_workers,
-            collate_fn=self.collate_fn,
-        )
-        return valid_loader
+        return self.get_dataloader(self.valid_dataset, shuffle=False)
 
     def test_dataloader(self):
-        test_loader = DataLoader(
-            self.test_dataset,
-            self.hyperparams.batch_size,
-            shuffle=False,
-            num_workers=self.hyperparams.num_workers,
-            collate_fn=self.collate_fn,
-        )
-        return test_loader
+        return self.get_dataloader(self.test_dataset, shuffle=False)
 
 # if __name__ == "__main__":
 #     parser = argparse.ArgumentParser()
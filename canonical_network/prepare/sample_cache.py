@@ -0,0 +1,150 @@
+import multiprocessing as mp
+import os
+import pickle
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class LocalSampleCache:
+    """
+    Per-process cache from sample index to sample, keeps the first `cache_size` entries it sees. Every DataLoader
+    worker builds its own copy.
+    """
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, value):
+        if len(self.entries) < self.cache_size:
+            self.entries[key] = value
+
+
+class SharedSampleCache:
+    """
+    Sample cache living in shared memory, so all DataLoader workers and epochs see the same entries. The first
+    worker touching an index fills it, the others read it.
+
+    The arena of `budget_bytes` is split into fixed slots of `slot_bytes`, never more slots than keys; every entry is
+    pickled into one slot and entries that do not fit are simply not cached. When all slots are taken the least recently used one is
+    evicted. A small int64 table next to the arena maps keys (sample indices in [0, num_keys)) to slots and keeps
+    the access clock. All table updates happen under one multiprocessing lock, the unpickling happens outside it.
+
+    Note that the arena lives in /dev/shm, which docker limits to 64MB unless started with --shm-size.
+    """
+    def __init__(self, num_keys, budget_bytes, slot_bytes):
+        self.num_keys = num_keys
+        self.slot_bytes = int(slot_bytes)
+        self.num_slots = min(max(int(budget_bytes // self.slot_bytes), 1), num_keys)
+        self._owner_pid = os.getpid()
+        self._data = shared_memory.SharedMemory(create=True, size=self.num_slots * self.slot_bytes)
+        self._table = shared_memory.SharedMemory(create=True, size=8 * self._table_length())
+        # a lock from the fork context refuses to be pickled into spawned workers, the spawn one works with every
+        # start method
+        self._lock = mp.get_context("spawn").Lock()
+        self._init_views()
+        # runs on garbage collection or at interpreter exit, whichever comes first
+        self._finalizer = weakref.finalize(self, _release_segments, self._data, self._table, self._owner_pid)
+        self._key_to_slot[:] = -1
+        self._slot_key[:] = -1
+        self._slot_size[:] = 0
+        self._slot_tick[:] = 0
+        self._clock[:] = 0
+
+    def _table_length(self):
+        return self.num_keys + 3 * self.num_slots + 1
+
+    def _init_views(self):
+        table = np.ndarray((self._table_length(),), dtype=np.int64, buffer=self._table.buf)
+        start = self.num_keys
+        self._key_to_slot = table[:start]
+        self._slot_key = table[start:start + self.num_slots]
+        self._slot_size = table[start + self.num_slots:start + 2 * self.num_slots]
+        self._slot_tick = table[start + 2 * self.num_slots:start + 3 * self.num_slots]
+        self._clock = table[-1:]
+
+    def __getstate__(self):
+        # only reached with the spawn/forkserver start methods, forked workers inherit the mappings directly
+        state = {k: v for k, v in self.__dict__.items() if not k.startswith("_") or k in ("_owner_pid", "_lock")}
+        state["_data_name"] = self._data.name
+        state["_table_name"] = self._table.name
+        return state
+
+    def __setstate__(self, state):
+        data_name = state.pop("_data_name")
+        table_name = state.pop("_table_name")
+        self.__dict__.update(state)
+        self._data = shared_memory.SharedMemory(name=data_name)
+        self._table = shared_memory.SharedMemory(name=table_name)
+        # spawned workers share the resource tracker of the creating process, so attaching here neither owns nor
+        # leaks the segments
+        self._init_views()
+        self._finalizer = weakref.finalize(self, _release_segments, self._data, self._table, self._owner_pid)
+
+    def get(self, key):
+        with self._lock:
+            slot = self._key_to_slot[key]
+            if slot < 0:
+                return None
+            self._clock[0] += 1
+            self._slot_tick[slot] = self._clock[0]
+            start = slot * self.slot_bytes
+            payload = bytes(self._data.buf[start:start + self._slot_size[slot]])
+        return pickle.loads(payload)
+
+    def put(self, key, value):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.slot_bytes:
+            return False
+        with self._lock:
+            if self._key_to_slot[key] >= 0:
+                return True
+            free_slots = np.flatnonzero(self._slot_key < 0)
+            slot = free_slots[0] if len(free_slots) > 0 else int(np.argmin(self._slot_tick))
+            evicted_key = self._slot_key[slot]
+            if evicted_key >= 0:
+                self._key_to_slot[evicted_key] = -1
+            start = slot * self.slot_bytes
+            self._data.buf[start:start + len(payload)] = payload
+            self._clock[0] += 1
+            self._slot_tick[slot] = self._clock[0]
+            self._slot_size[slot] = len(payload)
+            self._slot_key[slot] = key
+            self._key_to_slot[key] = slot
+        return True
+
+    def close(self):
+        self._key_to_slot = self._slot_key = self._slot_size = self._slot_tick = self._clock = None
+        self._finalizer()
+
+
+def _release_segments(data, table, owner_pid):
+    data.close()
+    table.close()
+    if os.getpid() == owner_pid:
+        data.unlink()
+        table.unlink()
+
+
+def split_cache_budget(budget_bytes, demands):
+    """
+    Splits the byte budget of a whole run over several caches in proportion to their demands, the bytes each one
+    would need to hold every key. Caches never allocate more than their demand, so a generous budget is not wasted.
+    """
+    demands = np.asarray(demands, dtype=np.float64)
+    if demands.sum() == 0:
+        return [0] * len(demands)
+    return [int(budget_bytes * demand / demands.sum()) for demand in demands]
+
+
+def make_sample_cache(backend, num_keys, cache_size, cache_bytes, slot_bytes):
+    if backend == "local":
+        return LocalSampleCache(cache_size)
+    elif backend == "shared":
+        return SharedSampleCache(num_keys, cache_bytes, slot_bytes)
+    else:
+        raise NotImplementedError(f"Unknown cache backend {backend}")
@@ -3,9 +3,14 @@ from torch.utils.data import DataLoader, Dataset
 import pytorch_lightning as pl
 import os
 import json
+from argparse import ArgumentParser
 import numpy as np
 
+import torch
+
 import canonical_network.utils as utils
+from canonical_network.prepare.packed_store import PackedPointCloudWriter, PackedPointCloudStore
+from canonical_network.prepare.sample_cache import make_sample_cache, split_cache_budget
 
 RNG = RandomState(0)
 
@@ -18,6 +23,82 @@ def pc_normalize(pc):
     return pc
 
 
+def read_split_index(root, split, class_choice=None):
+    """
+    Returns the category name to synset folder mapping, the original class ids and the list of
+    (category, shape_txt_file_path) tuples of one split.
+    """
+    cat = {}
+    with open(os.path.join(root, "synsetoffset2category.txt"), "r") as f:
+        for line in f:
+            ls = line.strip().split()
+            cat[ls[0]] = ls[1]
+    classes_original = dict(zip(cat, range(len(cat))))
+
+    if not class_choice is None:
+        cat = {k: v for k, v in cat.items() if k in class_choice}
+
+    split_ids = {}
+    for name in ("train", "val", "test"):
+        with open(os.path.join(root, "train_test_split", "shuffled_%s_file_list.json" % name), "r") as f:
+            split_ids[name] = set([str(d.split("/")[2]) for d in json.load(f)])
+    if split == "trainval":
+        ids = split_ids["train"] | split_ids["val"]
+    elif split in split_ids:
+        ids = split_ids[split]
+    else:
+        print("Unknown split: %s. Exiting.." % (split))
+        exit(-1)
+
+    datapath = []
+    for item in cat:
+        dir_point = os.path.join(root, cat[item])
+        for fn in sorted(os.listdir(dir_point)):
+            token = os.path.splitext(os.path.basename(fn))[0]
+            if token in ids:
+                datapath.append((item, os.path.join(dir_point, token + ".txt")))
+    return cat, classes_original, datapath
+
+
+def pack_shapenet_split(root, out_root, split="trainval"):
+    """
+    Converts one ShapeNetPart split from per-shape .txt files to a packed, memory-mappable store (see
+    `PackedPointCloudWriter`). The xyz channels are normalised once here, so loading is a plain slice.
+    """
+    cat, classes_original, datapath = read_split_index(root, split)
+    writer = PackedPointCloudWriter(os.path.join(out_root, split), num_channels=6, point_fields={"seg": np.int32})
+    for i, (item, fn) in enumerate(datapath):
+        data = np.loadtxt(fn).astype(np.float32)
+        point_set = data[:, 0:6]
+        point_set[:, 0:3] = pc_normalize(point_set[:, 0:3])
+        writer.append(
+            point_set,
+            point_fields={"seg": data[:, -1]},
+            sample_fields={"label": np.int32(classes_original[item])},
+        )
+        if (i + 1) % 1000 == 0:
+            print("Packed %d/%d %s shapes" % (i + 1, len(datapath), split))
+    writer.close(meta={"categories": cat, "classes": classes_original, "shape_ids": [fn for _, fn in datapath]})
+
+
+class ResamplingCollate:
+    """
+    Collates full length (point_set, cls, seg) samples and resamples every cloud to `npoints` points with
+    replacement, for the whole batch in one indexing op on the concatenated clouds.
+    """
+    def __init__(self, npoints):
+        self.npoints = npoints
+
+    def __call__(self, batch):
+        point_sets, classes, segs = zip(*batch)
+        lengths = torch.tensor([len(seg) for seg in segs])
+        offsets = torch.cumsum(lengths, dim=0) - lengths
+        choice = offsets[:, None] + (torch.rand(len(batch), self.npoints) * lengths[:, None]).long()
+        point_set = torch.from_numpy(np.concatenate(point_sets))[choice]
+        seg = torch.from_numpy(np.concatenate(segs))[choice]
+        return point_set, torch.from_numpy(np.stack(classes)), seg
+
+
 class PartNormalDataset(Dataset):
     def __init__(
         self,
@@ -26,58 +107,34 @@ class PartNormalDataset(Dataset):
         split="train",
         class_choice=None,
         normal_channel=False,
+        cache_backend="local",
+        cache_bytes=2**30,
+        packed_root=None,
+        resample=True,
+        knn_k=0,
+        num_resample_seeds=0,
     ):
         self.npoints = npoints
         self.root = root
-        self.catfile = os.path.join(self.root, "synsetoffset2category.txt")
-        self.cat = {}
         self.normal_channel = normal_channel
+        # when False the full clouds are returned and `ResamplingCollate` draws the points per batch
+        self.resample = resample
+        # when > 0, the input-coordinate knn graph is returned with every sample. Drawing the resampling from a
+        # fixed pool of `num_resample_seeds` seeds per shape lets the graph be cached under (index, seed)
+        self.knn_k = knn_k
+        self.num_resample_seeds = num_resample_seeds
 
-        with open(self.catfile, "r") as f:
-            for line in f:
-                ls = line.strip().split()
-                self.cat[ls[0]] = ls[1]
-        self.cat = {k: v for k, v in self.cat.items()}
-        self.classes_original = dict(zip(self.cat, range(len(self.cat))))
-
-        if not class_choice is None:
-            self.cat = {k: v for k, v in self.cat.items() if k in class_choice}
-        # print(self.cat)
-
-        self.meta = {}
-        with open(os.path.join(self.root, "train_test_split", "shuffled_train_file_list.json"), "r") as f:
-            train_ids = set([str(d.split("/")[2]) for d in json.load(f)])
-        with open(os.path.join(self.root, "train_test_split", "shuffled_val_file_list.json"), "r") as f:
-            val_ids = set([str(d.split("/")[2]) for d in json.load(f)])
-        with open(os.path.join(self.root, "train_test_split", "shuffled_test_file_list.json"), "r") as f:
-            test_ids = set([str(d.split("/")[2]) for d in json.load(f)])
-        for item in self.cat:
-            # print('category', item)
-            self.meta[item] = []
-            dir_point = os.path.join(self.root, self.cat[item])
-            fns = sorted(os.listdir(dir_point))
-            # print(fns[0][0:-4])
-            if split == "trainval":
-                fns = [fn for fn in fns if ((fn[0:-4] in train_ids) or (fn[0:-4] in val_ids))]
-            elif split == "train":
-                fns = [fn for fn in fns if fn[0:-4] in train_ids]
-            elif split == "val":
-                fns = [fn for fn in fns if fn[0:-4] in val_ids]
-            elif split == "test":
-                fns = [fn for fn in fns if fn[0:-4] in test_ids]
-            else:
-                print("Unknown split: %s. Exiting.." % (split))
-                exit(-1)
-
-            # print(os.path.basename(fns))
-            for fn in fns:
-                token = os.path.splitext(os.path.basename(fn))[0]
-                self.meta[item].append(os.path.join(dir_point, token + ".txt"))
-
-        self.datapath = []
-        for item in self.cat:
-            for fn in self.meta[item]:
-                self.datapath.append((item, fn))
+        if packed_root:
+            # packed store written by `pack_shapenet_split`, already split and normalised
+            self.store = PackedPointCloudStore(os.path.join(packed_root, split))
+            self.cat = self.store.meta["categories"]
+            self.classes_original = self.store.meta["classes"]
+            self.datapath = None
+            if not class_choice is None:
+                raise ValueError("class_choice is not supported with a packed store")
+        else:
+            self.store = None
+            self.cat, self.classes_original, self.datapath = read_split_index(self.root, split, class_choice)
 
         self.classes = {}
         for i in self.cat.keys():
@@ -103,36 +160,97 @@ class PartNormalDataset(Dataset):
             "Knife": [22, 23],
         }
 
-        self.cache = {}  # from index to (point_set, cls, seg) tuple
         self.cache_size = 20000
+        self.cache_backend = cache_backend
+        if cache_backend == "shared":
+            # every slot has to hold the largest cloud, and the knn graph of a full cloud when not resampling
+            max_points = self._max_points()
+            channels = 6 if normal_channel else 3
+            self.slot_bytes = max_points * (channels * 4 + 4) + 1024
+            self.knn_slot_bytes = (npoints if resample else max_points) * knn_k * 4 + 1024
+        else:
+            self.slot_bytes = self.knn_slot_bytes = 0
+        self.num_knn_keys = len(self) * max(num_resample_seeds, 1)
+        # None leaves the caches to `make_caches`, for data modules sharing one budget between their datasets
+        if cache_bytes is not None:
+            self.make_caches(cache_bytes)
 
-    def __getitem__(self, index):
-        if index in self.cache:
-            point_set, cls, seg = self.cache[index]
+    def _max_points(self):
+        if self.store is not None:
+            return int(np.diff(self.store.offsets).max())
+        max_points = 0
+        for _, fn in self.datapath:
+            with open(fn, "r") as f:
+                max_points = max(max_points, sum(1 for _ in f))
+        return max_points
+
+    def cache_demand(self):
+        return len(self) * self.slot_bytes + (self.num_knn_keys * self.knn_slot_bytes if self.knn_k else 0)
+
+    def make_caches(self, cache_bytes):
+        # the samples and the knn graphs split `cache_bytes` in proportion to what they would take in full
+        cache_bytes, knn_cache_bytes = split_cache_budget(
+            cache_bytes, [len(self) * self.slot_bytes, self.num_knn_keys * self.knn_slot_bytes if self.knn_k else 0]
+        ) if self.cache_backend == "shared" else (cache_bytes, cache_bytes)
+        # from index to (point_set, cls, seg) tuple, either per worker or shared by all workers up to `cache_bytes`
+        self.cache = make_sample_cache(self.cache_backend, len(self), self.cache_size, cache_bytes, self.slot_bytes)
+        self.knn_cache = make_sample_cache(
+            self.cache_backend, self.num_knn_keys, self.cache_size, knn_cache_bytes, self.knn_slot_bytes
+        ) if self.knn_k else None
+
+    def _load(self, index):
+        if self.store is not None:
+            cls = np.array([self.store.get_sample_field("label", index)]).astype(np.int32)
+            point_set = np.array(self.store.get_points(index))
+            seg = np.array(self.store.get_point_field("seg", index))
         else:
             fn = self.datapath[index]
             cat = self.datapath[index][0]
             cls = self.classes[cat]
             cls = np.array([cls]).astype(np.int32)
             data = np.loadtxt(fn[1]).astype(np.float32)
-            if not self.normal_channel:
-                point_set = data[:, 0:3]
-            else:
-                point_set = data[:, 0:6]
+            point_set = data[:, 0:6]
+            point_set[:, 0:3] = pc_normalize(point_set[:, 0:3])
             seg = data[:, -1].astype(np.int32)
-            if len(self.cache) < self.cache_size:
-                self.cache[index] = (point_set, cls, seg)
-        point_set[:, 0:3] = pc_normalize(point_set[:, 0:3])
+        if not self.normal_channel:
+            point_set = point_set[:, 0:3]
+        return point_set, cls, seg
 
-        choice = np.random.choice(len(seg), self.npoints, replace=True)
-        # resample
-        point_set = point_set[choice, :]
-        seg = seg[choice]
+    def __getitem__(self, index):
+        cached = self.cache.get(index)
+        if cached is not None:
+            point_set, cls, seg = cached
+        else:
+            point_set, cls, seg = self._load(index)
+            self.cache.put(index, (point_set, cls, seg))
 
+        knn_key = index
+        if self.resample:
+            if self.num_resample_seeds:
+                seed = np.random.randint(self.num_resample_seeds)
+                knn_key = index * self.num_resample_seeds + seed
+                choice = np.random.RandomState(knn_key).choice(len(seg), self.npoints, replace=True)
+            else:
+                knn_key = None
+                choice = np.random.choice(len(seg), self.npoints, replace=True)
+            # resample
+            point_set = point_set[choice, :]
+            seg = seg[choice]
+
+        if self.knn_k:
+            return point_set, cls, seg, self._get_knn(point_set, knn_key)
         return point_set, cls, seg
 
+    def _get_knn(self, point_set, key):
+        knn_idx = self.knn_cache.get(key) if key is not None else None
+        if knn_idx is None:
+            knn_idx = utils.point_cloud_knn(point_set[:, 0:3], self.knn_k).astype(np.int32)
+            if key is not None:
+                self.knn_cache.put(key, knn_idx)
+        return knn_idx
+
     def __len__(self):
-        return len(self.datapath)
+        return len(self.store) if self.store is not None else len(self.datapath)
 
 
 class ShapenetPartDataModule(pl.LightningDataModule):
@@ -140,46 +258,86 @@ class ShapenetPartDataModule(pl.LightningDataModule):
         super().__init__()
         self.data_path = hyperparams.data_path
         self.hyperparams = hyperparams
+        # packed clouds are resampled per batch in the collate function instead of per item, unless the knn graph of
+        # the resampled clouds is needed with every sample
+        self.collate_fn = ResamplingCollate(hyperparams.num_points) \
+            if hyperparams.packed_data_path and not hyperparams.cache_input_knn else None
 
     def setup(self, stage=None):
+        # --cache_bytes is the budget of the whole run, split between the datasets in proportion to their size
         if stage == "fit" or stage is None:
-            self.train_dataset = PartNormalDataset(
-                root=self.data_path, npoints=self.hyperparams.num_points, split="trainval",
-                normal_channel=self.hyperparams.normal_channel
-            )
-            self.valid_dataset = PartNormalDataset(
-                root=self.data_path, npoints=self.hyperparams.num_points, split="test",
-                normal_channel=self.hyperparams.normal_channel
-            )
+            self.train_dataset = self.make_dataset("trainval")
+            self.valid_dataset = self.make_dataset("test")
+            self.make_caches([self.train_dataset, self.valid_dataset])
         if stage == "test":
-            self.test_dataset = PartNormalDataset(
-                root=self.data_path, npoints=self.hyperparams.num_points, split="test",
-                normal_channel=self.hyperparams.normal_channel
-            )
+            # validation already runs on the test split, reuse it and its caches
+            self.test_dataset = getattr(self, "valid_dataset", None)
+            if self.test_dataset is None:
+                self.test_dataset = self.make_dataset("test")
+                self.make_caches([self.test_dataset])
+
+    def make_dataset(self, split):
+        return PartNormalDataset(
+            root=self.data_path, npoints=self.hyperparams.num_points, split=split,
+            normal_channel=self.hyperparams.normal_channel,
+            cache_backend=self.hyperparams.cache_backend, cache_bytes=None,
+            packed_root=self.hyperparams.packed_data_path or None, resample=self.collate_fn is None,
+            knn_k=self.hyperparams.n_knn if self.hyperparams.cache_input_knn else 0,
+            num_resample_seeds=self.hyperparams.num_resample_seeds
+        )
+
+    def make_caches(self, datasets):
+        budgets = split_cache_budget(self.hyperparams.cache_bytes, [dataset.cache_demand() for dataset in datasets])
+        for dataset, cache_bytes in zip(datasets, budgets):
+            dataset.make_caches(cache_bytes)
 
     def train_dataloader(self):
+        sampler = utils.get_sampler(self.train_dataset, shuffle=True, seed=self.hyperparams.seed)
         train_loader = DataLoader(
             self.train_dataset,
             batch_size=self.hyperparams.batch_size,
-            shuffle=True,
+            shuffle=sampler is None,
+            sampler=sampler,
             num_workers=self.hyperparams.num_workers,
+            collate_fn=self.collate_fn,
         )
         return train_loader
 
     def val_dataloader(self):
+        sampler = utils.get_sampler(self.valid_dataset, shuffle=False)
         valid_loader = DataLoader(
             self.valid_dataset,
             batch_size=self.hyperparams.batch_size,
             shuffle=False,
+            sampler=sampler,
             num_workers=self.hyperparams.num_workers,
+            collate_fn=self.collate_fn,
         )
         return valid_loader
 
     def test_dataloader(self):
+        sampler = utils.get_sampler(self.test_dataset, shuffle=False)
         test_loader = DataLoader(
             self.test_dataset,
             batch_size=self.hyperparams.batch_size,
             shuffle=False,
+            sampler=sampler,
             num_workers=self.hyperparams.num_workers,
+            collate_fn=self.collate_fn,
         )
         return test_loader
+
+
+def main():
+    parser = ArgumentParser(description="Pack ShapeNetPart into a memory-mapped store with normalised clouds")
+    parser.add_argument("--data_path", type=str, required=True,
+                        help="path to shapenetcore_partanno_segmentation_benchmark_v0_normal")
+    parser.add_argument("--out_path", type=str, required=True, help="where to write the packed splits")
+    parser.add_argument("--splits", type=str, nargs="*", default=["trainval", "test"], help="splits to pack")
+    args = parser.parse_args()
+    for split in args.splits:
+        pack_shapenet_split(args.data_path, args.out_path, split)
+
+
+if __name__ == "__main__":
+    main()
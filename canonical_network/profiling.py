@@ -0,0 +1,196 @@
+import functools
+import importlib
+import os
+import sys
+
+import pytorch_lightning as pl
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function, schedule
+
+REGION_PREFIX = "cn::"
+
+# submodule attribute name -> region, wherever it appears in the model
+MODULE_REGIONS = {
+    "canon_function": "canonicalizer",
+    "canonization_network": "canonicalizer",
+    "pred_function": "predictor",
+    "prediction_function": "predictor",
+    "encoder": "predictor",
+    "base_encoder": "predictor",
+    "predictor": "predictor",
+    "train_augmentation": "augmentation",
+}
+
+# (module name, function name) -> region, hot functions called from inside the models
+FUNCTION_REGIONS = {
+    ("canonical_network.utils", "knn"): "knn",
+    ("canonical_network.utils", "knn_kdtree"): "knn",
+    ("canonical_network.utils", "point_cloud_knn"): "knn",
+    ("canonical_network.utils", "farthest_point_sample"): "augmentation",
+    ("canonical_network.utils", "random_rotations"): "augmentation",
+    ("canonical_network.utils", "random_point_dropout"): "augmentation",
+    ("canonical_network.utils", "random_scale_point_cloud"): "augmentation",
+    ("canonical_network.utils", "random_shift_point_cloud"): "augmentation",
+    ("torch_scatter", "scatter"): "scatter",
+}
+
+
+def labelled(fn, region):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with record_function(REGION_PREFIX + region):
+            return fn(*args, **kwargs)
+    wrapper.__wrapped_region__ = fn
+    return wrapper
+
+
+class ProfilerCallback(pl.Callback):
+    """
+    Runs torch.profiler over a window of training steps (skip `wait`, warm up for `warmup`, record `active`) and
+    wraps the canonicalizer, predictor, augmentation, kNN and scatter calls in named ranges, so their time and memory
+    show up as `cn::<region>` rows. Writes a chrome trace and a summary table to `output_dir` and logs the region
+    shares of the step time.
+    """
+    def __init__(self, output_dir, wait=5, warmup=2, active=5, top_n=30, extra_modules=()):
+        self.output_dir = output_dir
+        self.wait = wait
+        self.warmup = warmup
+        self.active = active
+        self.top_n = top_n
+        self.extra_modules = list(extra_modules)
+        self.profiler = None
+        self.step = 0
+        self._patched = []
+
+    def label_model(self, model):
+        regions = {name: MODULE_REGIONS[name.split(".")[-1]] for name, _ in model.named_modules()
+                   if name.split(".")[-1] in MODULE_REGIONS}
+        regions.update({name: name for name in self.extra_modules})
+        for name, module in model.named_modules():
+            # nested modules with the region of an ancestor would be counted twice
+            if name not in regions or any(name.startswith(parent + ".") and regions[parent] == regions[name]
+                                          for parent in regions if parent != name):
+                continue
+            self._patch(module, "forward", labelled(module.forward, regions[name]), instance=True)
+
+        for (module_name, function_name), region in FUNCTION_REGIONS.items():
+            # optional dependencies are imported on first use, the model may not have run yet
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError:
+                continue
+            if not hasattr(module, function_name):
+                continue
+            fn = getattr(module, function_name)
+            wrapped = labelled(fn, region)
+            # the models import the helpers by name, so every loaded reference has to be swapped
+            for loaded_name, loaded in list(sys.modules.items()):
+                if (loaded_name == module_name or loaded_name.startswith("canonical_network")) \
+                        and getattr(loaded, function_name, None) is fn:
+                    self._patch(loaded, function_name, wrapped)
+
+    def _patch(self, owner, attribute, value, instance=False):
+        self._patched.append((owner, attribute, getattr(owner, attribute), instance))
+        setattr(owner, attribute, value)
+
+    def unlabel_model(self):
+        for owner, attribute, original, instance in reversed(self._patched):
+            if instance:
+                delattr(owner, attribute)
+            else:
+                setattr(owner, attribute, original)
+        self._patched = []
+
+    def on_fit_start(self, trainer, pl_module):
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+        self.label_model(pl_module)
+        self.profiler = profile(
+            activities=activities,
+            schedule=schedule(wait=self.wait, warmup=self.warmup, active=self.active, repeat=1),
+            on_trace_ready=functools.partial(self.write_report, trainer),
+            profile_memory=True,
+            record_shapes=False,
+        )
+        self.step = 0
+        self.profiler.start()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        if self.profiler is None:
+            return
+        self.profiler.step()
+        self.step += 1
+        if self.step >= self.wait + self.warmup + self.active:
+            self.stop()
+
+    def on_fit_end(self, trainer, pl_module):
+        self.stop()
+
+    def on_exception(self, trainer, pl_module, exception):
+        self.stop()
+
+    def stop(self):
+        if self.profiler is not None:
+            profiler, self.profiler = self.profiler, None
+            profiler.stop()
+        self.unlabel_model()
+
+    def write_report(self, trainer, profiler):
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f"rank{trainer.global_rank}_step{self.step}")
+        profiler.export_chrome_trace(prefix + "_trace.json")
+
+        use_cuda = torch.cuda.is_available()
+        events = profiler.key_averages()
+        sort_by = "cuda_time_total" if use_cuda else "cpu_time_total"
+        regions = region_summary(events, self.active, use_cuda)
+        with open(prefix + "_summary.txt", "w") as f:
+            f.write(format_regions(regions) + "\n\n")
+            f.write(events.table(sort_by=sort_by, row_limit=self.top_n) + "\n\n")
+            f.write(events.table(sort_by="self_" + ("cuda" if use_cuda else "cpu") + "_memory_usage",
+                                 row_limit=self.top_n))
+        print(format_regions(regions))
+        print(f"Profiler trace and summary written to {prefix}_*")
+
+        if trainer.logger is not None and regions:
+            metrics = {f"profile/{name}_ms_per_step": region["ms_per_step"] for name, region in regions.items()}
+            metrics.update({f"profile/{name}_share": region["share"] for name, region in regions.items()})
+            trainer.logger.log_metrics(metrics, step=trainer.global_step)
+
+
+def region_summary(events, num_steps, use_cuda):
+    """ Per region time per step, memory and share of the step time, from the profiler's averaged events. """
+    time_key = "cuda_time_total" if use_cuda else "cpu_time_total"
+    step_us = sum(getattr(event, time_key) for event in events if event.key.startswith("ProfilerStep"))
+    regions = {}
+    for event in events:
+        if not event.key.startswith(REGION_PREFIX):
+            continue
+        total_us = getattr(event, time_key)
+        regions[event.key[len(REGION_PREFIX):]] = {
+            "calls": event.count,
+            "ms_per_step": total_us / max(num_steps, 1) / 1e3,
+            "share": total_us / step_us if step_us else 0.0,
+            "memory_mb": (event.cuda_memory_usage if use_cuda else event.cpu_memory_usage) / 2**20,
+        }
+    return regions
+
+
+def format_regions(regions):
+    lines = [f"{'region':<16}{'calls':>8}{'ms/step':>12}{'share':>10}{'memory MB':>12}"]
+    for name, region in sorted(regions.items(), key=lambda item: -item[1]["ms_per_step"]):
+        lines.append(f"{name:<16}{region['calls']:>8}{region['ms_per_step']:>12.2f}{region['share']:>10.1%}"
+                     f"{region['memory_mb']:>12.1f}")
+    if "canonicalizer" in regions and "predictor" in regions:
+        canon, pred = regions["canonicalizer"]["ms_per_step"], regions["predictor"]["ms_per_step"]
+        lines.append(f"canonicalization / prediction time: {canon / pred if pred else float('inf'):.2f}")
+    return "\n".join(lines)
+
+
+def get_profiler_callback(hyperparams, run_name=""):
+    """ The profiler callback configured by the --profile* arguments of the training scripts, None when disabled. """
+    if not hyperparams.profile:
+        return None
+    extra_modules = [name for name in hyperparams.profile_modules.split(",") if name]
+    return ProfilerCallback(os.path.join(hyperparams.profile_dir, run_name), wait=hyperparams.profile_wait,
+                            warmup=hyperparams.profile_warmup, active=hyperparams.profile_steps,
+                            top_n=hyperparams.profile_top_n, extra_modules=extra_modules)
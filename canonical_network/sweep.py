@@ -0,0 +1,361 @@
+import contextlib
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import time
+import traceback
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+import yaml
+
+# sweep programs that can run locally, by file name, with the function training one trial
+PROGRAMS = {"train_nbody.py": "nbody"}
+
+
+def get_hyperparams():
+    parser = ArgumentParser(description="Runs a wandb sweep.yaml locally over a process pool, without the wandb agent.")
+    parser.add_argument("--sweep_config", type=str, default="sweep.yaml", help="wandb sweep configuration")
+    parser.add_argument("--method", type=str, default="",
+                        help="search 1)random 2)grid 3)bayes [default: the method of the sweep configuration]")
+    parser.add_argument("--num_trials", type=int, default=20, help="trials to run (grid: at most the grid size)")
+    parser.add_argument("--num_parallel", type=int, default=4, help="trials running at the same time")
+    parser.add_argument("--threads_per_trial", type=int, default=0,
+                        help="torch cpu threads per trial [default: 0, the cores split between the parallel trials]")
+    parser.add_argument("--overrides", type=str, default='{"use_wandb": false}',
+                        help="json dict of fixed hyperparameters for every trial, e.g. '{\"num_epochs\": 50}'")
+    parser.add_argument("--early_terminate", type=int, default=-1,
+                        help="median stopping 1)on 0)off -1)on if the sweep configuration has early_terminate")
+    parser.add_argument("--min_epochs", type=int, default=-1,
+                        help="epochs before a trial can be stopped, overrides early_terminate.min_iter "
+                             "[default: -1, min_iter or 3]")
+    parser.add_argument("--min_trials", type=int, default=3,
+                        help="trials that must have reached an epoch before the median at that epoch is used")
+    parser.add_argument("--num_initial", type=int, default=5, help="random trials before the bayesian search starts")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the search")
+    parser.add_argument("--data_path", type=str, default="", help="dataset directory [default: the program's default]")
+    parser.add_argument("--output_path", type=str, default="canonical_network/results/sweeps",
+                        help="directory for the trial logs and the results json")
+    return parser.parse_args()
+
+
+def load_sweep_config(path):
+    with open(path, "r") as f:
+        config = yaml.safe_load(f)
+    program = os.path.basename(config.get("program", "train_nbody.py"))
+    if program not in PROGRAMS:
+        raise NotImplementedError(f"Local sweeps of {program} are not supported, only {', '.join(PROGRAMS)}")
+    metric = config["metric"]["name"]
+    # wandb summary names, e.g. valid/loss.min, are the logged metric with an aggregation over the epochs
+    aggregation = metric.rsplit(".", 1)[1] if metric.endswith((".min", ".max")) else "last"
+    return {
+        "name": config.get("name", "sweep"),
+        "program": PROGRAMS[program],
+        "method": config.get("method", "random"),
+        "metric": metric[:-len(aggregation) - 1] if aggregation != "last" else metric,
+        "aggregation": aggregation,
+        "goal": config["metric"].get("goal", "minimize"),
+        "parameters": config.get("parameters", {}),
+        "early_terminate": config.get("early_terminate"),
+    }
+
+
+# Parameter specifications, in the wandb sweep format
+
+def sample_parameter(spec, rng):
+    if "value" in spec:
+        return spec["value"]
+    if "values" in spec:
+        return spec["values"][rng.choice(len(spec["values"]), p=spec.get("probabilities"))]
+    return from_unit(spec, rng.rand())
+
+
+def parameter_distribution(spec):
+    if "distribution" in spec:
+        return spec["distribution"]
+    # wandb infers uniform / int_uniform from the type of the bounds
+    return "int_uniform" if isinstance(spec["min"], int) and isinstance(spec["max"], int) else "uniform"
+
+
+def from_unit(spec, u):
+    """ Maps u in [0, 1] to a value of a `values` or distribution parameter, the inverse of `to_unit`. """
+    if "values" in spec:
+        return spec["values"][min(int(u * len(spec["values"])), len(spec["values"]) - 1)]
+    distribution = parameter_distribution(spec)
+    if distribution in ("normal", "log_normal", "q_normal", "q_log_normal"):
+        from scipy.stats import norm
+        value = float(spec.get("mu", 0.0)) + float(spec.get("sigma", 1.0)) * norm.ppf(np.clip(u, 1e-6, 1 - 1e-6))
+        value = math.exp(value) if "log" in distribution else value
+    else:
+        low, high = float(spec["min"]), float(spec["max"])
+        if distribution in ("log_uniform_values", "q_log_uniform_values"):
+            value = math.exp(math.log(low) + u * (math.log(high) - math.log(low)))
+        elif distribution in ("log_uniform", "q_log_uniform"):
+            # bounds in log space
+            value = math.exp(low + u * (high - low))
+        elif distribution in ("uniform", "q_uniform", "int_uniform"):
+            value = low + u * (high - low)
+        else:
+            raise NotImplementedError(f"Unknown parameter distribution {distribution}")
+    if distribution == "int_uniform":
+        return int(min(math.floor(value + 0.5), float(spec["max"])))
+    if distribution.startswith("q_"):
+        q = float(spec.get("q", 1.0))
+        return round(value / q) * q
+    return value
+
+
+def to_unit(spec, value):
+    if "values" in spec:
+        return (spec["values"].index(value) + 0.5) / len(spec["values"])
+    distribution = parameter_distribution(spec)
+    if distribution in ("normal", "log_normal", "q_normal", "q_log_normal"):
+        from scipy.stats import norm
+        value = math.log(value) if "log" in distribution else value
+        return float(norm.cdf((value - float(spec.get("mu", 0.0))) / float(spec.get("sigma", 1.0))))
+    low, high = float(spec["min"]), float(spec["max"])
+    if distribution in ("log_uniform_values", "q_log_uniform_values"):
+        return (math.log(value) - math.log(low)) / (math.log(high) - math.log(low))
+    if distribution in ("log_uniform", "q_log_uniform"):
+        return (math.log(value) - low) / (high - low)
+    return (value - low) / (high - low)
+
+
+# Search methods, `suggest` returns the next configuration (None when exhausted), `observe` its result
+
+class RandomSearch:
+    def __init__(self, parameters, seed=0):
+        self.parameters = parameters
+        self.rng = np.random.RandomState(seed)
+
+    def suggest(self, pending):
+        return {name: sample_parameter(spec, self.rng) for name, spec in self.parameters.items()}
+
+    def observe(self, config, value):
+        pass
+
+
+class GridSearch(RandomSearch):
+    def __init__(self, parameters, seed=0):
+        super().__init__(parameters, seed)
+        for name, spec in parameters.items():
+            if "value" not in spec and "values" not in spec:
+                raise ValueError(f"Grid search needs value/values for every parameter, {name} has a distribution")
+        names = list(parameters)
+        grid = itertools.product(*[parameters[name].get("values", [parameters[name].get("value")]) for name in names])
+        self.grid = iter([dict(zip(names, values)) for values in grid])
+
+    def suggest(self, pending):
+        return next(self.grid, None)
+
+
+class BayesSearch(RandomSearch):
+    """
+    Gaussian process (RBF kernel on the parameters mapped to the unit cube) with expected improvement, maximised
+    over random candidates. Running trials are added with the mean of the observed values (constant liar), so
+    parallel suggestions spread out. The first `num_initial` configurations are random.
+    """
+    def __init__(self, parameters, goal="minimize", seed=0, num_initial=5, num_candidates=2048, length_scale=0.25):
+        super().__init__(parameters, seed)
+        self.sign = 1.0 if goal == "minimize" else -1.0
+        self.num_initial = num_initial
+        self.num_candidates = num_candidates
+        self.length_scale = length_scale
+        self.names = [name for name, spec in parameters.items() if "value" not in spec]
+        self.points, self.values = [], []
+
+    def encode(self, config):
+        return np.array([to_unit(self.parameters[name], config[name]) for name in self.names])
+
+    def observe(self, config, value):
+        if value is not None and np.isfinite(value):
+            self.points.append(self.encode(config))
+            self.values.append(self.sign * value)
+
+    def kernel(self, a, b):
+        distances = ((a[:, None, :] - b[None, :, :]) ** 2).sum(-1)
+        return np.exp(-0.5 * distances / self.length_scale ** 2)
+
+    def suggest(self, pending):
+        if len(self.values) < self.num_initial or not self.names:
+            return super().suggest(pending)
+        from scipy.stats import norm
+        lie = float(np.mean(self.values))
+        points = np.stack(self.points + [self.encode(config) for config in pending])
+        values = np.array(self.values + [lie] * len(pending))
+        mean, std = values.mean(), values.std() + 1e-12
+        targets = (values - mean) / std
+
+        kernel = self.kernel(points, points) + 1e-4 * np.eye(len(points))
+        cholesky = np.linalg.cholesky(kernel)
+        alpha = np.linalg.solve(cholesky.T, np.linalg.solve(cholesky, targets))
+        candidates = self.rng.rand(self.num_candidates, len(self.names))
+        cross = self.kernel(candidates, points)
+        mu = cross @ alpha
+        v = np.linalg.solve(cholesky, cross.T)
+        sigma = np.sqrt(np.clip(1.0 - (v ** 2).sum(0), 1e-12, None))
+        best = targets[:len(self.values)].min()
+        z = (best - mu) / sigma
+        expected_improvement = (best - mu) * norm.cdf(z) + sigma * norm.pdf(z)
+
+        chosen = candidates[np.argmax(expected_improvement)]
+        config = {name: sample_parameter(spec, self.rng) for name, spec in self.parameters.items()}
+        config.update({name: from_unit(self.parameters[name], u) for name, u in zip(self.names, chosen)})
+        return config
+
+
+def make_search(method, parameters, goal, seed, num_initial):
+    if method == "random":
+        return RandomSearch(parameters, seed)
+    elif method == "grid":
+        return GridSearch(parameters, seed)
+    elif method == "bayes":
+        return BayesSearch(parameters, goal, seed, num_initial)
+    else:
+        raise NotImplementedError(f"Unknown search method {method}")
+
+
+class MedianStoppingCallback(pl.Callback):
+    """
+    Records the sweep metric after every validation epoch in `history` (shared between the trials) and stops the
+    trial when its best value so far is worse than the median of the other trials' best values at the same epoch.
+    """
+    def __init__(self, history, trial_id, metric, goal, early_terminate, min_epochs, min_trials):
+        self.history = history
+        self.trial_id = trial_id
+        self.metric = metric
+        self.sign = 1.0 if goal == "minimize" else -1.0
+        self.early_terminate = early_terminate
+        self.min_epochs = min_epochs
+        self.min_trials = min_trials
+        self.stopped_early = False
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.sanity_checking or self.metric not in trainer.callback_metrics:
+            return
+        curve = self.history.get(self.trial_id, []) + [float(trainer.callback_metrics[self.metric])]
+        # reassigned, a manager dict does not see in place changes of its values
+        self.history[self.trial_id] = curve
+        epoch = len(curve)
+        if not self.early_terminate or epoch < self.min_epochs:
+            return
+        others = [min(self.sign * value for value in other[:epoch])
+                  for trial_id, other in self.history.items() if trial_id != self.trial_id and len(other) >= epoch]
+        if len(others) >= self.min_trials and min(self.sign * value for value in curve) > np.median(others):
+            print(f"Median stopping trial {self.trial_id} at epoch {epoch}")
+            self.stopped_early = True
+            trainer.should_stop = True
+
+
+_SHARED = {}
+
+
+def init_worker(datasets, num_threads):
+    torch.set_num_threads(num_threads)
+    _SHARED["datasets"] = datasets
+
+
+def run_trial(trial_id, config, overrides, sweep, history, early_terminate, min_epochs, min_trials, log_path):
+    start = time.perf_counter()
+    callback = MedianStoppingCallback(history, trial_id, sweep["metric"], sweep["goal"], early_terminate, min_epochs,
+                                      min_trials)
+    result = {"trial": trial_id, "config": config}
+    with open(log_path, "w") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            if sweep["program"] == "nbody":
+                import wandb
+                from canonical_network.train_nbody import train_nbody
+                train_dataset, valid_dataset = _SHARED["datasets"]
+                train_nbody({**overrides, **config}, [callback], train_dataset, valid_dataset)
+                wandb.finish()
+            result["status"] = "stopped" if callback.stopped_early else "finished"
+        except Exception as e:
+            traceback.print_exc()
+            result["status"] = "failed"
+            result["error"] = f"{type(e).__name__}: {e}"
+    curve = history.get(trial_id, [])
+    result["curve"] = curve
+    result["value"] = aggregate(curve, sweep["aggregation"])
+    result["time_s"] = time.perf_counter() - start
+    return result
+
+
+def aggregate(curve, aggregation):
+    if not curve:
+        return None
+    return {"min": min, "max": max, "last": lambda values: values[-1]}[aggregation](curve)
+
+
+def load_shared_datasets(program, data_path=None):
+    """ Loads the datasets of the program once into shared memory, the trials map them instead of reloading. """
+    if program == "nbody":
+        from canonical_network.prepare.nbody_data import NBodyDataset
+        return NBodyDataset(partition="train", data_path=data_path).share_memory(), \
+            NBodyDataset(partition="val", data_path=data_path).share_memory()
+    return None
+
+
+def main():
+    hyperparams = get_hyperparams()
+    sweep = load_sweep_config(hyperparams.sweep_config)
+    overrides = json.loads(hyperparams.overrides)
+    method = hyperparams.method or sweep["method"]
+    search = make_search(method, sweep["parameters"], sweep["goal"], hyperparams.seed, hyperparams.num_initial)
+    early_terminate = bool(sweep["early_terminate"]) if hyperparams.early_terminate < 0 else bool(hyperparams.early_terminate)
+    min_epochs = ((sweep["early_terminate"] or {}).get("min_iter", 3) if hyperparams.min_epochs < 0
+                  else hyperparams.min_epochs)
+    num_threads = hyperparams.threads_per_trial or max(os.cpu_count() // hyperparams.num_parallel, 1)
+
+    run_path = os.path.join(hyperparams.output_path, f"{sweep['name'].replace(' ', '_')}_{time.strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(run_path, exist_ok=True)
+    print(f"Running {hyperparams.num_trials} {method} trials of {sweep['name']}, {hyperparams.num_parallel} at a time "
+          f"with {num_threads} threads each, logs in {run_path}")
+
+    datasets = load_shared_datasets(sweep["program"], hyperparams.data_path or None)
+    context = mp.get_context("spawn")
+    manager = context.Manager()
+    history = manager.dict()
+    results, running = [], {}
+    with ProcessPoolExecutor(hyperparams.num_parallel, mp_context=context, initializer=init_worker,
+                             initargs=(datasets, num_threads)) as executor:
+        num_started = 0
+        while True:
+            while len(running) < hyperparams.num_parallel and num_started < hyperparams.num_trials:
+                config = search.suggest(list(running.values()))
+                if config is None:
+                    break
+                future = executor.submit(run_trial, num_started, config, overrides, sweep, history, early_terminate,
+                                         min_epochs, hyperparams.min_trials,
+                                         os.path.join(run_path, f"trial_{num_started:03d}.log"))
+                running[future] = config
+                num_started += 1
+            if not running:
+                break
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                config = running.pop(future)
+                result = future.result()
+                search.observe(config, result["value"])
+                results.append(result)
+                print(f"trial {result['trial']} {result['status']} {sweep['metric']}={result['value']} "
+                      f"in {result['time_s']:.0f}s: {config}")
+    manager.shutdown()
+
+    sign = 1.0 if sweep["goal"] == "minimize" else -1.0
+    completed = [result for result in results if result["value"] is not None]
+    best = min(completed, key=lambda result: sign * result["value"]) if completed else None
+    with open(os.path.join(run_path, "results.json"), "w") as f:
+        json.dump({"sweep": sweep, "method": method, "overrides": overrides, "best": best,
+                   "trials": sorted(results, key=lambda result: result["trial"])}, f, indent=2)
+    if best is not None:
+        print(f"Best trial {best['trial']}: {sweep['metric']}={best['value']} with {best['config']}")
+    print(f"Saved {os.path.join(run_path, 'results.json')}")
+
+
+if __name__ == "__main__":
+    main()
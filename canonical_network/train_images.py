@@ -9,8 +9,10 @@ from tqdm import tqdm
 
 from canonical_network.prepare import RotatedMNISTDataModule, CIFAR10DataModule
 from canonical_network.models.image_model import LitClassifier
+from canonical_network.profiling import get_profiler_callback
+from canonical_network.distributed import get_trainer_kwargs, get_distributed_callbacks, is_global_zero
 
-def get_hyperparams():
+def get_hyperparams(args=None):
     parser = ArgumentParser()
     parser.add_argument("--model", type=str, default="vanilla", help="model to train 1) vanilla 2) equivariant 3) canonized_pca 4) equivariant_optimization")
     parser.add_argument("--base_encoder", type=str, default="cnn",
@@ -46,6 +48,17 @@ def get_hyperparams():
     parser.add_argument("--check_invariance", type=int, default=0, help="check if the network is invariant")
     parser.add_argument("--num_channels", type=int, default=20, help="num_channels for equivariant cnn base encoder")
 
+    # Throughput options
+    parser.add_argument("--precision", type=str, default="32",
+                        help="training precision 1)32 2)bf16 3)16 4)auto (bf16 on cpu, bf16/16 on gpu)")
+    parser.add_argument("--channels_last", type=int, default=0, help="run the encoders and inputs in channels-last memory format")
+    parser.add_argument("--canonization_full_precision", type=int, default=1,
+                        help="keep the canonization network in float32 under mixed precision")
+    parser.add_argument("--pin_memory", type=int, default=1,
+                        help="collate batches into pinned memory for asynchronous host to device copies (cuda only)")
+    parser.add_argument("--check_precision_stability", type=int, default=0,
+                        help="log how often the canonization argmax agrees between float32 and reduced precision")
+
     # Hyperparameters for the energy based model and Deepset
     parser.add_argument("--num_layers", type=int, default=6, help="number of deepset layers")
     parser.add_argument("--hidden_dim", type=int, default=64, help="hidden dimension for deepset")
@@ -54,12 +67,66 @@ def get_hyperparams():
     parser.add_argument("--num_optimization_iters", type=int, default=20, help="number of optimization iterations for the energy based model")
     parser.add_argument("--rot_opt_lr", type=float, default=0.01, help="number of samples for the energy based model")
     parser.add_argument("--implicit", type=int, default=0, help="whether to use implicit rotation optimization")
-    args = parser.parse_args()
+
+    # Distributed training
+    parser.add_argument("--num_processes", type=int, default=1,
+                        help="data-parallel processes per node, DDP over gloo on cpu (--batch_size is per process) [default: 1]")
+    parser.add_argument("--num_nodes", type=int, default=1,
+                        help="number of machines, each started with NODE_RANK, MASTER_ADDR and MASTER_PORT set [default: 1]")
+    parser.add_argument("--strategy", type=str, default="ddp",
+                        help="1)ddp: the script is started once per process 2)ddp_fork: the processes are forked from this one")
+    parser.add_argument("--find_unused_parameters", type=int, default=1,
+                        help="let DDP look for parameters without gradients every step, 0 is faster when all are used")
+    parser.add_argument("--threads_per_process", type=int, default=0,
+                        help="torch cpu threads per process [default: 0, the cores split between the processes]")
+
+    # Profiling
+    parser.add_argument("--cost_accounting", type=int, default=0,
+                        help="log time, FLOPs and activation memory of the canonicalization and prediction halves")
+    parser.add_argument("--profile", type=int, default=0,
+                        help="profile a window of training steps with torch.profiler (chrome trace and summary per region)")
+    parser.add_argument("--profile_dir", type=str, default="canonical_network/results/profiles", help="where to write the profiles")
+    parser.add_argument("--profile_wait", type=int, default=5, help="training steps skipped before profiling")
+    parser.add_argument("--profile_warmup", type=int, default=2, help="profiler warmup steps, not recorded")
+    parser.add_argument("--profile_steps", type=int, default=5, help="training steps recorded")
+    parser.add_argument("--profile_top_n", type=int, default=30, help="rows of the operator tables in the summary")
+    parser.add_argument("--profile_modules", type=str, default="",
+                        help="comma separated extra submodules (dotted paths) to time as their own region")
+    args = parser.parse_args(args)
     return args
 
 
-def train_images():
-    hyperparams = get_hyperparams()
+def get_trainer_precision(precision, device):
+    """
+    Maps the `--precision` flag to a `pl.Trainer` precision. fp16 is only available on gpu (where Lightning
+    adds loss scaling), so it falls back to bf16 on cpu.
+    """
+    if precision == "auto":
+        if device == "cuda" and not torch.cuda.is_bf16_supported():
+            return 16
+        return "bf16"
+    if precision == "16" and device == "cpu":
+        print('fp16 is not supported on cpu, using bf16 instead.')
+        return "bf16"
+    return int(precision) if precision.isdigit() else precision
+
+
+def get_image_data(hyperparams):
+    """ The data module of `hyperparams.dataset`, `hyperparams.data_path` is the directory of that dataset. """
+    if hyperparams.dataset == "rotated_mnist":
+        return RotatedMNISTDataModule(hyperparams, mode=hyperparams.data_mode)
+    elif hyperparams.dataset == "cifar10":
+        return CIFAR10DataModule(hyperparams)
+    else:
+        raise NotImplementedError("Dataset not implemented")
+
+
+def train_images(args=None, image_data=None, extra_callbacks=()):
+    """
+    `args` replace the command line, a prepared `image_data` module is used instead of loading the dataset and
+    `extra_callbacks` are added to the trainer (the multi-seed launcher passes all three). Returns the trainer.
+    """
+    hyperparams = get_hyperparams(args)
     hyperparams.device = 'cuda' if torch.cuda.is_available() else 'cpu'
     hyperparams.data_path = hyperparams.data_path + "/" + hyperparams.dataset
     hyperparams.checkpoint_path = hyperparams.checkpoint_path + "/" + hyperparams.dataset + "/" + hyperparams.model \
@@ -72,19 +139,19 @@ def train_images():
     else:
         print('Using wandb for logging.')
         os.environ["WANDB_MODE"] = "online"
+    if not is_global_zero():
+        # the other ranks of distributed training run the script as well, only rank 0 logs
+        os.environ["WANDB_MODE"] = "disabled"
 
     wandb.init(config=hyperparams, entity=hyperparams.wandb_entity, project=hyperparams.wandb_project)
     wandb_logger = WandbLogger(project=hyperparams.wandb_project, log_model="all")
     hyperparams = wandb.config
 
     pl.seed_everything(hyperparams.seed)
+    precision = get_trainer_precision(hyperparams.precision, hyperparams.device)
 
-    if hyperparams.dataset == "rotated_mnist":
-        image_data = RotatedMNISTDataModule(hyperparams, mode=hyperparams.data_mode)
-    elif hyperparams.dataset == "cifar10":
-        image_data = CIFAR10DataModule(hyperparams)
-    else:
-        raise NotImplementedError("Dataset not implemented")
+    if image_data is None:
+        image_data = get_image_data(hyperparams)
 
     if hyperparams.model == "vanilla":
         checkpoint_name = f"{hyperparams.model}_seed_{hyperparams.seed}"
@@ -102,6 +169,11 @@ def train_images():
     early_stop_metric_callback = EarlyStopping(monitor="val/acc", min_delta=0.0, patience=hyperparams.patience, verbose=True, mode="max")
     callbacks = [checkpoint_callback, early_stop_metric_callback]
 
+    profiler_callback = get_profiler_callback(hyperparams, f"{hyperparams.model}_{wandb.run.id}")
+    if profiler_callback is not None:
+        callbacks.append(profiler_callback)
+    callbacks += get_distributed_callbacks(hyperparams) + list(extra_callbacks)
+
     if hyperparams.run_mode == "test":
         model = LitClassifier.load_from_checkpoint(
             checkpoint_path=hyperparams.checkpoint_path + "/" + checkpoint_name + ".ckpt",
@@ -115,18 +187,20 @@ def train_images():
     if hyperparams.model == "equivariant":
         wandb.watch(model.network.canonization_network, log='all')
 
+    trainer_kwargs = get_trainer_kwargs(hyperparams)
     if hyperparams.run_mode == "auto_tune":
-        trainer = pl.Trainer(max_epochs=hyperparams.num_epochs, accelerator="auto", auto_scale_batch_size=True, auto_lr_find=True, logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic, inference_mode=False)
+        trainer = pl.Trainer(max_epochs=hyperparams.num_epochs, **trainer_kwargs, auto_scale_batch_size=True, auto_lr_find=True, logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic, inference_mode=False, precision=precision)
         trainer.tune(model, datamodule=image_data)
     elif hyperparams.run_mode == "dryrun":
-        trainer = pl.Trainer(fast_dev_run=2, max_epochs=hyperparams.num_epochs, accelerator="auto", limit_train_batches=5, limit_val_batches=5, logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic, inference_mode=False)
+        trainer = pl.Trainer(fast_dev_run=2, max_epochs=hyperparams.num_epochs, **trainer_kwargs, limit_train_batches=5, limit_val_batches=5, logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic, inference_mode=False, precision=precision)
     else:
-        trainer = pl.Trainer(max_epochs=hyperparams.num_epochs, accelerator="auto", logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic, inference_mode=False, limit_val_batches=100, check_val_every_n_epoch=10)
+        trainer = pl.Trainer(max_epochs=hyperparams.num_epochs, **trainer_kwargs, logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic, inference_mode=False, precision=precision, limit_val_batches=100, check_val_every_n_epoch=10)
 
     if hyperparams.run_mode == "train":
         trainer.fit(model, datamodule=image_data)
 
     trainer.test(model, datamodule=image_data)
+    return trainer
 
     # This is just for sanity check and verify that the metric logging is working fine.
     #custom_test(model, image_data)
@@ -6,10 +6,12 @@ import os
 from argparse import ArgumentParser
 from canonical_network.prepare.modelnet_data import ModelNetDataModule
 from canonical_network.models.pointcloud_classification_models import Pointnet, DGCNN, EquivariantPointcloudModel, VNPointnet
+from canonical_network.profiling import get_profiler_callback
+from canonical_network.distributed import get_trainer_kwargs, get_distributed_callbacks, is_global_zero
 import torch
 
 
-def get_hyperparams():
+def get_hyperparams(args=None):
     parser = ArgumentParser()
     parser.add_argument("--model", type=str, default="equivariant_pointcloud_model",
                         help="model to train 1) equivariant_pointcloud_model 2) pointnet 3) DGCNN")
@@ -38,6 +40,12 @@ def get_hyperparams():
     parser.add_argument("--data_path", type=str, default="/network/projects/siamak_students/"
                                                          "modelnet40_normal_resampled",
                         help="path to data")
+    parser.add_argument("--packed_data_path", type=str, default="",
+                        help="path to the packed store written by prepare/modelnet_data.py (empty to read .txt files)")
+    parser.add_argument("--cache_backend", type=str, default="local",
+                        help="sample cache 1)local: one per dataloader worker 2)shared: one shared memory cache for all workers")
+    parser.add_argument("--cache_bytes", type=int, default=2**30, help="byte budget of the shared sample caches of the whole run, split between the datasets [default: 1GB]")
+    parser.add_argument("--uniform", type=int, default=0, help="farthest point sample the clouds instead of truncating")
     parser.add_argument("--use_checkpointing", type=int, default=1, help="use checkpointing")
     parser.add_argument("--checkpoint_path", type=str, default="canonical_network/checkpoints", help="path to checkpoint")
     parser.add_argument("--deterministic", type=bool, default=False, help="deterministic training")
@@ -51,15 +59,60 @@ def get_hyperparams():
     parser.add_argument("--train_rotation", type=str, default="z", help="train rotation 1)z 2)so3")
     parser.add_argument("--valid_rotation", type=str, default="so3", help="train rotation 1)z 2)so3 [default: so3 to test equivariance]")
     parser.add_argument("--augment_train_data", type=int, default=0, help="whether to scale and shift the train data [default: 0]")
+    parser.add_argument("--jitter_sigma", type=float, default=0.0, help="std of the clipped gaussian jitter added to the train points [default: 0, off]")
+    parser.add_argument("--augment_seed", type=int, default=-1, help="seed for the train augmentations [default: -1, random]")
     parser.add_argument("--num_classes", type=int, default=40, help="num classes of the classification problem [default: 16]")
     parser.add_argument("--num_points", type=int, default=1024, help="num of points per pointcloud [default: 2048]")
+    parser.add_argument("--fps_num_points", type=int, default=0,
+                        help="farthest point sample the batch down to this many points on device [default: 0, off]")
+    parser.add_argument("--fps_seed", type=int, default=-1, help="seed for the on-device farthest point sampling [default: -1, random]")
     parser.add_argument("--n_knn", type=int, default=20, help="num of nearest neighbors for DGCNN [default: 40]")
+    parser.add_argument("--knn_backend", type=str, default="dense",
+                        help="knn search 1)dense: tiled pairwise distances 2)kdtree: scipy kd-tree for coordinates on cpu")
+    parser.add_argument("--knn_memory_budget", type=int, default=2**30,
+                        help="bytes of pairwise distances knn may hold at once before tiling [default: 1GB]")
+    parser.add_argument("--knn_workers", type=int, default=-1, help="threads for the kd-tree queries [default: -1, all cores]")
+    parser.add_argument("--fused_edge_conv", type=int, default=1,
+                        help="compute the first edge conv of DGCNN/VN layers from the points instead of materialised edge features")
+    parser.add_argument("--static_knn_graph", type=int, default=0,
+                        help="reuse the input coordinate knn graph in all edge conv layers instead of recomputing it on the features")
+    parser.add_argument("--cache_input_knn", type=int, default=0,
+                        help="compute the input coordinate knn graph once per sample in the dataset and cache it")
     parser.add_argument("--pooling", type=str, default="mean", help="pooling for VectorNeuron [default: mean]")
 
-    args = parser.parse_args()
+
+    # Distributed training
+    parser.add_argument("--num_processes", type=int, default=1,
+                        help="data-parallel processes per node, DDP over gloo on cpu (--batch_size is per process) [default: 1]")
+    parser.add_argument("--num_nodes", type=int, default=1,
+                        help="number of machines, each started with NODE_RANK, MASTER_ADDR and MASTER_PORT set [default: 1]")
+    parser.add_argument("--strategy", type=str, default="ddp",
+                        help="1)ddp: the script is started once per process 2)ddp_fork: the processes are forked from this one")
+    parser.add_argument("--find_unused_parameters", type=int, default=1,
+                        help="let DDP look for parameters without gradients every step, 0 is faster when all are used")
+    parser.add_argument("--threads_per_process", type=int, default=0,
+                        help="torch cpu threads per process [default: 0, the cores split between the processes]")
+
+    # Profiling
+    parser.add_argument("--cost_accounting", type=int, default=0,
+                        help="log time, FLOPs and activation memory of the canonicalization and prediction halves")
+    parser.add_argument("--profile", type=int, default=0,
+                        help="profile a window of training steps with torch.profiler (chrome trace and summary per region)")
+    parser.add_argument("--profile_dir", type=str, default="canonical_network/results/profiles", help="where to write the profiles")
+    parser.add_argument("--profile_wait", type=int, default=5, help="training steps skipped before profiling")
+    parser.add_argument("--profile_warmup", type=int, default=2, help="profiler warmup steps, not recorded")
+    parser.add_argument("--profile_steps", type=int, default=5, help="training steps recorded")
+    parser.add_argument("--profile_top_n", type=int, default=30, help="rows of the operator tables in the summary")
+    parser.add_argument("--profile_modules", type=str, default="",
+                        help="comma separated extra submodules (dotted paths) to time as their own region")
+    args = parser.parse_args(args)
     return args
-def train_pointnet():
-    hyperparams = get_hyperparams()
+def train_pointnet(args=None, data=None, extra_callbacks=()):
+    """
+    `args` replace the command line, a prepared `data` module is used instead of loading the dataset and
+    `extra_callbacks` are added to the trainer (the multi-seed launcher passes all three). Returns the trainer.
+    """
+    hyperparams = get_hyperparams(args)
     hyperparams.device = 'cuda' if torch.cuda.is_available() else 'cpu'
     hyperparams.wandb_project = hyperparams.wandb_project + "-" + hyperparams.dataset
 
@@ -69,6 +122,9 @@ def train_pointnet():
     else:
         print('Using wandb for logging.')
         os.environ["WANDB_MODE"] = "online"
+    if not is_global_zero():
+        # the other ranks of distributed training run the script as well, only rank 0 logs
+        os.environ["WANDB_MODE"] = "disabled"
 
     if hyperparams.use_checkpointing:
         if hyperparams.model == "equivariant_pointcloud_model":
@@ -92,7 +148,8 @@ def train_pointnet():
 
     pl.seed_everything(hyperparams.seed)
 
-    data = ModelNetDataModule(hyperparams)
+    if data is None:
+        data = ModelNetDataModule(hyperparams)
 
     callbacks = []
 
@@ -108,6 +165,11 @@ def train_pointnet():
     early_stop_metric_callback = EarlyStopping(monitor="valid/class_accuracy", min_delta=0.0, patience=hyperparams.patience, verbose=True, mode="max")
     callbacks.append(early_stop_metric_callback)
 
+    profiler_callback = get_profiler_callback(hyperparams, f"{hyperparams.model}_{wandb.run.id}")
+    if profiler_callback is not None:
+        callbacks.append(profiler_callback)
+    callbacks += get_distributed_callbacks(hyperparams) + list(extra_callbacks)
+
     if hyperparams.run_mode == "test":
         model = {
             "equivariant_pointcloud_model": lambda : EquivariantPointcloudModel.load_from_checkpoint(
@@ -135,13 +197,14 @@ def train_pointnet():
             "DGCNN": lambda: DGCNN(hyperparams),
         }[hyperparams.model]()
 
+    trainer_kwargs = get_trainer_kwargs(hyperparams)
     if hyperparams.run_mode == "auto_tune":
-        trainer = pl.Trainer(max_epochs=hyperparams.num_epochs, accelerator="auto", auto_scale_batch_size=True, auto_lr_find=True, logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic)
+        trainer = pl.Trainer(max_epochs=hyperparams.num_epochs, **trainer_kwargs, auto_scale_batch_size=True, auto_lr_find=True, logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic)
         trainer.tune(model, datamodule=data)
     elif hyperparams.run_mode == "dryrun":
-        trainer = pl.Trainer(fast_dev_run=2, max_epochs=hyperparams.num_epochs, accelerator="auto", limit_train_batches=5, limit_val_batches=5, logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic)
+        trainer = pl.Trainer(fast_dev_run=2, max_epochs=hyperparams.num_epochs, **trainer_kwargs, limit_train_batches=5, limit_val_batches=5, logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic)
     else:
-        trainer = pl.Trainer(max_epochs=hyperparams.num_epochs, accelerator="auto", logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic)
+        trainer = pl.Trainer(max_epochs=hyperparams.num_epochs, **trainer_kwargs, logger=wandb_logger, callbacks=callbacks, deterministic=hyperparams.deterministic)
 
     if hyperparams.run_mode == "train":
         trainer.fit(model, datamodule=data)
@@ -149,6 +212,7 @@ def train_pointnet():
         trainer.test(model, datamodule=data)
     else:
         raise ValueError("Invalid run mode")
+    return trainer
 
 
 def main():
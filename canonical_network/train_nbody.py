@@ -8,6 +8,8 @@ import torch
 from canonical_network.prepare.nbody_data import NBodyDataModule
 from canonical_network.models.euclideangraph_model import NBODY_HYPERPARAMS, EuclideanGraphModel
 from canonical_network.models.euclideangraph_base_models import EGNN_vel, GNN, VNDeepSets, Transformer
+from canonical_network.profiling import get_profiler_callback
+from canonical_network.distributed import get_trainer_kwargs, get_distributed_callbacks, is_global_zero
 
 # Change model here
 HYPERPARAMS = {"model": "Transformer", 
@@ -20,11 +22,28 @@ HYPERPARAMS = {"model": "Transformer",
                "num_epochs": 10000, 
                "num_workers":12, 
                "auto_tune":False, 
-               "seed": 0}
+               "seed": 0,
+               "profile": False,
+               "profile_dir": "canonical_network/results/profiles",
+               "profile_wait": 5,
+               "profile_warmup": 2,
+               "profile_steps": 5,
+               "profile_top_n": 30,
+               "profile_modules": "",
+               "cost_accounting": False,
+               "num_processes": 1,
+               "num_nodes": 1,
+               "strategy": "ddp",
+               "find_unused_parameters": True,
+               "threads_per_process": 0}
 
 
-def train_nbody():
-    hyperparams = HYPERPARAMS | NBODY_HYPERPARAMS # merges the dictionaries
+def train_nbody(overrides=None, extra_callbacks=(), train_dataset=None, valid_dataset=None):
+    """
+    `overrides` update the hyperparameters, `extra_callbacks` are added to the trainer and already loaded datasets
+    are used instead of reading the dataset files (the local sweep runner passes all three). Returns the trainer.
+    """
+    hyperparams = HYPERPARAMS | NBODY_HYPERPARAMS | (overrides or {}) # merges the dictionaries
 
     if not hyperparams["use_wandb"]:
         print('Wandb disable for logging.')
@@ -32,8 +51,11 @@ def train_nbody():
     else:
         print('Using wandb for logging.')
         os.environ["WANDB_MODE"] = "online"
-        
-    wandb.login()
+        wandb.login()
+    if not is_global_zero():
+        # the other ranks of distributed training run the script as well, only rank 0 logs
+        os.environ["WANDB_MODE"] = "disabled"
+
     wandb.init(config=hyperparams, entity="symmetry_group", project="canonical_network-nbody-transformer")
     wandb_logger = WandbLogger(project="canonical_network-nbody-transformer")
 
@@ -44,12 +66,16 @@ def train_nbody():
     nbody_hypeyparams = hyperparams
 
     pl.seed_everything(nbody_hypeyparams.seed)
-    nbody_data = NBodyDataModule(nbody_hypeyparams)
+    nbody_data = NBodyDataModule(nbody_hypeyparams, train_dataset=train_dataset, valid_dataset=valid_dataset)
 
     checkpoint_callback = ModelCheckpoint(dirpath="canonical_network/results/nbody/model_saves", filename= nbody_hypeyparams.model + "_" + wandb.run.name + "_{epoch}_{valid/loss:.3f}", monitor="valid/loss", mode="min")
     early_stop_metric_callback = EarlyStopping(monitor="valid/loss", min_delta=0.0, patience=600, verbose=True, mode="min")
     early_stop_lr_callback = EarlyStopping(monitor="lr", min_delta=0.0, patience=10000, verbose=True, mode="min", stopping_threshold=1.1e-6)
     callbacks = [checkpoint_callback, early_stop_lr_callback, early_stop_metric_callback] if nbody_hypeyparams.checkpoint else [early_stop_lr_callback, early_stop_metric_callback]
+    profiler_callback = get_profiler_callback(nbody_hypeyparams, f"{nbody_hypeyparams.model}_{wandb.run.id}")
+    if profiler_callback is not None:
+        callbacks.append(profiler_callback)
+    callbacks += get_distributed_callbacks(nbody_hypeyparams) + list(extra_callbacks)
 
     # Instantiates model using hyperparams
     model = {"euclideangraph_model": lambda: EuclideanGraphModel(nbody_hypeyparams), 
@@ -59,14 +85,16 @@ def train_nbody():
              "Transformer": lambda: Transformer(nbody_hypeyparams),
              }[nbody_hypeyparams.model]()
 
+    trainer_kwargs = get_trainer_kwargs(nbody_hypeyparams)
     if nbody_hypeyparams.auto_tune:
-        trainer = pl.Trainer(fast_dev_run=nbody_hypeyparams.dryrun, max_epochs=nbody_hypeyparams.num_epochs, accelerator="auto", auto_scale_batch_size=True, auto_lr_find=True, logger=wandb_logger, callbacks=callbacks, deterministic=False, log_every_n_steps=30)
+        trainer = pl.Trainer(fast_dev_run=nbody_hypeyparams.dryrun, max_epochs=nbody_hypeyparams.num_epochs, **trainer_kwargs, auto_scale_batch_size=True, auto_lr_find=True, logger=wandb_logger, callbacks=callbacks, deterministic=False, log_every_n_steps=30)
         trainer.tune(model, datamodule=nbody_data, enable_checkpointing=nbody_hypeyparams.checkpoint)
     elif nbody_hypeyparams.dryrun:
-        trainer = pl.Trainer(fast_dev_run=False, max_epochs=2, accelerator="auto", limit_train_batches=10, limit_val_batches=10, logger=wandb_logger, callbacks=callbacks, deterministic=False, enable_checkpointing=nbody_hypeyparams.checkpoint, log_every_n_steps=30)
+        trainer = pl.Trainer(fast_dev_run=False, max_epochs=2, **trainer_kwargs, limit_train_batches=10, limit_val_batches=10, logger=wandb_logger, callbacks=callbacks, deterministic=False, enable_checkpointing=nbody_hypeyparams.checkpoint, log_every_n_steps=30)
     else:
-        trainer = pl.Trainer(fast_dev_run=nbody_hypeyparams.dryrun, max_epochs=nbody_hypeyparams.num_epochs, accelerator="auto", logger=wandb_logger, callbacks=callbacks, deterministic=False, enable_checkpointing=nbody_hypeyparams.checkpoint, log_every_n_steps=30)
+        trainer = pl.Trainer(fast_dev_run=nbody_hypeyparams.dryrun, max_epochs=nbody_hypeyparams.num_epochs, **trainer_kwargs, logger=wandb_logger, callbacks=callbacks, deterministic=False, enable_checkpointing=nbody_hypeyparams.checkpoint, log_every_n_steps=30)
     trainer.fit(model, datamodule=nbody_data)
+    return trainer
 
 
 def main():
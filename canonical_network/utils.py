@@ -1,14 +1,42 @@
 from collections import namedtuple
+import importlib
 import pathlib
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+from torch.utils.data.distributed import DistributedSampler
 import torch
-import torchvision
+import torch.distributed as dist
 import numpy as np
-import kornia as K
 import os
 
 
+class LazyModule:
+    """
+    Stands in for a slow to import or optional module and imports it on the first attribute access, so importing
+    the package only loads the dependencies of the code paths that run. A missing optional dependency raises its
+    ImportError at that first use instead of when the package is imported.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if attribute in ("_name", "_module"):
+            # not set yet, e.g. on a copy made without __init__
+            raise AttributeError(attribute)
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'{' (loaded)' if self._module is not None else ''}>"
+
+
+torchvision = LazyModule("torchvision")
+K = LazyModule("kornia")
+spatial = LazyModule("scipy.spatial")
+
+
 SRC_PATH = pathlib.Path(__file__).parent
 DATA_PATH = SRC_PATH / "data"
 
@@ -54,6 +82,27 @@ class ImageSetMixedDataset(Dataset):
         return self.images[index], self.features[index], self.targets[index]
 
 
+class SequentialMultiple(torch.nn.Sequential):
+    def forward(self, *inputs):
+        for module in self._modules.values():
+            if type(inputs) == tuple:
+                inputs = module(*inputs)
+            else:
+                inputs = module(inputs)
+        return inputs
+
+
+def convert_to_channels_last(module):
+    """ Converts the weights of every 2D convolution in `module` to channels-last memory format.
+        The equivariant layers keep their own (possibly 5D) weights and rotate them on every call, so only
+        `nn.Conv2d` modules are converted.
+    """
+    for submodule in module.modules():
+        if isinstance(submodule, torch.nn.Conv2d):
+            submodule.to(memory_format=torch.channels_last)
+    return module
+
+
 def to_categorical(y, num_classes):
     return torch.eye(num_classes)[y]
 
@@ -71,9 +120,8 @@ def random_shift_point_cloud(batch_data, shift_range=0.1):
     """
     B, N, C = batch_data.shape
     # generate random shifts in pytorch from -shift_range to shift_range of shape (B, 3)
-    shifts = torch.rand((B, 3), device=batch_data.device) * 2 * shift_range - shift_range
-    for batch_index in range(B):
-        batch_data[batch_index,:,:] += shifts[batch_index,:]
+    shifts = torch.rand((B, 1, 3), device=batch_data.device) * 2 * shift_range - shift_range
+    batch_data += shifts
     return batch_data
 
 
@@ -86,21 +134,110 @@ def random_scale_point_cloud(batch_data, scale_low=0.8, scale_high=1.2):
     """
     B, N, C = batch_data.shape
     # generate random shifts in pytorch from -scale_low to scale_high of shape (B) and put in on the device of batch_data
-    scales = torch.rand((B,), device=batch_data.device) * (scale_high - scale_low) + scale_low
-    for batch_index in range(B):
-        batch_data[batch_index,:,:] *= scales[batch_index]
+    scales = torch.rand((B, 1, 1), device=batch_data.device) * (scale_high - scale_low) + scale_low
+    batch_data *= scales
     return batch_data
 
 def random_point_dropout(batch_pc, max_dropout_ratio=0.9):
     ''' batch_pc: BxNx3 '''
-    for b in range(batch_pc.shape[0]):
-        dropout_ratio =  np.random.random() * max_dropout_ratio # 0~0.875
-        drop_idx = torch.where(torch.rand((batch_pc.shape[1]))<=dropout_ratio)[0]
-        if len(drop_idx)>0:
-            batch_pc[b,drop_idx,:] = batch_pc.clone()[b,0,:] # set to the first point
-    return batch_pc
+    B, N, _ = batch_pc.shape
+    dropout_ratio = torch.rand((B, 1), device=batch_pc.device) * max_dropout_ratio # 0~0.875
+    drop = torch.rand((B, N), device=batch_pc.device) <= dropout_ratio
+    return torch.where(drop.unsqueeze(-1), batch_pc[:, :1], batch_pc) # set to the first point
+
+
+def random_z_rotations(batch_size, device=None, dtype=torch.float32, generator=None):
+    """ Returns (batch_size, 3, 3) rotations about the z axis with uniform angles. """
+    angles = torch.rand(batch_size, device=device, dtype=dtype, generator=generator) * 2 * np.pi
+    cos, sin = torch.cos(angles), torch.sin(angles)
+    zeros, ones = torch.zeros_like(angles), torch.ones_like(angles)
+    return torch.stack([cos, -sin, zeros, sin, cos, zeros, zeros, zeros, ones], dim=-1).view(batch_size, 3, 3)
+
+
+def random_so3_rotations(batch_size, device=None, dtype=torch.float32, generator=None):
+    """ Returns (batch_size, 3, 3) rotations distributed uniformly (Haar) on SO(3), from normalised gaussian quaternions. """
+    quaternions = torch.randn(batch_size, 4, device=device, dtype=dtype, generator=generator)
+    w, x, y, z = (quaternions / quaternions.norm(dim=-1, keepdim=True)).unbind(-1)
+    return torch.stack([
+        1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w),
+        2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w),
+        2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y),
+    ], dim=-1).view(batch_size, 3, 3)
+
+
+def random_rotations(rotation_type, batch_size, device=None, dtype=torch.float32, generator=None):
+    """ rotation_type: "z" or "so3", anything else gives identities """
+    if rotation_type == "z":
+        return random_z_rotations(batch_size, device, dtype, generator)
+    elif rotation_type == "so3":
+        return random_so3_rotations(batch_size, device, dtype, generator)
+    return torch.eye(3, device=device, dtype=dtype).expand(batch_size, 3, 3)
+
+
+def farthest_point_sample(xyz, npoint, generator=None, start_index=None):
+    """ Batched farthest point sampling, runs on the device of `xyz`.
+        Input:
+            xyz: BxNxD tensor, only the first three channels are used as coordinates
+            npoint: number of points to sample
+            generator: torch.Generator used to draw the start points, for reproducible sampling
+            start_index: optional B tensor of start points, overrides the random draw
+        Return:
+            Bxnpoint long tensor, indices of the sampled points
+    """
+    B, N, _ = xyz.shape
+    device = xyz.device
+    xyz = xyz[:, :, :3]
+    with torch.no_grad():
+        if start_index is None:
+            generator_device = generator.device if generator is not None else device
+            farthest = torch.randint(0, N, (B,), generator=generator, device=generator_device).to(device)
+        else:
+            farthest = torch.as_tensor(start_index, dtype=torch.long, device=device).view(B)
+        batch_indices = torch.arange(B, device=device)
+        centroids = torch.empty((B, npoint), dtype=torch.long, device=device)
+        distance = torch.full((B, N), float("inf"), dtype=xyz.dtype, device=device)
+        for i in range(npoint):
+            centroids[:, i] = farthest
+            centroid = xyz[batch_indices, farthest].unsqueeze(1)
+            distance = torch.minimum(distance, torch.sum((xyz - centroid) ** 2, -1))
+            farthest = distance.argmax(-1)
+    return centroids
+
+
+# how `knn` searches neighbours, set through `configure_knn`
+KNN_CONFIG = {"backend": "dense", "memory_budget": 2**30, "workers": -1}
+# the kd-tree only pays off for low dimensional inputs, higher dimensional features always use the dense search
+KDTREE_MAX_DIMS = 8
+
+
+def configure_knn(backend="dense", memory_budget=2**30, workers=-1):
+    """
+    backend: "dense" computes pairwise distances, in tiles of at most `memory_budget` bytes once the full
+        (B, N, N) matrix does not fit. "kdtree" additionally answers CPU queries on coordinates with a scipy
+        cKDTree using `workers` threads (-1 for all cores).
+    """
+    if backend not in ("dense", "kdtree"):
+        raise NotImplementedError(f"Unknown knn backend {backend}")
+    KNN_CONFIG.update(backend=backend, memory_budget=memory_budget, workers=workers)
+
 
 def knn(x, k):
+    """
+    Input:
+        x: features, [B, C, N]
+        k: number of neighbours, the point itself included
+    Return:
+        idx: neighbour indices sorted by distance, [B, N, k]
+    """
+    batch_size, num_dims, num_points = x.shape
+    if KNN_CONFIG["backend"] == "kdtree" and x.device.type == "cpu" and num_dims <= KDTREE_MAX_DIMS:
+        return knn_kdtree(x, k, KNN_CONFIG["workers"])
+    if batch_size * num_points * num_points * x.element_size() <= KNN_CONFIG["memory_budget"]:
+        return knn_dense(x, k)
+    return knn_tiled(x, k, KNN_CONFIG["memory_budget"])
+
+
+def knn_dense(x, k):
     inner = -2 * torch.matmul(x.transpose(2, 1), x)
     xx = torch.sum(x ** 2, dim=1, keepdim=True)
     pairwise_distance = -xx - inner - xx.transpose(2, 1)
@@ -109,6 +246,55 @@ def knn(x, k):
     return idx
 
 
+def knn_tiled(x, k, memory_budget):
+    """
+    Same result as `knn_dense` without the (B, N, N) matrix: queries are processed in row tiles against key
+    tiles, so at most `memory_budget` bytes of distances exist at a time, and the per key tile top-k are merged
+    into a running top-k.
+    """
+    batch_size, _, num_points = x.shape
+    budget = max(memory_budget // (x.element_size() * batch_size), k)
+    key_tile = min(num_points, budget)
+    query_tile = min(num_points, max(budget // key_tile, 1))
+
+    x_t = x.transpose(2, 1)  # (batch_size, num_points, num_dims)
+    xx = torch.sum(x ** 2, dim=1)  # (batch_size, num_points)
+    idx = torch.empty(batch_size, num_points, k, dtype=torch.long, device=x.device)
+    for q_start in range(0, num_points, query_tile):
+        queries = x_t[:, q_start:q_start + query_tile]
+        query_norms = xx[:, q_start:q_start + query_tile, None]
+        best_distance = best_idx = None
+        for k_start in range(0, num_points, key_tile):
+            keys = x[:, :, k_start:k_start + key_tile]
+            pairwise_distance = 2 * torch.matmul(queries, keys) - query_norms - xx[:, None, k_start:k_start + key_tile]
+            distance, tile_idx = pairwise_distance.topk(k=min(k, keys.size(2)), dim=-1)
+            tile_idx = tile_idx + k_start
+            if best_distance is not None:
+                distance = torch.cat((best_distance, distance), dim=-1)
+                tile_idx = torch.cat((best_idx, tile_idx), dim=-1)
+                distance, merged = distance.topk(k=k, dim=-1)
+                tile_idx = tile_idx.gather(-1, merged)
+            best_distance, best_idx = distance, tile_idx
+        idx[:, q_start:q_start + query_tile] = best_idx
+    return idx
+
+
+def knn_kdtree(x, k, workers=-1):
+    points = x.detach().transpose(2, 1).cpu().numpy()
+    idx = np.stack([point_cloud_knn(cloud, k, workers) for cloud in points])
+    return torch.from_numpy(idx).long().to(x.device)
+
+
+def point_cloud_knn(points, k, workers=1):
+    """
+    Input:
+        points: one point cloud, [N, C] numpy array
+    Return:
+        idx: neighbour indices sorted by distance, the point itself first, [N, k]
+    """
+    return spatial.cKDTree(points).query(points, k=k, workers=workers)[1].reshape(len(points), k)
+
+
 def get_graph_feature(x, k=20, idx=None, x_coord=None):
     batch_size = x.size(0)
     num_points = x.size(2)
@@ -163,19 +349,238 @@ def get_graph_feature_cross(x, k=20, idx=None):
 
     return feature
 
-def combine_set_data_sparse(set_data):
+def gather_neighbours(x, idx):
+    """
+    Input:
+        x: features, [B, C, N]
+        idx: neighbour indices from `knn`, [B, N, k]
+    Return:
+        neighbour features, [B, C, N, k]
+    """
+    batch_size, num_dims, num_points = x.shape
+    k = idx.size(-1)
+    idx = idx.reshape(batch_size, 1, num_points * k).expand(batch_size, num_dims, num_points * k)
+    return x.gather(2, idx).view(batch_size, num_dims, num_points, k)
+
+
+def edge_conv(x, conv, k=20, idx=None, x_coord=None):
+    """
+    Computes `conv(get_graph_feature(x, k, idx, x_coord))` for an nn.Sequential `conv` starting with a 1x1 Conv2d,
+    without building the (B, 2C, N, k) edge features. The 1x1 conv is linear in the concatenation, so with
+    W = [W_diff, W_centre]:  W_diff (x_j - x_i) + W_centre x_i = (W_diff x)_j + ((W_centre - W_diff) x)_i,
+    i.e. two C -> O convs on the N points, a gather of the first and a broadcast add of the second.
+    """
+    batch_size = x.size(0)
+    num_points = x.size(-1)
+    x = x.view(batch_size, -1, num_points)
+    if idx is None:
+        idx = knn(x if x_coord is None else x_coord, k=k)
+
+    layer = conv[0]
+    w_diff, w_centre = layer.weight.flatten(1).chunk(2, dim=1)
+    centre = torch.matmul(w_centre - w_diff, x)
+    if layer.bias is not None:
+        centre = centre + layer.bias.view(1, -1, 1)
+    # the gather output is fresh, adding the centres in place saves one more (B, O, N, k) tensor
+    out = gather_neighbours(torch.matmul(w_diff, x), idx).add_(centre.unsqueeze(-1))
+    for module in conv[1:]:
+        out = module(out)
+    return out
+
+
+def vn_edge_linear(x, weight, k=20, idx=None):
+    """
+    Computes `F.linear` with `weight` over the channels of `get_graph_feature_cross(x, k, idx)`, i.e. what VNLinear
+    does on them, without the repeated centres and the (B, 3C, 3, N, k) concatenation:
+    W_diff (x_j - x_i) + W_centre x_i + W_cross (x_j x x_i) = W_diff x_j + (W_centre - W_diff) x_i + W_cross (x_j x x_i)
+    Input:
+        x: vector features, [B, C, 3, N]
+        weight: [O, 3C]
+    Return:
+        [B, O, 3, N, k]
+    """
+    batch_size, num_dims, _, num_points = x.shape
+    if idx is None:
+        idx = knn(x.view(batch_size, -1, num_points), k=k)
+    w_diff, w_centre, w_cross = weight.chunk(3, dim=1)
+
+    neighbours = gather_neighbours(x.view(batch_size, -1, num_points), idx).view(batch_size, num_dims, 3, num_points, -1)
+    centre = x.unsqueeze(-1)
+    cross = torch.linalg.cross(neighbours, centre.expand_as(neighbours), dim=2)
+    out = torch.einsum("oc,bcdnk->bodnk", w_diff, neighbours)
+    out += torch.einsum("oc,bcdnk->bodnk", w_cross, cross)
+    out += torch.einsum("oc,bcdnk->bodnk", w_centre - w_diff, centre)
+    return out
+
+def global_point_conv(conv, global_feature, point_features):
+    """
+    Computes `conv(torch.cat([global_feature.repeat(1, 1, N), *point_features], dim=1))` for a 1x1 Conv1d, or an
+    nn.Sequential starting with one, without the concatenation. The weight is split along its input channels: the
+    global part is applied once per cloud and broadcast-added to the per-point parts.
+    Input:
+        global_feature: [B, G] or [B, G, 1]
+        point_features: list of [B, C_i, N]
+    """
+    layers = list(conv) if isinstance(conv, torch.nn.Sequential) else [conv]
+    batch_size = global_feature.size(0)
+    global_feature = global_feature.view(batch_size, -1, 1)
+
+    weight = layers[0].weight.squeeze(-1)
+    w_global, *w_points = weight.split([global_feature.size(1)] + [f.size(1) for f in point_features], dim=1)
+    global_out = torch.matmul(w_global, global_feature)
+    if layers[0].bias is not None:
+        global_out = global_out + layers[0].bias.view(1, -1, 1)
+    out = global_out + torch.matmul(w_points[0], point_features[0])
+    for w, feature in zip(w_points[1:], point_features[1:]):
+        out = out + torch.matmul(w, feature)
+    for layer in layers[1:]:
+        out = layer(out)
+    return out
+
+
+def combine_set_data_sparse(set_data, return_ptr=False, pin_memory=False):
+    """
+    Packs a list of (set_features, target) pairs into one flat batch. `set_indices` maps every element to its set
+    and `ptr` (returned with `return_ptr`) holds the offsets, set i is batch_features[ptr[i]:ptr[i + 1]].
+    With `pin_memory` the features are concatenated straight into page-locked memory when collating in the main
+    process, in DataLoader workers pinning is left to the loader.
+    """
     set_features, targets = zip(*set_data)
 
-    set_indices = torch.LongTensor([])
-    for i, elements in enumerate(set_features):
-        elements_indices = torch.ones_like(elements, dtype=torch.long) * i
-        set_indices = torch.cat((set_indices, elements_indices))
+    set_sizes = torch.tensor([len(elements) for elements in set_features], dtype=torch.long)
+    set_indices = torch.repeat_interleave(torch.arange(len(set_features)), set_sizes)
 
     batch_targets = torch.cat(targets, 0)
-    batch_features = torch.cat(set_features, 0)
-
+    if pin_memory and torch.utils.data.get_worker_info() is None:
+        batch_features = torch.empty((len(set_indices),) + set_features[0].shape[1:],
+                                     dtype=set_features[0].dtype, pin_memory=True)
+        torch.cat(set_features, 0, out=batch_features)
+    else:
+        batch_features = torch.cat(set_features, 0)
+
+    if return_ptr:
+        ptr = torch.zeros(len(set_features) + 1, dtype=torch.long)
+        torch.cumsum(set_sizes, 0, out=ptr[1:])
+        return batch_features, set_indices, ptr, batch_targets
     return batch_features, set_indices, batch_targets
 
+
+def combine_set_data_padded(set_data, padding_value=0):
+    """
+    Pads the sets of a batch of `SetDataset` (set_features, target) or `ImageSetMixedDataset` (image, set_features,
+    target) items to the largest set in the batch. Returns the padded features of shape (B, max_set_size, ...) and a
+    boolean mask that is True on padding, the convention of `src_key_padding_mask`, right after the set features.
+    No data module uses it yet, the rotated MNIST set mode feeds `LitClassifier` and keeps the sparse batches.
+    """
+    *images, set_features, targets = zip(*set_data)
+
+    set_sizes = torch.tensor([len(elements) for elements in set_features], dtype=torch.long)
+    batch_features = torch.nn.utils.rnn.pad_sequence(set_features, batch_first=True, padding_value=padding_value)
+    padding_mask = torch.arange(batch_features.shape[1]).unsqueeze(0) >= set_sizes.unsqueeze(1)
+
+    batch_targets = torch.cat(targets, 0) if targets[0].dim() > 0 else torch.stack(targets)
+    return tuple(torch.stack(image) for image in images) + (batch_features, padding_mask, batch_targets)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler for padded sets that keeps sets of similar size together. Every epoch the shuffled indices are
+    cut into pools of `bucket_size` sets, each pool is sorted by size and split greedily into batches whose padded
+    size (number of sets * largest set) stays within `max_tokens`, and the batches of all pools are shuffled.
+    A padded batch then costs about its real number of elements instead of batch size * largest set in the dataset.
+    With `num_replicas` > 1 every rank plans the same batches and takes every `num_replicas`-th one starting at
+    `rank`; when shuffling (training) all ranks get the same number of batches so DDP steps stay in lockstep.
+    """
+    def __init__(self, set_sizes, max_tokens, bucket_size=4096, max_batch_size=None, shuffle=True, drop_last=False,
+                 seed=0, num_replicas=1, rank=0):
+        self.set_sizes = np.asarray(set_sizes, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.max_batch_size = max_batch_size or len(self.set_sizes)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._batches = None
+
+    def _make_batches(self, epoch):
+        rng = np.random.default_rng(self.seed + epoch)
+        order = rng.permutation(len(self.set_sizes)) if self.shuffle else np.arange(len(self.set_sizes))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.set_sizes[bucket], kind="stable")]
+            batch, batch_max_size = [], 0
+            for index in bucket:
+                max_size = max(batch_max_size, self.set_sizes[index])
+                if batch and (max_size * (len(batch) + 1) > self.max_tokens or len(batch) == self.max_batch_size):
+                    batches.append(batch)
+                    batch, max_size = [], self.set_sizes[index]
+                batch.append(int(index))
+                batch_max_size = max_size
+            # with drop_last the remainder of each pool is dropped, every other batch was closed by the budget
+            if batch and not self.drop_last:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+            # at most num_replicas - 1 batches are dropped so every rank runs the same number of steps
+            batches = batches[:len(batches) - len(batches) % self.num_replicas]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        batches = self._batches if self._batches is not None else self._make_batches(self.epoch)
+        self._batches = None
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        # the number of batches depends on the shuffle, so the next epoch is planned here and reused by __iter__
+        if self._batches is None:
+            self._batches = self._make_batches(self.epoch)
+        return len(self._batches)
+
+
+def distributed_world():
+    """ (number of processes, rank of this process) of torch.distributed, (1, 0) when it is not initialised. """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size(), dist.get_rank()
+    return 1, 0
+
+
+class UnpaddedDistributedSampler(Sampler):
+    """
+    Splits a dataset into disjoint, contiguous shards of the ranks without padding, unlike `DistributedSampler`
+    which repeats samples to even out the shards. Every sample is evaluated exactly once, so validation metrics
+    summed over the ranks are those of the whole split.
+    """
+    def __init__(self, dataset, num_replicas, rank):
+        self.num_samples = len(dataset)
+        self.start = self.num_samples * rank // num_replicas
+        self.end = self.num_samples * (rank + 1) // num_replicas
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
+
+
+def get_sampler(dataset, shuffle, seed=0):
+    """
+    The sampler of this rank when running under torch.distributed, None in a single process (the DataLoader then
+    shuffles by itself). Shuffled (training) data is split by a `DistributedSampler` seeded identically on every
+    rank, evaluation data into unpadded shards.
+    """
+    num_replicas, rank = distributed_world()
+    if num_replicas == 1:
+        return None
+    if shuffle:
+        return DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+    return UnpaddedDistributedSampler(dataset, num_replicas, rank)
+
+
 def save_images_class_wise(images, labels, save_path, filename, num_classes=10):
     print(save_path)
     os.makedirs(save_path, exist_ok=True)
@@ -219,6 +624,18 @@ def check_rotoreflection_invariance(network, x, num_rotations=4):
     return 1.0 if truth else 0.0
 
 
+def check_canonization_precision_stability(network, x, dtype=torch.bfloat16):
+    """ Returns the fraction of images whose canonization argmax is unchanged when the canonization network
+        runs under reduced precision autocast instead of float32.
+    """
+    with torch.no_grad():
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            reference = network.canonization_network(x.float()).argmax(dim=-1)
+        with torch.autocast(device_type=x.device.type, dtype=dtype):
+            reduced = network.canonization_network(x).float().argmax(dim=-1)
+    return (reference == reduced).float().mean().item()
+
+
 def check_rotation_equivariance(network, x, num_rotations=4):
     batch_size = x.shape[0]
     device = x.device
@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from canonical_network.export import ExportWrapper, export_torchscript, get_export_spec, lightning_tracing
+from canonical_network.utils import dict_to_object
+
+
+def test_set_transformer_trace_matches_eager(tmp_path):
+    torch.manual_seed(0)
+    spec = get_export_spec(dict_to_object({"family": "set", "model": "transformer"}), {"batch_size": 4})
+    spec.model.eval()
+    wrapper = ExportWrapper(spec).eval()
+    path = str(tmp_path / "set_transformer.pt")
+    with lightning_tracing():
+        export_torchscript(wrapper, spec.make_inputs(1), path)
+    traced = torch.jit.load(path)
+    # padded sets of another batch size than the traced one
+    inputs = spec.make_inputs(8)
+    with torch.no_grad():
+        for output, reference in zip(traced(*inputs), wrapper(*inputs)):
+            torch.testing.assert_close(output, reference)
+
+
+def test_nbody_transformer_is_rejected():
+    with pytest.raises(NotImplementedError, match="PositionalEncoding"):
+        get_export_spec(dict_to_object({"family": "nbody", "model": "Transformer"}), {})
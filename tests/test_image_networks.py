@@ -0,0 +1,32 @@
+import pytest
+import torch
+
+from canonical_network.models.image_networks import BasicConvEncoder, EquivariantCanonizationNetwork
+
+IN_SHAPE = (1, 28, 28)
+
+
+def make_network(group_type):
+    torch.manual_seed(0)
+    network = EquivariantCanonizationNetwork(
+        BasicConvEncoder(IN_SHAPE, 8), IN_SHAPE, num_classes=10, canonization_out_channels=8,
+        canonization_num_layers=2, canonization_kernel_size=5, group_type=group_type, num_rotations=4,
+        device="cpu", batch_size=2,
+    )
+    return network.eval()
+
+
+@pytest.mark.parametrize("group_type", ["rotation", "roto-reflection"])
+def test_fibres_to_group_is_stable_under_bf16_autocast(group_type):
+    network = make_network(group_type)
+    x = torch.rand(32, *IN_SHAPE, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        reference_fibres = network.canonization_network(x)
+        reference = network.fibres_to_group(reference_fibres)
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            _, group = network.get_canonized_images(x)
+    reference = reference if isinstance(reference, tuple) else (reference,)
+    assert len(group) == len(reference)
+    for element, reference_element in zip(group, reference):
+        assert element.dtype == torch.float32
+        assert torch.equal(element, reference_element)
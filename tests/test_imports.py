@@ -0,0 +1,24 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from canonical_network.benchmarks.imports import MODULES
+
+# imported on first use only. Lightning itself loads torchvision, so it is only checked for the plain torch modules
+LAZY_DEPENDENCIES = ("kornia", "scipy.spatial", "torch_scatter")
+
+
+def loaded_modules(module, candidates):
+    """ Which of `candidates` are in sys.modules after importing `module` in a fresh interpreter. """
+    code = f"import json, sys, {module}; print(json.dumps([name for name in {list(candidates)!r} if name in sys.modules]))"
+    process = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module", list(MODULES))
+def test_optional_dependencies_are_imported_lazily(module):
+    candidates = LAZY_DEPENDENCIES + (("torchvision",) if MODULES[module] == "torch" else ())
+    assert loaded_modules(module, candidates) == []
@@ -0,0 +1,21 @@
+import torch
+
+from canonical_network.models.set_model import SET_HYPERPARAMS, SetPredictionFunction
+from canonical_network.utils import dict_to_object
+
+
+def test_prediction_function_counts_sets_from_set_indices():
+    torch.manual_seed(0)
+    function = SetPredictionFunction(dict_to_object(SET_HYPERPARAMS)).eval()
+    set_sizes = [2, 3, 1, 4]
+    x = torch.randint(SET_HYPERPARAMS["num_embeddings"], (sum(set_sizes),))
+    clusters = torch.softmax(torch.randn(len(x), SET_HYPERPARAMS["num_clusters"]), dim=1)
+    set_indices = torch.arange(len(set_sizes)).repeat_interleave(torch.tensor(set_sizes))
+    with torch.no_grad():
+        batched = function(x, clusters, set_indices)
+        # every set on its own gives the same outputs, whatever the number of sets in the batch
+        separate = torch.cat([
+            function(x_set, clusters_set, torch.zeros(len(x_set), dtype=torch.long)).reshape(-1)
+            for x_set, clusters_set in zip(x.split(set_sizes), clusters.split(set_sizes))
+        ])
+    torch.testing.assert_close(batched, separate)
@@ -0,0 +1,67 @@
+import pytest
+import torch
+
+from canonical_network.models.vn_layers import VNBatchNorm, VNLeakyReLU, VNLinear, VNLinearLeakyReLU, VNMaxPool, \
+    VNSoftplus
+from canonical_network.utils import get_graph_feature_cross, vn_edge_linear
+
+LAYERS = {
+    "VNLinear": lambda fused: VNLinear(8, 16, fused=fused),
+    "VNLeakyReLU": lambda fused: VNLeakyReLU(8, negative_slope=0.2, fused=fused),
+    "VNLeakyReLU shared": lambda fused: VNLeakyReLU(8, share_nonlinearity=True, fused=fused),
+    "VNSoftplus": lambda fused: VNSoftplus(8, fused=fused),
+    "VNBatchNorm": lambda fused: VNBatchNorm(8, dim=4, fused=fused),
+    "VNLinearLeakyReLU": lambda fused: VNLinearLeakyReLU(8, 16, dim=4, fused=fused),
+    "VNLinearLeakyReLU dim 5": lambda fused: VNLinearLeakyReLU(8, 16, dim=5, negative_slope=0.0, fused=fused),
+}
+
+
+def outputs_and_grads(function, parameters, x):
+    """ The output of `function(x)` and the gradients of its squared sum w.r.t. x and `parameters`. """
+    x = x.clone().requires_grad_(True)
+    out = function(x)
+    grads = torch.autograd.grad(out.pow(2).sum(), [x] + list(parameters))
+    return [out.detach()] + list(grads)
+
+
+def assert_close(values, reference_values):
+    for value, reference in zip(values, reference_values):
+        torch.testing.assert_close(value, reference, rtol=1e-5, atol=1e-5 * reference.abs().max().clamp(min=1.0))
+
+
+@pytest.mark.parametrize("name", list(LAYERS))
+def test_fused_layers_match_reference(name):
+    torch.manual_seed(0)
+    reference, fused = LAYERS[name](False), LAYERS[name](True)
+    fused.load_state_dict(reference.state_dict())
+    x = torch.randn(4, 8, 3, 64, 5) if "dim 5" in name else torch.randn(4, 8, 3, 64)
+    assert_close(outputs_and_grads(fused, list(fused.parameters()), x),
+                 outputs_and_grads(reference, list(reference.parameters()), x))
+
+
+def reference_max_pool(layer, x):
+    # indexing with a meshgrid over the leading axes, how VNMaxPool selected the vectors before the gather
+    d = layer.map_to_dir(x.transpose(1, -1)).transpose(1, -1)
+    idx = (x * d).sum(2, keepdims=True).max(dim=-1, keepdim=False)[1]
+    index_tuple = torch.meshgrid([torch.arange(j) for j in x.size()[:-1]], indexing="ij") + (idx,)
+    return x[index_tuple]
+
+
+@pytest.mark.parametrize("shape", [(4, 8, 3, 64), (2, 8, 3, 16, 20)])
+def test_gather_max_pool_matches_reference(shape):
+    torch.manual_seed(0)
+    layer = VNMaxPool(8)
+    x = torch.randn(*shape)
+    # the directions only pick the argmax, so gradients only reach x
+    assert_close(outputs_and_grads(layer, [], x), outputs_and_grads(lambda x: reference_max_pool(layer, x), [], x))
+    x_max, idx = layer(x, return_indices=True)
+    assert torch.equal(x_max, x.gather(-1, idx.unsqueeze(-1).expand(*x.shape[:-1], 1)).squeeze(-1))
+
+
+def test_edge_linear_matches_linear_on_graph_features():
+    torch.manual_seed(0)
+    layer = VNLinear(3 * 4, 8)
+    x = torch.randn(2, 4, 3, 32)
+    assert_close(outputs_and_grads(lambda x: layer.forward_edge(x, k=10), list(layer.parameters()), x),
+                 outputs_and_grads(lambda x: layer(get_graph_feature_cross(x, k=10)), list(layer.parameters()), x))
+    assert vn_edge_linear(x, layer.map_to_feat.weight, k=10).shape == (2, 8, 3, 32, 10)